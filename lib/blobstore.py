@@ -0,0 +1,100 @@
+"""
+Blob store
+
+Payloads of the received messages, one file each under /flash/blobs, named
+by the SHA-256 of their content (first DIGEST_SIZE bytes, in hex). A payload
+is written once: receiving the same content again reuses its file. The
+messages database keeps only metadata rows pointing to the blobs (key, size,
+content type), so binary images are stored as they are, without JSON
+escaping, and message listings stay small.
+"""
+
+import binascii
+import hashlib
+import os
+
+DIGEST_SIZE = 16    # bytes of the SHA-256 in the blob name
+
+TEXT = 'text/plain; charset=utf-8'
+BINARY = 'application/octet-stream'
+
+# (magic, content type) of the images the nodes send
+MAGIC = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+)
+
+
+def content_type(payload):
+    # Image by its magic number, text when it decodes as UTF-8, else binary
+    for magic, kind in MAGIC:
+        if payload[:len(magic)] == magic:
+            return kind
+    if payload[:4] == b'RIFF' and payload[8:12] == b'WEBP':
+        return 'image/webp'
+    try:
+        str(payload, 'utf-8')
+        return TEXT
+    except UnicodeError:
+        return BINARY
+
+
+def key_of(payload):
+    return binascii.hexlify(hashlib.sha256(payload).digest()[:DIGEST_SIZE]).decode()
+
+
+class BlobStore:
+
+    def __init__(self, path='/flash/blobs'):
+        self.path = path
+        try:
+            os.mkdir(path)
+        except OSError:
+            pass
+
+    def file(self, key):
+        return '{}/{}'.format(self.path, key)
+
+    def exists(self, key):
+        try:
+            os.stat(self.file(key))
+            return True
+        except OSError:
+            return False
+
+    def put(self, payload):
+        # Stores payload once, returns its key
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        key = key_of(payload)
+        self.write(key, payload)
+        return key
+
+    def write(self, key, payload):
+        # Stores payload under its key (key_of) unless it is already there
+        if not self.exists(key):
+            # Written aside then renamed: a reset never leaves a partial blob under its key
+            tmp_path = self.file(key) + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(payload)
+            os.rename(tmp_path, self.file(key))
+
+    def get(self, key):
+        with open(self.file(key), 'rb') as f:
+            return f.read()
+
+    def remove(self, key):
+        try:
+            os.remove(self.file(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            try:
+                os.remove('{}/{}'.format(self.path, name))
+            except OSError:
+                pass
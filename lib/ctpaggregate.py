@@ -0,0 +1,119 @@
+"""
+LoRa CTP small message aggregation
+
+Short messages to the same peer sent while a transfer to it is running are
+coalesced into one batch message, so they share one frame header and one
+ACK round trip:
+
+    CTRL_PREFIX, CTRL_BATCH, then per message: length (1 byte), data
+
+The first message of a batch is the leader: it goes out as soon as no
+other batch to that peer is in flight (plus linger_ms, 0 by default), with
+everything queued meanwhile; a lone message goes out as is, without any
+wait. The callers of the other messages block until that transfer ends and
+get the same result. A batch is closed as soon as the next message would
+not fit in one frame.
+
+Only peers that agreed on batches in the session handshake get them (see
+ctpsession), older firmware would store a batch as one message.
+"""
+
+import time
+
+import _thread
+
+from ctpcodec import CTRL_PREFIX, CTRL_BATCH
+
+try:
+    from time import sleep_ms
+except ImportError:
+    # CPython: offline tools and replay harnesses
+    def sleep_ms(ms):
+        time.sleep(ms / 1000)
+
+PREFIX = CTRL_PREFIX + bytes([CTRL_BATCH])
+MAX_RECORD = 255
+
+
+def is_batch(data):
+    return data[:len(PREFIX)] == PREFIX
+
+
+def split(data):
+    # Messages of a batch, in order
+    records = []
+    offset = len(PREFIX)
+    while offset < len(data):
+        size = data[offset]
+        records.append(data[offset + 1:offset + 1 + size])
+        offset += 1 + size
+    return records
+
+
+class Batch:
+
+    def __init__(self):
+        self.records = []
+        self.size = len(PREFIX)
+        self.result = None
+        self.done = _thread.allocate_lock()
+        self.done.acquire()
+
+    def fits(self, payload, max_size):
+        return self.size + 1 + len(payload) <= max_size
+
+    def add(self, payload):
+        self.records.append(payload)
+        self.size += 1 + len(payload)
+
+    def encode(self):
+        if len(self.records) == 1:
+            return self.records[0]
+        out = bytearray(PREFIX)
+        for record in self.records:
+            out.append(len(record))
+            out += record
+        return bytes(out)
+
+
+class Aggregator:
+
+    def __init__(self, send, max_size, linger_ms=0):
+        # send(addr, payload) performs the transfer and returns its result
+        self.send_batch = send
+        self.max_size = max_size
+        self.linger_ms = linger_ms
+        self.lock = _thread.allocate_lock()
+        self.open = {}      # addr -> batch collecting messages
+        self.sending = {}   # addr -> lock held while a batch to addr is in flight
+
+    def send(self, addr, payload):
+        with self.lock:
+            batch = self.open.get(addr)
+            leader = (batch is None) or not batch.fits(payload, self.max_size)
+            if leader:
+                batch = self.open[addr] = Batch()
+            batch.add(payload)
+            sending = self.sending.get(addr)
+            if sending is None:
+                sending = self.sending[addr] = _thread.allocate_lock()
+
+        if not leader:
+            # The leader sends it: wait for the transfer
+            batch.done.acquire()
+            batch.done.release()
+            return batch.result
+
+        # The batch keeps collecting while the previous one to addr is in flight
+        sending.acquire()
+        try:
+            if self.linger_ms:
+                sleep_ms(self.linger_ms)
+            with self.lock:
+                if self.open.get(addr) is batch:
+                    del self.open[addr]
+            batch.result = self.send_batch(addr, batch.encode())
+        finally:
+            sending.release()
+            batch.done.release()
+        return batch.result
@@ -0,0 +1,99 @@
+"""
+LoRa CTP short node IDs
+
+Every node claims a 1 byte alias and advertises it in its hello beacons,
+bound to its full address. Data and ACK frames between two nodes that know
+each other's alias use the 7 byte short header (see ctpcodec) instead of the
+20 byte one.
+
+Rules:
+- The alias candidate of a node is derived from its address (1..254),
+  0 is the broadcast alias.
+- If a node with a lower address advertises the same alias, the node with
+  the higher address moves to the next free alias. Every node applies the
+  same rule, so they converge without negotiation.
+- An alias advertised by two different addresses is a collision: it is not
+  resolved and frames to/from those nodes use full addresses.
+- A peer is only addressed by alias once its own hello lists our current
+  alias, i.e. it is able to resolve our short frames.
+"""
+
+import hashlib
+
+BROADCAST_ALIAS = 0
+MIN_ALIAS = 1
+MAX_ALIAS = 254
+
+
+def candidate(addr):
+    # Initial alias of a node, derived from its address
+    return hashlib.sha256(addr).digest()[0] % MAX_ALIAS + MIN_ALIAS
+
+
+class AliasTable:
+
+    def __init__(self, my_addr, any_addr):
+        self.my_addr = my_addr
+        self.any_addr = any_addr
+        self.my_alias = candidate(my_addr)
+        self.advertised = {}    # addr -> alias advertised in its hello
+        self.confirmed = {}     # addr -> our alias as listed in its hello
+        self.resolve = {}       # alias -> addr, only unique aliases (used by ctpcodec.decode)
+        self.__rebuild()
+
+    def __rebuild(self):
+        # Resolve our own alias against lower addresses, then index the unique ones
+        claimed = {}
+        for addr, alias in self.advertised.items():
+            claimed.setdefault(alias, []).append(addr)
+
+        alias = candidate(self.my_addr)
+        for _ in range(MAX_ALIAS):
+            owners = claimed.get(alias, ())
+            if not any(addr < self.my_addr for addr in owners):
+                break
+            alias = alias + 1 if alias < MAX_ALIAS else MIN_ALIAS
+        self.my_alias = alias
+
+        resolve = {BROADCAST_ALIAS: self.any_addr, self.my_alias: self.my_addr}
+        for alias, owners in claimed.items():
+            if alias == self.my_alias or alias == BROADCAST_ALIAS:
+                continue
+            if len(owners) == 1:
+                resolve[alias] = owners[0]
+        self.resolve = resolve
+
+    def learn(self, addr, alias, listed_alias=None):
+        # addr advertised alias in its hello, listing our alias as listed_alias
+        # Returns True if our own alias changed
+        previous = self.my_alias
+        if alias is None:
+            self.advertised.pop(addr, None)
+        else:
+            self.advertised[addr] = alias
+        if listed_alias is None:
+            self.confirmed.pop(addr, None)
+        else:
+            self.confirmed[addr] = listed_alias
+        self.__rebuild()
+        return self.my_alias != previous
+
+    def forget(self, addr):
+        # Stop addressing addr by alias until its next hello
+        self.confirmed.pop(addr, None)
+
+    def alias_of(self, addr):
+        # Alias to use in frames to addr, or None to use the full address
+        alias = self.advertised.get(addr)
+        if alias is None or self.resolve.get(alias) != addr:
+            return None
+        if self.confirmed.get(addr) != self.my_alias:
+            return None
+        return alias
+
+    def neighbours(self):
+        # Map addr -> alias (or '' if not resolvable) to be advertised in the hello
+        out = {}
+        for addr, alias in self.advertised.items():
+            out[addr] = alias if self.resolve.get(alias) == addr else ''
+        return out
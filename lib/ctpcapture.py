@@ -0,0 +1,160 @@
+"""
+LoRa CTP frame capture
+
+Records every frame sent or received by a CTPendpoint, with its direction,
+time, RSSI and SNR, to a compact binary log on flash. The endpoint sockets
+are wrapped by CaptureSocket, so the protocol engine is unchanged. Captures
+are replayed offline through the receive path by tools/ctpreplay.py.
+
+The log is a 14 byte header (magic, version, record header size, address of
+the capturing node) followed by records (little endian):
+    1 byte:  direction (0 received, 1 sent)
+    4 bytes: milliseconds since the capture started
+    2 bytes: RSSI (dBm, signed, 0 for sent frames)
+    1 byte:  SNR (dB, signed, rounded)
+    2 bytes: frame length
+    the frame
+
+Records are buffered in RAM and written in blocks. When the log exceeds
+max_bytes it is renamed to <path>.old and a new one is started, so at most
+twice max_bytes are kept.
+"""
+
+import os
+import struct
+
+import _thread
+
+from ctpmetrics import ticks_ms, ticks_diff
+
+FILE_FORMAT    = "<4sBB8s"
+FILE_SIZE      = 14
+FILE_MAGIC     = b'CTPC'
+FILE_VERSION   = 1
+RECORD_FORMAT  = "<BIhbH"
+RECORD_SIZE    = 10
+
+RX = 0
+TX = 1
+
+
+class Capture:
+
+    def __init__(self, path, my_addr, max_bytes=65536, buffer_size=2048):
+        self.path = path
+        self.my_addr = my_addr
+        self.max_bytes = max_bytes
+        self.buf = bytearray(buffer_size)
+        self.used = 0
+        self.start = ticks_ms()
+        self.records = 0
+        self.lock = _thread.allocate_lock()
+        self.file = None
+        self.__open()
+
+    def __open(self):
+        self.file = open(self.path, 'wb')
+        self.file.write(struct.pack(FILE_FORMAT, FILE_MAGIC, FILE_VERSION, RECORD_SIZE, self.my_addr))
+        self.size = FILE_SIZE
+
+    def __write(self):
+        # Called with the lock held
+        if self.used:
+            self.file.write(self.buf[:self.used])
+            self.size += self.used
+            self.used = 0
+        if self.size >= self.max_bytes:
+            self.file.close()
+            try:
+                os.remove(self.path + '.old')
+            except OSError:
+                pass
+            os.rename(self.path, self.path + '.old')
+            self.__open()
+
+    def record(self, direction, frame, n, rssi=0, snr=0):
+        with self.lock:
+            if self.file is None:
+                return
+            if self.used + RECORD_SIZE + n > len(self.buf):
+                self.__write()
+                if RECORD_SIZE + n > len(self.buf):
+                    return
+            struct.pack_into(RECORD_FORMAT, self.buf, self.used, direction,
+                             ticks_diff(ticks_ms(), self.start) & 0xFFFFFFFF, rssi, int(round(snr)), n)
+            self.used += RECORD_SIZE
+            self.buf[self.used:self.used + n] = frame[:n]
+            self.used += n
+            self.records += 1
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.__write()
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.__write()
+                self.file.close()
+                self.file = None
+
+
+class CaptureSocket:
+    # Wraps an endpoint socket, recording the frames that go through it.
+    # link() gives the (rssi, snr) of the frame just read
+
+    def __init__(self, sock, capture, link):
+        self.sock = sock
+        self.capture = capture
+        self.rx_link = link
+        self.sock_readinto = getattr(sock, 'readinto', None)
+        # Ring sockets know the link quality of each frame (see loractp __link)
+        self.link = getattr(sock, 'link', None)
+
+    def settimeout(self, value):
+        self.sock.settimeout(value)
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def send(self, data):
+        n = self.sock.send(data)
+        self.capture.record(TX, data, len(data))
+        return n
+
+    def readinto(self, buf):
+        if self.sock_readinto is not None:
+            n = self.sock_readinto(buf)
+        else:
+            packet = self.sock.recv(len(buf))
+            n = len(packet)
+            buf[:n] = packet
+        if n:
+            rssi, snr = self.rx_link()
+            self.capture.record(RX, buf, n, rssi, snr)
+        return n
+
+    def recv(self, size):
+        buf = bytearray(size)
+        n = self.readinto(buf)
+        return bytes(buf[:n])
+
+
+def decode(data):
+    # Parse a capture log into (my_addr, records), records being tuples
+    # (direction, t_ms, rssi, snr, frame)
+    magic, version, rsize, my_addr = struct.unpack_from(FILE_FORMAT, data, 0)
+    if magic != FILE_MAGIC or version != FILE_VERSION or rsize != RECORD_SIZE:
+        raise ValueError("Not a CTP capture")
+    records = []
+    offset = FILE_SIZE
+    while offset + RECORD_SIZE <= len(data):
+        direction, t_ms, rssi, snr, n = struct.unpack_from(RECORD_FORMAT, data, offset)
+        offset += RECORD_SIZE
+        if offset + n > len(data):
+            break   # truncated by a reset while writing
+        records.append((direction, t_ms, rssi, snr, bytes(data[offset:offset + n])))
+        offset += n
+    return my_addr, records
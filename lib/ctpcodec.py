@@ -0,0 +1,257 @@
+"""
+LoRa CTP packet codec
+
+Precompiled encoder/decoder for the LoRaCTP frame header:
+    8 bytes: source addr (last 8 bytes)
+    8 bytes: dest addr (last 8 bytes)
+    1 byte: flags
+    3 bytes: checksum
+
+and for the short header used between nodes that know each other's alias
+(see ctpalias):
+    1 byte: SHORT_MARK, never the first byte of an address (ASCII hex)
+    1 byte: source alias
+    1 byte: dest alias
+    1 byte: flags
+    3 bytes: checksum
+
+The header layout is compiled once into a Struct object and the flags byte is
+translated with lookup tables, so encoding and decoding a frame does not parse
+a format string nor branch on every flag. It has no dependency on the radio,
+so it also runs on CPython (tools/bench_ctpcodec.py).
+"""
+
+import binascii
+import hashlib
+import struct
+
+try:
+    Struct = struct.Struct
+except AttributeError:
+    # MicroPython's struct module has no Struct class: bind the format once
+    class Struct:
+
+        def __init__(self, fmt):
+            self.format = fmt
+            self.size = struct.calcsize(fmt)
+
+        def pack(self, *values):
+            return struct.pack(self.format, *values)
+
+        def pack_into(self, buf, offset, *values):
+            struct.pack_into(self.format, buf, offset, *values)
+
+        def unpack(self, data):
+            return struct.unpack(self.format, data)
+
+        def unpack_from(self, data, offset=0):
+            return struct.unpack_from(self.format, data, offset)
+
+HEADER_FORMAT = "!8s8sB3s"
+HEADER = Struct(HEADER_FORMAT)
+HEADER_SIZE = HEADER.size
+NO_CHECKSUM = b''
+
+SHORT_MARK = 0xA5
+SHORT_HEADER_FORMAT = "!BBBB3s"
+SHORT_HEADER = Struct(SHORT_HEADER_FORMAT)
+SHORT_HEADER_SIZE = SHORT_HEADER.size
+
+# Payload-level control messages (dedup manifests, ...) start with this prefix
+# followed by a type byte. User payloads in this repo are JSON or text, never NUL.
+CTRL_PREFIX   = b'\x00CTP'
+CTRL_MANIFEST = 0x01    # ctpdedup
+CTRL_DELTA    = 0x02    # ctpdedup
+CTRL_SEGMENT  = 0x03    # priority segment (loractp)
+CTRL_SESSION  = 0x04    # ctpsession
+CTRL_BATCH    = 0x05    # ctpaggregate
+
+# Flag bits
+F_SEQNUM    = 1 << 0
+F_ACKNUM    = 1 << 2
+F_HINT      = 1 << 3    # ACK with a neighbour presence hint trailer (ctpneighbors)
+F_LAST      = 1 << 4
+F_HELLO     = 1 << 5
+F_IS_ACK    = 1 << 6
+F_ACK_REQ   = 1 << 7
+
+# FLAGS_ENCODE[seqnum | acknum<<1 | is_last<<2 | hello<<3 | is_ack<<4 | ack_required<<5] -> flags byte
+FLAGS_ENCODE = bytes(
+    (F_SEQNUM if i & 1 else 0) | (F_ACKNUM if i & 2 else 0) | (F_LAST if i & 4 else 0) |
+    (F_HELLO if i & 8 else 0) | (F_IS_ACK if i & 16 else 0) | (F_ACK_REQ if i & 32 else 0)
+    for i in range(64))
+
+# FLAGS_DECODE[flags byte] -> (hello, seqnum, ack_required, acknum, is_ack, is_last)
+FLAGS_DECODE = tuple(
+    (f & F_HELLO != 0, f & F_SEQNUM, f & F_ACK_REQ != 0, (f >> 2) & 1, f & F_IS_ACK != 0, f & F_LAST != 0)
+    for f in range(256))
+
+
+def flags(seqnum, acknum, is_last, hello, is_ack, ack_required):
+    # seqnum, acknum: 0/1, the rest booleans
+    return FLAGS_ENCODE[seqnum | (acknum << 1) | (4 if is_last else 0) | (8 if hello else 0) |
+                        (16 if is_ack else 0) | (32 if ack_required else 0)]
+
+
+def checksum(data):
+    # Last 3 hex digits of the SHA256 of data
+    return binascii.hexlify(hashlib.sha256(data).digest())[-3:]
+
+
+def encode(s_addr, d_addr, flag_byte, content):
+    # Returns a whole frame. Data frames carry the checksum of their content
+    if content and not (flag_byte & F_IS_ACK):
+        return HEADER.pack(s_addr, d_addr, flag_byte, checksum(content)) + content
+    return HEADER.pack(s_addr, d_addr, flag_byte, NO_CHECKSUM)
+
+
+def encode_short(s_alias, d_alias, flag_byte, content):
+    if content and not (flag_byte & F_IS_ACK):
+        return SHORT_HEADER.pack(SHORT_MARK, s_alias, d_alias, flag_byte, checksum(content)) + content
+    return SHORT_HEADER.pack(SHORT_MARK, s_alias, d_alias, flag_byte, NO_CHECKSUM)
+
+
+def with_reply(ack_frame, reply):
+    # ACK frame carrying a reply to the transfer it acknowledges (see loractp),
+    # the checksum field then protects the reply
+    size = header_size(ack_frame)
+    return ack_frame[:size - 3] + checksum(reply) + reply
+
+
+def with_hint(ack_frame, hint):
+    # ACK frame followed by a neighbour presence hint (see ctpneighbors)
+    frame = bytearray(ack_frame)
+    frame[3 if frame[0] == SHORT_MARK else 16] |= F_HINT
+    return bytes(frame) + hint
+
+
+def is_short(packet):
+    return packet[0] == SHORT_MARK
+
+
+def decode(packet, aliases=None):
+    # Break a packet into (sp, dp, hello, seqnum, ack_required, acknum, is_ack, is_last, check, payload)
+    # Short frames are resolved with aliases (alias -> addr), unknown aliases give None
+    if packet[0] == SHORT_MARK:
+        mark, s_alias, d_alias, flag_byte, check = SHORT_HEADER.unpack_from(packet, 0)
+        sp = aliases.get(s_alias) if aliases else None
+        dp = aliases.get(d_alias) if aliases else None
+        content = packet[SHORT_HEADER_SIZE:]
+    else:
+        sp, dp, flag_byte, check = HEADER.unpack_from(packet, 0)
+        content = packet[HEADER_SIZE:]
+    hello, seqnum, ack_required, acknum, is_ack, is_last = FLAGS_DECODE[flag_byte]
+    return sp, dp, hello, seqnum, ack_required, acknum, is_ack, is_last, check, content
+
+
+# In-place accessors for received frames (bytearray), used by the protocol
+# engine so that inspecting a frame allocates nothing
+
+def header_size(buf):
+    return SHORT_HEADER_SIZE if buf[0] == SHORT_MARK else HEADER_SIZE
+
+
+def flag_byte(buf):
+    return buf[3] if buf[0] == SHORT_MARK else buf[16]
+
+
+def check_value(buf, size):
+    # Checksum field of a frame with a header of the given size, as an int
+    return (buf[size - 3] << 16) | (buf[size - 2] << 8) | buf[size - 1]
+
+
+HEX_DIGITS = b'0123456789abcdef'
+
+
+def checksum_value(data):
+    # checksum(data) as an int, read from the digest: no hex string is built
+    digest = hashlib.sha256(data).digest()
+    return ((HEX_DIGITS[digest[30] & 15] << 16) | (HEX_DIGITS[digest[31] >> 4] << 8) |
+            HEX_DIGITS[digest[31] & 15])
+
+
+def same_bytes(buf, offset, ref):
+    # buf[offset:offset+len(ref)] == ref, without slicing
+    i = 0
+    n = len(ref)
+    while i < n:
+        if buf[offset + i] != ref[i]:
+            return False
+        i += 1
+    return True
+
+
+def fragment_count(length, payload_size):
+    return (length + payload_size - 1) // payload_size
+
+
+def pack_headers(s_addr, d_addr, payload, payload_size, hello=False, ack_required=True, headers=None):
+    # Batch mode: packs the header of every fragment of a stop & wait transfer
+    # (alternating seq/ack numbers, last flag, content checksum) into one
+    # preallocated buffer. Header i lives at [i*size:(i+1)*size], size being
+    # SHORT_HEADER_SIZE when the addresses are aliases (int), HEADER_SIZE otherwise.
+    # headers is reused when it is large enough, so repeated transfers allocate nothing.
+    # Only the checksums differ from a fragment to the next but one: the buffer is
+    # filled with the two alternating headers in one copy, then each fragment gets
+    # its three checksum digits, read from the digest as in checksum_value
+    total = fragment_count(len(payload), payload_size)
+    if isinstance(s_addr, int):
+        size = SHORT_HEADER_SIZE
+        prefix = bytes((SHORT_MARK, s_addr, d_addr))
+    else:
+        size = HEADER_SIZE
+        prefix = s_addr + d_addr
+    if headers is None or len(headers) < total * size:
+        headers = bytearray(total * size)
+    if total == 0:
+        return headers
+    even = flags(0, 1, False, hello, False, ack_required)
+    odd = flags(1, 0, False, hello, False, ack_required)
+    pair = prefix + bytes((even, 0, 0, 0)) + prefix + bytes((odd, 0, 0, 0))
+    headers[0:total * size] = (pair * ((total + 1) // 2))[:total * size]
+    headers[(total - 1) * size + size - 4] |= F_LAST
+    mv = memoryview(payload)
+    sha256 = hashlib.sha256
+    hex_digits = HEX_DIGITS
+    check = size - 3
+    for start in range(0, len(payload), payload_size):
+        digest = sha256(mv[start:start + payload_size]).digest()
+        headers[check] = hex_digits[digest[30] & 15]
+        headers[check + 1] = hex_digits[digest[31] >> 4]
+        headers[check + 2] = hex_digits[digest[31] & 15]
+        check += size
+    return headers
+
+
+class AckCache:
+    # Precomputed ACK frames per (peer, flags). An ACK frame only depends on
+    # the two addresses and the flags byte, so each variant is built once.
+    # A peer given as an int is an alias: the frame uses the short header
+    # with my_alias, and the cache is dropped whenever my_alias changes.
+
+    def __init__(self, my_addr, my_alias=None):
+        self.my_addr = my_addr
+        self.my_alias = my_alias
+        self.frames = {}
+
+    def get(self, peer, flag_byte):
+        try:
+            frame = self.frames[peer][flag_byte]
+        except KeyError:
+            self.frames[peer] = [None] * 256
+            frame = None
+        if frame is None:
+            if isinstance(peer, int):
+                frame = SHORT_HEADER.pack(SHORT_MARK, self.my_alias, peer, flag_byte | F_IS_ACK, NO_CHECKSUM)
+            else:
+                frame = HEADER.pack(self.my_addr, peer, flag_byte | F_IS_ACK, NO_CHECKSUM)
+            self.frames[peer][flag_byte] = frame
+        return frame
+
+    def set_alias(self, my_alias):
+        if my_alias != self.my_alias:
+            self.my_alias = my_alias
+            self.frames = {}
+
+    def clear(self):
+        self.frames = {}
@@ -0,0 +1,137 @@
+"""
+LoRa CTP congestion control
+
+The sender is stop & wait, so there is no window to adapt: the in-flight
+amount is always one frame. What competing flows can share fairly is the
+frame rate, so each peer has an AIMD controller of its sending rate
+(frames per second) that paces the frames of a transfer:
+
+- every acknowledged frame increases the rate by ALPHA (additive increase),
+- a lost frame (ACK timeout) multiplies it by BETA (multiplicative decrease),
+  once per frame however many times it is retransmitted,
+- the RTT is a delay signal: when the smoothed RTT rises DELAY_TARGET_MS
+  above the lowest one seen, frames are queueing (busy receiver, contended
+  channel) and the rate is multiplied by BETA_DELAY, at most once every
+  DELAY_HOLD ACKs, before losses show up,
+- before a frame the sender waits until 1/rate has elapsed since the previous
+  one, the RTT spent waiting for the ACK counts as part of that interval.
+
+Rates derive from the frame airtime at the radio settings: a new peer starts
+at the stop & wait capacity of the link (a full frame and its ACK back to
+back) and no rate goes above what the channel and the duty cycle allow.
+Frames that get no feedback (broadcasts, transfers without ACKs) have no
+signal to adapt to: they are paced at that duty cycle limit only.
+
+Flows that see the same losses converge to the same rate, as with TCP AIMD.
+Retransmissions wait a random delay within an interval that doubles with
+every attempt, instead of the fixed 0/1/2 s that made colliding senders
+retransmit into each other again. Controllers live across transfers.
+"""
+
+import time
+
+import machine
+
+from ctpmetrics import ticks_ms, ticks_diff
+
+try:
+    from time import sleep_ms
+except ImportError:
+    # CPython: offline tools and replay harnesses
+    def sleep_ms(ms):
+        time.sleep(ms / 1000)
+
+RATE_MIN   = 0.2        # frames per second
+ALPHA      = 0.25       # frames per second, per acknowledged frame
+BETA       = 0.5
+BETA_DELAY = 0.85
+DELAY_TARGET_MS = 100   # queueing delay above the base RTT that counts as congestion
+DELAY_HOLD = 8          # ACKs between two delay decreases
+DUTY_CYCLE = 1.0        # share of time on air allowed by the band (0.01 or 0.1 in EU868 sub-bands)
+RETRY_BASE_MS = 500
+
+
+def airtime_ms(size, sf=7, bw_khz=250):
+    # Time on air of a LoRa frame of size bytes (explicit header, CRC, coding rate 4/5,
+    # 8 symbol preamble), from the Semtech SX127x datasheet formula
+    symbol_ms = (1 << sf) / bw_khz
+    de = 1 if symbol_ms > 16 else 0     # low data rate optimization
+    bits = 8 * size - 4 * sf + 28 + 16
+    symbols = 8 + max(-(-bits // (4 * (sf - 2 * de))) * 5, 0)
+    return int((12.25 + symbols) * symbol_ms + 0.5)
+
+
+class Controller:
+
+    def __init__(self, rate_init, rate_max):
+        self.rate = rate_init
+        self.rate_max = rate_max
+        self.last_send = None
+        self.base_rtt = None    # ms, lowest RTT seen
+        self.srtt = None        # ms, smoothed RTT (1/8)
+        self.hold = 0           # ACKs before the next delay decrease is allowed
+
+    def interval_ms(self, feedback=True):
+        return int(1000 / (self.rate if feedback else self.rate_max))
+
+    def pace(self, feedback=True):
+        # Waits for the next send slot, returns the time waited in ms.
+        # feedback: the frame is acknowledged, else it goes at the duty cycle limit
+        wait = 0
+        if self.last_send is not None:
+            wait = self.interval_ms(feedback) - ticks_diff(ticks_ms(), self.last_send)
+            if wait > 0:
+                sleep_ms(wait)
+            else:
+                wait = 0
+        self.last_send = ticks_ms()
+        return wait
+
+    def retry_delay(self, attempt):
+        # Random wait before retransmission number attempt (1, 2, ...), returns it in ms
+        window = max(self.interval_ms(), RETRY_BASE_MS) << (attempt - 1)
+        delay = machine.rng() % window
+        sleep_ms(delay)
+        self.last_send = ticks_ms()
+        return delay
+
+    def on_ack(self, rtt_ms=None):
+        if rtt_ms is not None:
+            if (self.base_rtt is None) or (rtt_ms < self.base_rtt):
+                self.base_rtt = rtt_ms
+            self.srtt = rtt_ms if self.srtt is None else (self.srtt * 7 + rtt_ms) >> 3
+            if self.hold > 0:
+                self.hold -= 1
+            elif self.srtt - self.base_rtt > DELAY_TARGET_MS:
+                # Queueing delay: back off before it turns into losses
+                self.rate = max(self.rate * BETA_DELAY, RATE_MIN)
+                self.hold = DELAY_HOLD
+                return
+        self.rate = min(self.rate + ALPHA, self.rate_max)
+
+    def on_loss(self):
+        self.rate = max(self.rate * BETA, RATE_MIN)
+
+
+class Registry:
+    # One controller per peer, rates derived from the frame airtimes (ms)
+
+    def __init__(self, frame_ms, ack_ms, duty_cycle=DUTY_CYCLE):
+        self.rate_max = duty_cycle * 1000 / frame_ms
+        self.rate_init = min(1000 / (frame_ms + ack_ms), self.rate_max)
+        self.peers = {}
+
+    def peer(self, addr):
+        controller = self.peers.get(addr)
+        if controller is None:
+            controller = self.peers[addr] = Controller(self.rate_init, self.rate_max)
+        return controller
+
+    def rates(self):
+        # Current rate of every peer in frames per second
+        return dict((addr, controller.rate) for addr, controller in self.peers.items())
+
+    def delays(self):
+        # (base RTT, smoothed RTT) in ms of every peer that acknowledged frames
+        return dict((addr, (controller.base_rtt, controller.srtt)) for addr, controller in self.peers.items()
+                    if controller.srtt is not None)
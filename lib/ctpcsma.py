@@ -0,0 +1,58 @@
+"""
+LoRa CTP listen before talk
+
+Carrier sense with randomized binary exponential backoff before every data
+or hello frame. The Pycom LoRa API has no channel activity detection, so the
+channel is sensed with `LoRa.ischannel_free(rssi_threshold)`; radios without
+it are always considered free.
+
+While the channel is busy the sender waits a random number of slots in
+[0, cw) and doubles cw up to CW_MAX. After MAX_ATTEMPTS busy senses the
+frame is sent anyway, so a noisy channel delays frames but never blocks them.
+ACKs are not deferred: the peer is waiting for them and the channel is
+already ours.
+"""
+
+import time
+
+import machine
+
+try:
+    from time import sleep_ms
+except ImportError:
+    # CPython: offline tools and replay harnesses
+    def sleep_ms(ms):
+        time.sleep(ms / 1000)
+
+RSSI_THRESHOLD = -90    # dBm, above it the channel is busy
+SLOT_MS      = 50       # about a quarter of a full frame airtime at SF7/250 kHz
+CW_MIN       = 4        # slots
+CW_MAX       = 64
+MAX_ATTEMPTS = 6
+
+
+class Csma:
+
+    def __init__(self, lora, rssi_threshold=RSSI_THRESHOLD):
+        self.sense = getattr(lora, 'ischannel_free', None)
+        self.rssi_threshold = rssi_threshold
+
+    def backoff(self, cw):
+        # Random wait of [0, cw) slots, returns it in ms
+        delay = (machine.rng() % cw) * SLOT_MS
+        if delay:
+            sleep_ms(delay)
+        return delay
+
+    def wait(self):
+        # Waits for a free channel, returns (busy senses, total backoff in ms)
+        if self.sense is None:
+            return 0, 0
+        busy = 0
+        waited = 0
+        cw = CW_MIN
+        while busy < MAX_ATTEMPTS and not self.sense(self.rssi_threshold):
+            busy += 1
+            waited += self.backoff(cw)
+            cw = min(cw * 2, CW_MAX)
+        return busy, waited
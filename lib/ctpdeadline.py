@@ -0,0 +1,55 @@
+"""
+LoRa CTP deadlines and cancellation
+
+A Deadline bounds a whole sendit/recvit call: it expires after `timeout`
+seconds, or as soon as its CancelToken is cancelled from another thread
+(e.g. a web request). The receiver raises Timeout/Cancelled when it stops
+waiting; the sender returns its status code instead, like any failed
+transfer.
+"""
+
+from ctpmetrics import ticks_ms, ticks_diff
+
+
+class Timeout(Exception):
+    pass
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancelToken:
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Deadline:
+
+    def __init__(self, timeout=None, cancel=None):
+        # timeout in seconds, None for no time limit
+        self.start = ticks_ms()
+        self.timeout_ms = None if timeout is None else int(timeout * 1000)
+        self.cancel = cancel
+
+    def remaining(self):
+        # Seconds left, None if there is no time limit
+        if self.timeout_ms is None:
+            return None
+        return max(0, self.timeout_ms - ticks_diff(ticks_ms(), self.start)) / 1000
+
+    def expired(self):
+        return (self.timeout_ms is not None) and (ticks_diff(ticks_ms(), self.start) >= self.timeout_ms)
+
+    def cancelled(self):
+        return (self.cancel is not None) and self.cancel.cancelled
+
+    def check(self):
+        if self.cancelled():
+            raise Cancelled()
+        if self.expired():
+            raise Timeout()
@@ -0,0 +1,229 @@
+"""
+LoRa CTP chunk deduplication
+
+rsync-like transfers of repeated or slightly edited payloads. The sender
+splits the payload in fixed size chunks and first sends a manifest with the
+digest of every chunk. The receiver answers, in the ACK of the manifest's last
+fragment, with a bitmap of the chunks it already holds in its chunk cache on
+flash, and the sender then only sends the missing chunks (delta message).
+
+Manifest:   CTRL_PREFIX, CTRL_MANIFEST, total length (4 bytes), chunk size (2 bytes), 8 byte digests
+Reply:      bitmap, bit i (LSB first) set if chunk i is held
+Delta:      CTRL_PREFIX, CTRL_DELTA, transfer id (8 bytes), missing chunks in order
+Reply:      DELTA_OK, or DELTA_REJECTED when the payload can't be rebuilt
+            (chunk evicted or corrupt, manifest lost): the sender resends it in full.
+            The check before the reply touches no flash, the payload is rebuilt
+            (chunks read and stored) once the ACK is sent
+
+The transfer id is the first 8 bytes of the SHA256 of the digest list.
+"""
+
+import binascii
+import hashlib
+import os
+import struct
+
+from ctpcodec import CTRL_PREFIX, CTRL_MANIFEST, CTRL_DELTA
+
+MANIFEST_PREFIX = CTRL_PREFIX + bytes([CTRL_MANIFEST])
+DELTA_PREFIX    = CTRL_PREFIX + bytes([CTRL_DELTA])
+MANIFEST_FORMAT = "!IH"
+MANIFEST_HEADER = len(MANIFEST_PREFIX) + struct.calcsize(MANIFEST_FORMAT)
+DELTA_HEADER    = len(DELTA_PREFIX) + 8
+
+CHUNK_SIZE  = 1024
+DIGEST_SIZE = 8
+
+DELTA_OK       = b'\x01'
+DELTA_REJECTED = b'\x00'
+
+
+def digest(chunk):
+    return hashlib.sha256(chunk).digest()[:DIGEST_SIZE]
+
+
+def chunk_count(length, chunk_size=CHUNK_SIZE):
+    return (length + chunk_size - 1) // chunk_size
+
+
+def manifest(payload, chunk_size=CHUNK_SIZE):
+    mv = memoryview(payload)
+    out = bytearray(MANIFEST_PREFIX)
+    out += struct.pack(MANIFEST_FORMAT, len(payload), chunk_size)
+    for i in range(chunk_count(len(payload), chunk_size)):
+        out += digest(mv[i * chunk_size:(i + 1) * chunk_size])
+    return bytes(out)
+
+
+def parse_manifest(data):
+    # Returns (transfer id, total length, chunk size, digests) or None
+    if len(data) < MANIFEST_HEADER or data[:len(MANIFEST_PREFIX)] != MANIFEST_PREFIX:
+        return None
+    total, chunk_size = struct.unpack_from(MANIFEST_FORMAT, data, len(MANIFEST_PREFIX))
+    digests = data[MANIFEST_HEADER:]
+    if chunk_size == 0 or len(digests) != chunk_count(total, chunk_size) * DIGEST_SIZE:
+        return None
+    return hashlib.sha256(digests).digest()[:8], total, chunk_size, digests
+
+
+def has_chunk(bitmap, i):
+    return i // 8 < len(bitmap) and (bitmap[i // 8] >> (i % 8)) & 1 == 1
+
+
+def delta(payload, manifest_data, bitmap):
+    # Delta message carrying the chunks the receiver is missing
+    transfer_id, total, chunk_size, digests = parse_manifest(manifest_data)
+    mv = memoryview(payload)
+    out = bytearray(DELTA_PREFIX)
+    out += transfer_id
+    for i in range(chunk_count(total, chunk_size)):
+        if not has_chunk(bitmap, i):
+            out += mv[i * chunk_size:(i + 1) * chunk_size]
+    return bytes(out)
+
+
+def is_manifest(data):
+    return data[:len(MANIFEST_PREFIX)] == MANIFEST_PREFIX
+
+
+def is_delta(data):
+    return data[:len(DELTA_PREFIX)] == DELTA_PREFIX
+
+
+class ChunkCache:
+    # Bounded chunk store on flash, one file per chunk named by its digest.
+    # The oldest chunks are evicted first, pinned chunks are never evicted.
+
+    def __init__(self, path='/flash/chunks', max_chunks=128):
+        self.path = path
+        self.max_chunks = max_chunks
+        self.pinned = set()
+        try:
+            os.mkdir(path)
+        except OSError:
+            pass
+        try:
+            names = os.listdir(path)
+        except OSError:
+            names = []
+        # Oldest first is not known after a reboot: files found on flash go first
+        self.order = [binascii.unhexlify(name) for name in names if len(name) == 2 * DIGEST_SIZE]
+
+    def __file(self, key):
+        return '{}/{}'.format(self.path, binascii.hexlify(key).decode())
+
+    def __contains__(self, key):
+        return key in self.order
+
+    def get(self, key):
+        try:
+            with open(self.__file(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key, chunk):
+        if key in self.order:
+            return
+        while len(self.order) >= self.max_chunks:
+            victim = None
+            for old in self.order:
+                if old not in self.pinned:
+                    victim = old
+                    break
+            if victim is None:
+                return
+            self.order.remove(victim)
+            try:
+                os.remove(self.__file(victim))
+            except OSError:
+                pass
+        with open(self.__file(key), 'wb') as f:
+            f.write(chunk)
+        self.order.append(key)
+
+
+class Deduplicator:
+    # Receiver side: answers manifests and rebuilds payloads from delta messages
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.pending = {}   # sender -> (transfer id, total, chunk size, digests, bitmap)
+
+    def answer(self, sender, data):
+        # Bitmap of the manifest's chunks already held, they stay pinned until the delta arrives
+        parsed = parse_manifest(data)
+        if parsed is None:
+            return None
+        transfer_id, total, chunk_size, digests = parsed
+        self.__release(sender)
+        count = chunk_count(total, chunk_size)
+        bitmap = bytearray((count + 7) // 8)
+        for i in range(count):
+            key = digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]
+            if key in self.cache:
+                bitmap[i // 8] |= 1 << (i % 8)
+                self.cache.pinned.add(key)
+        bitmap = bytes(bitmap)
+        self.pending[sender] = (transfer_id, total, chunk_size, digests, bitmap)
+        return bitmap
+
+    def accept(self, sender, data):
+        # Reply to a delta, sent in the ACK of its last fragment: whether rebuild() will
+        # have everything, i.e. the held chunks are still in the cache index and the
+        # carried ones match their digests. Only RAM is read, a rejected delta is forgotten
+        if self.__complete(sender, data):
+            return DELTA_OK
+        self.__release(sender)
+        return DELTA_REJECTED
+
+    def __complete(self, sender, data):
+        pending = self.pending.get(sender)
+        if pending is None or data[len(DELTA_PREFIX):DELTA_HEADER] != pending[0]:
+            return False
+        transfer_id, total, chunk_size, digests, bitmap = pending
+        mv = memoryview(data)
+        offset = DELTA_HEADER
+        for i in range(chunk_count(total, chunk_size)):
+            key = digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]
+            if has_chunk(bitmap, i):
+                if key not in self.cache:
+                    return False
+            else:
+                size = min(chunk_size, total - i * chunk_size)
+                if offset + size > len(data) or digest(mv[offset:offset + size]) != key:
+                    return False
+                offset += size
+        return offset == len(data)
+
+    def rebuild(self, sender, data):
+        # Full payload from a delta message, None if it doesn't match the pending manifest
+        pending = self.pending.get(sender)
+        if pending is None or data[len(DELTA_PREFIX):DELTA_HEADER] != pending[0]:
+            return None
+        transfer_id, total, chunk_size, digests, bitmap = pending
+        self.__release(sender)
+        payload = bytearray(total)
+        offset = DELTA_HEADER
+        for i in range(chunk_count(total, chunk_size)):
+            key = digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]
+            size = min(chunk_size, total - i * chunk_size)
+            if has_chunk(bitmap, i):
+                chunk = self.cache.get(key)
+            else:
+                chunk = data[offset:offset + size]
+                offset += size
+                if digest(chunk) != key:
+                    return None
+                self.cache.put(key, chunk)
+            if chunk is None or len(chunk) != size:
+                return None
+            payload[i * chunk_size:i * chunk_size + size] = chunk
+        return bytes(payload)
+
+    def __release(self, sender):
+        pending = self.pending.pop(sender, None)
+        if pending is not None:
+            digests = pending[3]
+            for i in range(len(digests) // DIGEST_SIZE):
+                self.cache.pinned.discard(digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE])
@@ -0,0 +1,103 @@
+"""
+LoRa CTP transfer metrics
+
+Cumulative per-peer counters kept by CTPendpoint across transfers. Each peer
+owns a flat list of integers indexed by the constants below, so updating a
+counter in the protocol hot path is a single list store. `snapshot` turns the
+registry into a plain dict for the HTTP API.
+"""
+
+import time
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    # CPython: offline tools and replay harnesses
+    def ticks_ms():
+        return int(time.perf_counter() * 1000) & 0x3FFFFFFF
+
+    def ticks_diff(a, b):
+        return ((a - b + 0x20000000) & 0x3FFFFFFF) - 0x20000000
+
+# Counter indices
+FRAMES_SENT     = 0     # data frames transmitted, retransmissions included
+FRAMES_RECV     = 1     # data frames received from the peer
+RETRANSMISSIONS = 2
+TIMEOUTS        = 3     # ACK not received in time
+CHECKSUM_FAIL   = 4
+DUPLICATES      = 5     # data frames received again because our ACK was lost
+TX_BYTES        = 6     # payload bytes delivered to the peer (acknowledged transfers)
+RX_BYTES        = 7     # payload bytes received from the peer
+TX_TIME_MS      = 8     # time spent in transfers to the peer
+RX_TIME_MS      = 9     # time spent in transfers from the peer
+TX_TRANSFERS    = 10
+TX_FAILED       = 11
+RX_TRANSFERS    = 12
+DEDUP_SAVED     = 13    # payload bytes not sent because the peer already held the chunks
+CHANNEL_BUSY    = 14    # carrier senses that found the channel busy (listen before talk)
+BACKOFF_MS      = 15    # time spent in backoff before sending to the peer
+PACING_MS       = 16    # time spent pacing frames and waiting before retransmissions (congestion control)
+RX_ABORTED      = 17    # partial transfers from the peer dropped: it went silent or sent more than max_transfer
+DEDUP_REJECTED  = 18    # delta transfers that didn't match their manifest, resent in full
+RTT_SUM_MS      = 19
+RTT_SAMPLES     = 20
+RTT_HISTOGRAM   = 21    # first bucket, one counter per RTT_BUCKETS_MS entry plus overflow
+
+BROADCAST = b'\x00\x00\x00\x00\x00\x00\x00\x00'
+
+# Upper bounds (ms) of the RTT histogram buckets
+RTT_BUCKETS_MS = (50, 100, 200, 500, 1000, 2000, 5000)
+COUNTERS = RTT_HISTOGRAM + len(RTT_BUCKETS_MS) + 1
+
+NAMES = ('frames_sent', 'frames_recv', 'retransmissions', 'timeouts', 'checksum_failures',
+         'duplicates', 'tx_bytes', 'rx_bytes', 'tx_time_ms', 'rx_time_ms', 'tx_transfers',
+         'tx_failed', 'rx_transfers', 'dedup_saved_bytes', 'channel_busy', 'backoff_ms',
+         'pacing_ms', 'rx_aborted', 'dedup_rejected')
+
+
+class Metrics:
+
+    def __init__(self):
+        self.peers = {}
+
+    def peer(self, addr):
+        # Returns the counters of a peer, fetch it once per transfer
+        counters = self.peers.get(addr)
+        if counters is None:
+            counters = self.peers[addr] = [0] * COUNTERS
+        return counters
+
+    @staticmethod
+    def rtt(counters, rtt_ms):
+        counters[RTT_SUM_MS] += rtt_ms
+        counters[RTT_SAMPLES] += 1
+        bucket = RTT_HISTOGRAM
+        for bound in RTT_BUCKETS_MS:
+            if rtt_ms <= bound:
+                break
+            bucket += 1
+        counters[bucket] += 1
+
+    def reset(self):
+        self.peers = {}
+
+    def snapshot(self):
+        out = {}
+        for addr, counters in self.peers.items():
+            peer = {}
+            for i, name in enumerate(NAMES):
+                peer[name] = counters[i]
+            histogram = {}
+            for i, bound in enumerate(RTT_BUCKETS_MS):
+                histogram['le_{}'.format(bound)] = counters[RTT_HISTOGRAM + i]
+            histogram['inf'] = counters[RTT_HISTOGRAM + len(RTT_BUCKETS_MS)]
+            peer['rtt_histogram_ms'] = histogram
+            peer['rtt_avg_ms'] = counters[RTT_SUM_MS] // counters[RTT_SAMPLES] if counters[RTT_SAMPLES] else None
+            peer['tx_goodput_bps'] = counters[TX_BYTES] * 8000 // counters[TX_TIME_MS] if counters[TX_TIME_MS] else None
+            peer['rx_goodput_bps'] = counters[RX_BYTES] * 8000 // counters[RX_TIME_MS] if counters[RX_TIME_MS] else None
+            if addr == BROADCAST:
+                addr = 'broadcast'
+            elif isinstance(addr, bytes):
+                addr = addr.decode('utf-8')
+            out[addr] = peer
+        return out
@@ -0,0 +1,129 @@
+"""
+LoRa CTP neighbour presence
+
+Every valid frame heard, a data frame for us that passes its checksum or
+an ACK of our transfer, proves that its sender is alive. Only well-formed
+addresses (8 hex digits) are recorded. The ACK of the last fragment of a transfer
+carries a presence hint: the addresses of the nodes its sender heard
+lately. It is a trailer after the ACK content (a control reply, if any),
+flagged by F_HINT:
+
+    4 bytes per address (binary form of the 8 hex digit address), count (1 byte)
+
+While a node is sending data or ACK frames its neighbours hear it anyway,
+so its hello beacons are suppressed, up to MAX_SUPPRESS_S: hellos still
+advertise the aliases (ctpalias) from time to time.
+"""
+
+import binascii
+
+from ctpmetrics import ticks_ms, ticks_diff
+
+HINT_MAX       = 8      # addresses in a hint
+ADDR_SIZE      = 4      # binary address in a hint
+LIVE_S         = 60     # s, a neighbour heard within this time is listed in our hints
+REFRESH_S      = 5      # s, a neighbour heard again within this time is not registered again
+MAX_SUPPRESS_S = 60     # s, at most this long without a hello
+
+
+HEX = b'0123456789ABCDEFabcdef'
+
+
+def valid_addr(addr):
+    # 8 hex digits, the short form of a node address
+    if not isinstance(addr, bytes) or len(addr) != 8:
+        return False
+    for c in addr:
+        if c not in HEX:
+            return False
+    return True
+
+
+def encode_hint(addrs):
+    # An address that can't be encoded is left out of the hint
+    out = bytearray()
+    count = 0
+    for addr in addrs:
+        if count == HINT_MAX:
+            break
+        try:
+            out += binascii.unhexlify(addr)
+        except ValueError:
+            continue
+        count += 1
+    out.append(count)
+    return bytes(out)
+
+
+def hint_size(buf, n):
+    # Size of the hint trailer ending at buf[n], 0 if it is malformed
+    if n < 1:
+        return 0
+    size = 1 + buf[n - 1] * ADDR_SIZE
+    return size if size <= n else 0
+
+
+def decode_hint(buf, n):
+    # Addresses of the hint trailer ending at buf[n]
+    size = hint_size(buf, n)
+    if not size:
+        return []
+    start = n - size
+    return [binascii.hexlify(bytes(buf[start + i:start + i + ADDR_SIZE])).upper()
+            for i in range(0, size - 1, ADDR_SIZE)]
+
+
+class Neighbors:
+
+    def __init__(self):
+        self.heard_at = {}      # addr -> ticks of the last frame heard from it
+        self.last_tx = None     # ticks of our last data or ACK frame
+        self.last_hello = None  # ticks of our last hello
+        self.suppressed = 0     # hellos skipped because traffic was flowing
+        self.hint = None        # cached hint, rebuilt when the live set changes
+        self.hinted = None
+
+    def heard(self, addr):
+        # addr sent a frame. Returns True if it was not heard within REFRESH_S,
+        # False as well for a malformed address, which is not recorded
+        if not valid_addr(addr):
+            return False
+        now = ticks_ms()
+        last = self.heard_at.get(addr)
+        self.heard_at[addr] = now
+        return (last is None) or (ticks_diff(now, last) > REFRESH_S * 1000)
+
+    def alive(self, max_age=LIVE_S):
+        # Addresses heard within max_age seconds, most recent first
+        now = ticks_ms()
+        live = [(ticks_diff(now, t), addr) for addr, t in self.heard_at.items() if ticks_diff(now, t) <= max_age * 1000]
+        live.sort()
+        return [addr for age, addr in live]
+
+    def get_hint(self):
+        live = self.alive()[:HINT_MAX]
+        if live != self.hinted:
+            self.hinted = live
+            self.hint = encode_hint(live)
+        return self.hint
+
+    def sent(self):
+        self.last_tx = ticks_ms()
+
+    def beacon_due(self, interval):
+        # Whether a hello is needed, hellos being sent every interval seconds
+        now = ticks_ms()
+        if (self.last_hello is None) or (ticks_diff(now, self.last_hello) >= MAX_SUPPRESS_S * 1000):
+            return True
+        if (self.last_tx is not None) and (ticks_diff(now, self.last_tx) < interval * 1000):
+            self.suppressed += 1
+            return False
+        return True
+
+    def hello_sent(self):
+        self.last_hello = ticks_ms()
+
+    def snapshot(self):
+        # JSON friendly: address -> seconds since heard
+        now = ticks_ms()
+        return {addr.decode('utf-8'): ticks_diff(now, t) // 1000 for addr, t in self.heard_at.items()}
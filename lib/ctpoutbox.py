@@ -0,0 +1,136 @@
+"""
+LoRa CTP store and forward outbox
+
+Messages that could not be delivered are queued on flash, one file per
+message named <destination>.<id>: a JSON line with the send options followed
+by the raw payload. They are sent again, in order, once the destination is
+heard again (its hello) and its retry is due.
+
+Retries are scheduled by link quality: the SNR margin above the SF7
+demodulation floor of the peer's last hello sets how long to wait after a
+failed attempt, doubling with each consecutive failure. Peers heard with
+the best link are served first. The schedule is kept in RAM, after a reboot
+every queued message is due as soon as its destination is heard.
+"""
+
+import os
+import time
+
+import ujson
+
+SNR_FLOOR     = -7.5    # dB, SF7 demodulation limit
+LINK_FRESH_S  = 60      # a peer is reachable if heard within this time
+RETRY_BASE_S  = 15
+RETRY_MAX_S   = 900
+
+
+def retry_delay(snr, failures):
+    # Seconds to wait after a failed attempt: longer for weak links and for repeated failures
+    margin = snr - SNR_FLOOR
+    factor = 1 if margin >= 10 else (2 if margin >= 5 else 4)
+    return min(RETRY_BASE_S * factor << min(failures - 1, 10), RETRY_MAX_S)
+
+
+class Outbox:
+
+    def __init__(self, path='/flash/outbox', max_messages=64):
+        self.path = path
+        self.max_messages = max_messages
+        self.queue = {}     # destination -> message ids, oldest first
+        self.links = {}     # destination -> (rssi, snr, last heard)
+        self.retry = {}     # destination -> (failures, next attempt)
+        self.next_id = 1
+        try:
+            os.mkdir(path)
+        except OSError:
+            pass
+        try:
+            names = os.listdir(path)
+        except OSError:
+            names = []
+        for name in names:
+            dest, _, msg_id = name.partition('.')
+            if msg_id.isdigit():
+                self.queue.setdefault(dest.encode(), []).append(int(msg_id))
+                self.next_id = max(self.next_id, int(msg_id) + 1)
+        for ids in self.queue.values():
+            ids.sort()
+
+    def __file(self, dest, msg_id):
+        return '{}/{}.{}'.format(self.path, dest.decode('utf-8'), msg_id)
+
+    def __len__(self):
+        return sum(len(ids) for ids in self.queue.values())
+
+    def put(self, dest, payload, ack_required=True, dedup=False):
+        # Queue payload for dest, returns its id or None if the outbox is full
+        if len(self) >= self.max_messages:
+            return None
+        msg_id = self.next_id
+        self.next_id += 1
+        meta = {'ack_required': ack_required, 'dedup': dedup, 'time': time.time()}
+        with open(self.__file(dest, msg_id), 'wb') as f:
+            f.write(ujson.dumps(meta).encode('utf-8'))
+            f.write(b'\n')
+            f.write(payload)
+        self.queue.setdefault(dest, []).append(msg_id)
+        return msg_id
+
+    def get(self, dest, msg_id):
+        # Returns (meta, payload)
+        with open(self.__file(dest, msg_id), 'rb') as f:
+            meta = ujson.loads(f.readline())
+            return meta, f.read()
+
+    def remove(self, dest, msg_id):
+        try:
+            os.remove(self.__file(dest, msg_id))
+        except OSError:
+            pass
+        ids = self.queue.get(dest, [])
+        if msg_id in ids:
+            ids.remove(msg_id)
+        if not ids:
+            self.queue.pop(dest, None)
+            self.retry.pop(dest, None)
+
+    def seen(self, dest, rssi, snr):
+        # dest was heard (hello) with the given link quality
+        self.links[dest] = (rssi, snr, time.time())
+
+    def due(self):
+        # Destinations with queued messages that are reachable and due, best link first
+        now = time.time()
+        ready = []
+        for dest in self.queue:
+            link = self.links.get(dest)
+            if link is None or now - link[2] > LINK_FRESH_S:
+                continue
+            failures, next_attempt = self.retry.get(dest, (0, 0))
+            if now >= next_attempt:
+                ready.append((link[1], dest))
+        ready.sort(reverse=True)
+        return [dest for snr, dest in ready]
+
+    def delivered(self, dest):
+        self.retry.pop(dest, None)
+
+    def failed(self, dest):
+        failures = self.retry.get(dest, (0, 0))[0] + 1
+        snr = self.links[dest][1] if dest in self.links else SNR_FLOOR
+        self.retry[dest] = (failures, time.time() + retry_delay(snr, failures))
+
+    def pending(self):
+        # Queued message ids, retry state and link quality per destination
+        out = {}
+        for dest, ids in self.queue.items():
+            failures, next_attempt = self.retry.get(dest, (0, 0))
+            link = self.links.get(dest)
+            out[dest.decode('utf-8')] = {
+                'messages': list(ids),
+                'failures': failures,
+                'next_attempt': next_attempt,
+                'rssi': link[0] if link else None,
+                'snr': link[1] if link else None
+            }
+        return out
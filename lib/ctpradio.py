@@ -0,0 +1,161 @@
+"""
+LoRa CTP event driven receive path
+
+The radio RX callback (LoRa.RX_PACKET_EVENT) copies every frame, with its
+RSSI, SNR and arrival time, into a preallocated ring buffer as soon as it
+leaves the modem FIFO, so frames are not lost while the protocol threads
+are busy (database writes, HTTP requests). ACK frames and data frames go to
+separate rings: the sender waiting for an ACK and the receive thread never
+steal each other's frames.
+
+RingSocket exposes a ring with the socket calls used by the protocol engine
+(settimeout, setblocking, readinto, recv, send): reads wait on the ring
+without polling, sends go to the real socket.
+"""
+
+import array
+import socket
+
+import _thread
+
+import ctpcodec
+from ctpmetrics import ticks_ms
+
+
+class FrameRing:
+
+    def __init__(self, slots, slot_size):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.buf = bytearray(slots * slot_size)
+        self.view = memoryview(self.buf)
+        self.lens = array.array('H', [0] * slots)
+        self.rssi = array.array('h', [0] * slots)
+        self.snr = array.array('f', [0] * slots)
+        self.ticks = array.array('L', [0] * slots)
+        self.head = 0       # next slot to write
+        self.count = 0
+        self.received = 0
+        self.dropped = 0    # oldest frames overwritten because the ring was full
+        self.last_rssi = 0
+        self.last_snr = 0
+        self.last_ticks = 0
+        self.lock = _thread.allocate_lock()
+        self.signal = _thread.allocate_lock()   # released when a frame arrives
+        self.signal.acquire()
+
+    def push(self, frame, n, rssi, snr, ticks):
+        # Called from the radio callback: copies frame[:n] into the next slot
+        n = min(n, self.slot_size)
+        with self.lock:
+            slot = self.head
+            start = slot * self.slot_size
+            self.view[start:start + n] = frame[:n]
+            self.lens[slot] = n
+            self.rssi[slot] = rssi
+            self.snr[slot] = snr
+            self.ticks[slot] = ticks
+            self.head = (slot + 1) % self.slots
+            if self.count == self.slots:
+                self.dropped += 1
+            else:
+                self.count += 1
+            self.received += 1
+        if self.signal.locked():
+            try:
+                self.signal.release()
+            except RuntimeError:
+                pass
+
+    def pop_into(self, buf):
+        # Copies the oldest frame into buf, returns its length or None if the ring is empty
+        with self.lock:
+            if self.count == 0:
+                return None
+            slot = (self.head - self.count) % self.slots
+            n = self.lens[slot]
+            start = slot * self.slot_size
+            buf[:n] = self.view[start:start + n]
+            self.last_rssi = self.rssi[slot]
+            self.last_snr = self.snr[slot]
+            self.last_ticks = self.ticks[slot]
+            self.count -= 1
+            return n
+
+    def wait(self, timeout):
+        # Waits for a frame to arrive, timeout in seconds (None: forever). False on timeout
+        return self.signal.acquire(1, -1 if timeout is None else timeout)
+
+    def stats(self):
+        return {'slots': self.slots, 'queued': self.count, 'received': self.received, 'dropped': self.dropped}
+
+
+class RingSocket:
+    # Socket-like view of a ring for the protocol engine. Timeouts apply to
+    # the ring only: the real socket keeps its own mode for sending
+
+    def __init__(self, ring, sock):
+        self.ring = ring
+        self.sock = sock
+        self.timeout = None
+
+    def settimeout(self, value):
+        self.timeout = value
+
+    def setblocking(self, flag):
+        self.timeout = None if flag else 0
+
+    def send(self, data):
+        return self.sock.send(data)
+
+    def readinto(self, buf):
+        while True:
+            n = self.ring.pop_into(buf)
+            if n is not None:
+                return n
+            if self.timeout == 0 or not self.ring.wait(self.timeout):
+                raise socket.timeout
+
+    def recv(self, size):
+        buf = bytearray(self.ring.slot_size)
+        n = self.readinto(buf)
+        return bytes(buf[:min(n, size)])
+
+    def link(self):
+        # (rssi, snr) of the last frame read
+        return self.ring.last_rssi, self.ring.last_snr
+
+
+class RxDispatcher:
+    # Radio callback: drains the receive socket into the ACK ring or the data ring
+
+    def __init__(self, lora, sock, ack_ring, data_ring, event):
+        self.lora = lora
+        self.sock = sock
+        self.ack_ring = ack_ring
+        self.data_ring = data_ring
+        self.event = event
+        self.scratch = bytearray(data_ring.slot_size)
+        self.readinto = getattr(sock, 'readinto', None)
+
+    def __call__(self, lora):
+        if not (lora.events() & self.event):
+            return
+        stats = self.lora.stats()
+        while True:
+            try:
+                if self.readinto is not None:
+                    n = self.readinto(self.scratch)
+                else:
+                    packet = self.sock.recv(len(self.scratch))
+                    n = len(packet)
+                    self.scratch[:n] = packet
+            except OSError:
+                return
+            if not n:
+                return
+            frame = self.scratch
+            if n >= ctpcodec.header_size(frame) and (ctpcodec.flag_byte(frame) & ctpcodec.F_IS_ACK):
+                self.ack_ring.push(frame, n, stats.rssi, stats.snr, ticks_ms())
+            else:
+                self.data_ring.push(frame, n, stats.rssi, stats.snr, ticks_ms())
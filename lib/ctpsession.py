@@ -0,0 +1,149 @@
+"""
+LoRa CTP session handshake
+
+Before the first transfer to a peer the sender offers its transfer
+parameters in a session control message, and the receiver answers with the
+agreed ones in the ACK of that message: one round trip. The agreement is
+cached per peer on both sides, so following transfers skip it.
+
+Parameters (JSON, short keys to fit in one frame):
+    v       protocol version
+    hdr     header versions: 1 long (addresses), 2 short (aliases)
+    win     frames in flight (this sender is stop & wait: 1)
+    ack     ACK modes: 'frame' (every frame), 'none'
+    comp    compression codecs ('none' only: there is no compressor on the LoPy)
+    fec     FEC ratio, redundant frames per 100 (no FEC yet: 0)
+    sf, bw  spreading factor and bandwidth (kHz) of the radio
+    dedup   chunk cache available (ctpdedup)
+    batch   coalesced small messages understood (ctpaggregate)
+    len     total length of the transfer that follows
+    id      transfer id
+
+The radio settings are not renegotiated on the fly: both ends must already
+share them to hear each other, the agreement records them and a peer with
+different settings is refused. So is a malformed offer, and an offer whose
+len exceeds what the receiver can reassemble: that one is answered with a
+refusal (err, max) so the sender fails instead of sending it anyway.
+"""
+
+import ujson
+
+from ctpcodec import CTRL_PREFIX, CTRL_SESSION
+
+PREFIX  = CTRL_PREFIX + bytes([CTRL_SESSION])
+VERSION = 1
+HEADERS = [1, 2]
+ACK_MODES = ['frame', 'none']
+CODECS = ['none']
+
+
+def offer(sf, bw, dedup, length=0, transfer_id=0):
+    # Session message proposing our parameters
+    params = {'v': VERSION, 'hdr': HEADERS, 'win': 1, 'ack': ACK_MODES, 'comp': CODECS,
+              'fec': 0, 'sf': sf, 'bw': bw, 'dedup': dedup, 'batch': True, 'len': length, 'id': transfer_id}
+    return PREFIX + ujson.dumps(params).encode('utf-8')
+
+
+def is_session(data):
+    return data[:len(PREFIX)] == PREFIX
+
+
+def parse(data):
+    try:
+        params = ujson.loads(data[len(PREFIX):])
+    except ValueError:
+        return None
+    return params if isinstance(params, dict) else None
+
+
+def _first_common(offered, supported):
+    for item in offered:
+        if item in supported:
+            return item
+    return None
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _valid(params):
+    # Types of the offered parameters, as offer() writes them
+    for key in ('v', 'win', 'len', 'id'):
+        if not _is_int(params.get(key, 0)) or params.get(key, 0) < 0:
+            return False
+    for key in ('hdr', 'ack', 'comp'):
+        if not isinstance(params.get(key, []), list):
+            return False
+    return True
+
+
+def too_long(params, max_len):
+    # Offer announcing a transfer longer than max_len
+    return _is_int(params.get('len', 0)) and params.get('len', 0) > max_len
+
+
+def agree(params, sf, bw, dedup, max_len):
+    # Parameters agreed with an offer, None if we can't talk to that peer or the offer is
+    # malformed or announces more than max_len bytes (see too_long)
+    if params.get('sf') != sf or params.get('bw') != bw:
+        return None
+    if not _valid(params) or params.get('len', 0) > max_len:
+        return None
+    common = [h for h in params.get('hdr', [1]) if h in HEADERS]
+    agreed = {
+        'v': min(params.get('v', VERSION), VERSION),
+        'hdr': max(common) if common else 1,
+        'win': max(1, min(params.get('win', 1), 1)),
+        'ack': _first_common(params.get('ack', ACK_MODES), ACK_MODES) or 'frame',
+        'comp': _first_common(params.get('comp', CODECS), CODECS) or 'none',
+        'fec': 0,
+        'sf': sf,
+        'bw': bw,
+        'dedup': bool(params.get('dedup')) and dedup,
+        'batch': params.get('batch') is True,
+        'len': params.get('len', 0),
+        'id': params.get('id', 0)
+    }
+    return agreed
+
+
+def encode_agreed(agreed):
+    return ujson.dumps(agreed).encode('utf-8')
+
+
+def refusal(max_len):
+    # Answer to an offer too long for the receiver
+    return ujson.dumps({'err': 'len', 'max': max_len}).encode('utf-8')
+
+
+def is_refusal(agreed):
+    return 'err' in agreed
+
+
+def decode_agreed(reply):
+    try:
+        agreed = ujson.loads(reply)
+    except ValueError:
+        return None
+    return agreed if isinstance(agreed, dict) else None
+
+
+# Agreement used for peers that acknowledge the offer without answering it (older firmware)
+LEGACY = {'v': 0, 'hdr': 1, 'win': 1, 'ack': 'frame', 'comp': 'none', 'fec': 0, 'dedup': False, 'batch': False}
+
+
+class Sessions:
+    # Agreed parameters per peer
+
+    def __init__(self):
+        self.peers = {}
+
+    def get(self, peer):
+        return self.peers.get(peer)
+
+    def put(self, peer, agreed):
+        self.peers[peer] = agreed
+
+    def drop(self, peer):
+        self.peers.pop(peer, None)
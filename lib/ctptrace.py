@@ -0,0 +1,146 @@
+"""
+LoRa CTP trace buffer
+
+Records compact binary protocol events into a preallocated ring buffer so the
+LoRaCTP hot path does not pay for string formatting and UART output. When the
+trace is disabled the endpoint keeps `trace = None` and every probe reduces to
+a single truth test.
+
+Each record is 12 bytes (little endian):
+    1 byte:  event id
+    1 byte:  seq/ack bits (bit 0 seqnum, bit 1 acknum)
+    2 bytes: fragment counter
+    2 bytes: size in bytes (payload or frame)
+    2 bytes: event argument (attempt, rtt in ms, ...)
+    4 bytes: timestamp in microseconds (ticks_us, wraps)
+
+A dump is a 8 byte header (magic, version, record size, record count) followed
+by the records from oldest to newest. `decode` parses a dump on any Python, so
+traces fetched from GET /trace can be inspected offline.
+"""
+
+import struct
+import time
+
+try:
+    from time import ticks_us
+except ImportError:
+    # CPython: offline tools and replay harnesses
+    def ticks_us():
+        return int(time.perf_counter() * 1000000) & 0xFFFFFFFF
+
+RECORD_FORMAT = "<BBHHHI"
+RECORD_SIZE   = 12
+DUMP_FORMAT   = "<4sBBH"
+DUMP_SIZE     = 8
+DUMP_MAGIC    = b'CTPT'
+DUMP_VERSION  = 1
+
+# Event identifiers
+EV_SEND_START   = 1     # frag: total fragments, size: payload length
+EV_SEND_END     = 2     # frag: fragments sent, arg: retransmissions, size: 1 if failed
+EV_TX_DATA      = 3     # frag: fragment index, size: frame length, arg: attempt
+EV_RX_ACK       = 4     # size: frame length, arg: rtt in ms
+EV_ACK_INVALID  = 5     # size: frame length
+EV_TIMEOUT      = 6     # arg: attempt
+EV_RTO          = 7     # arg: new timeout in ms
+EV_RECV_START   = 8
+EV_RECV_END     = 9     # frag: fragments accepted, size: bytes received (saturated)
+EV_RX_DATA      = 10    # frag: fragment index, size: frame length
+EV_TX_ACK       = 11    # frag: fragment index, size: frame length
+EV_DUPLICATE    = 12    # frag: fragment index, ACK lost: re-sending ACK
+EV_BAD_FRAME    = 13    # frame that could not be parsed or failed the checksum
+EV_NOT_FOR_ME   = 14
+EV_HELLO        = 15    # size: neighbour list length
+EV_BACKOFF      = 16    # frag: fragment index, size: busy senses, arg: backoff in ms
+EV_RECV_ABORT   = 17    # frag: fragments received, size: bytes dropped (saturated)
+EV_SESSION      = 18    # frag: 0 if the peer runs an older firmware, arg: 1 dedup + 2 batch
+EV_REFUSED      = 19    # size: transfer length in KB, arg: receiver maximum in KB
+EV_SEGMENT_FAIL = 20    # frag: segment index, size: segment count
+EV_DEDUP        = 21    # size: bytes sent (saturated), arg: payload length in KB
+
+EVENT_NAMES = {
+    EV_SEND_START:  'send_start',
+    EV_SEND_END:    'send_end',
+    EV_TX_DATA:     'tx_data',
+    EV_RX_ACK:      'rx_ack',
+    EV_ACK_INVALID: 'ack_invalid',
+    EV_TIMEOUT:     'timeout',
+    EV_RTO:         'rto',
+    EV_RECV_START:  'recv_start',
+    EV_RECV_END:    'recv_end',
+    EV_RX_DATA:     'rx_data',
+    EV_TX_ACK:      'tx_ack',
+    EV_DUPLICATE:   'duplicate',
+    EV_BAD_FRAME:   'bad_frame',
+    EV_NOT_FOR_ME:  'not_for_me',
+    EV_HELLO:       'hello',
+    EV_BACKOFF:     'backoff',
+    EV_RECV_ABORT:  'recv_abort',
+    EV_SESSION:     'session',
+    EV_REFUSED:     'refused',
+    EV_SEGMENT_FAIL: 'segment_fail',
+    EV_DEDUP:       'dedup',
+}
+
+
+class Trace:
+
+    def __init__(self, size=256):
+        # size: number of records kept, older ones are overwritten
+        self.size = size
+        self.buf  = bytearray(size * RECORD_SIZE)
+        self.head = 0       # next slot to write
+        self.count = 0
+        self.enabled = True
+
+    def event(self, ev, seq=0, frag=0, length=0, arg=0):
+        if not self.enabled:
+            return
+        head = self.head
+        struct.pack_into(RECORD_FORMAT, self.buf, head * RECORD_SIZE,
+                         ev, seq, frag & 0xFFFF, length & 0xFFFF, arg & 0xFFFF, ticks_us())
+        head += 1
+        self.head = 0 if head == self.size else head
+        if self.count < self.size:
+            self.count += 1
+
+    def clear(self):
+        self.head  = 0
+        self.count = 0
+
+    def dump(self):
+        # Returns the trace as bytes, oldest record first
+        out = bytearray(DUMP_SIZE + self.count * RECORD_SIZE)
+        struct.pack_into(DUMP_FORMAT, out, 0, DUMP_MAGIC, DUMP_VERSION, RECORD_SIZE, self.count)
+        start = (self.head - self.count) % self.size
+        first = min(self.count, self.size - start)
+        out[DUMP_SIZE:DUMP_SIZE + first * RECORD_SIZE] = self.buf[start * RECORD_SIZE:(start + first) * RECORD_SIZE]
+        if first < self.count:
+            rest = (self.count - first) * RECORD_SIZE
+            out[DUMP_SIZE + first * RECORD_SIZE:] = self.buf[:rest]
+        return bytes(out)
+
+
+def decode(data):
+    # Parse a dump produced by Trace.dump() into a list of tuples:
+    # (name, seqnum, acknum, frag, length, arg, t_us)
+    magic, version, rsize, count = struct.unpack_from(DUMP_FORMAT, data, 0)
+    if magic != DUMP_MAGIC or version != DUMP_VERSION or rsize != RECORD_SIZE:
+        raise ValueError("Not a CTP trace dump")
+    events = []
+    for i in range(count):
+        ev, seq, frag, length, arg, t_us = struct.unpack_from(RECORD_FORMAT, data, DUMP_SIZE + i * RECORD_SIZE)
+        events.append((EVENT_NAMES.get(ev, 'ev{}'.format(ev)), seq & 1, (seq >> 1) & 1, frag, length, arg, t_us))
+    return events
+
+
+def format_events(events):
+    # Human readable listing, timestamps relative to the first record
+    lines = []
+    t0 = events[0][6] if events else 0
+    for name, seqnum, acknum, frag, length, arg, t_us in events:
+        dt = ((t_us - t0) & 0xFFFFFFFF) / 1000.0
+        lines.append("{:>12.3f} ms  {:<12} seq={} ack={} frag={:<5} len={:<5} arg={}".format(
+            dt, name, seqnum, acknum, frag, length, arg))
+    return "\n".join(lines)
@@ -1,13 +1,137 @@
+"""
+Messages database
+
+Append-only log: every message is one JSON line appended to the log, kept
+in segment files /flash/messages.log.<n> of about SEGMENT_BYTES each (or
+pointing to 1/SEGMENT_SHARE of retain_bytes of payloads). Files
+are never rewritten: a full segment is followed by a new one, and expired
+segments are removed whole. A line cut short by a reset has no newline: it
+is skipped when reading, and closed at startup so the next message starts on
+its own line.
+
+A /flash/database.json left by older firmware (one JSON array), or its
+single /flash/messages.log, becomes the first segment on first boot.
+
+Payloads are not in the log: they are written once to the blob store
+(lib/blobstore.py) and the message row carries the blob key, size and
+content type. Rows of older firmware keep their inline 'message'.
+
+The log is indexed in RAM: id, offset and blob key prefix of every record
+(its length is the distance to the next one), next id and count. Offsets
+run across the segments as if they were one file. The index is built by one
+streaming scan at startup and kept up to date by the writes, so saving,
+counting and fetching a message never parse the history.
+
+Writes are group committed: save_message only appends the record to a tail
+buffer in RAM (and its payload to the pending blobs), so the LoRa receive
+thread never waits on flash. The tail is written in one append, after its
+blobs, by the writer thread (run) once it holds commit_messages records or
+its oldest record is commit_ms old, or at once when the tail and its pending
+payloads pass TAIL_MAX_BYTES: at most that window of messages is lost
+on a reset. Records in the tail are served from RAM until then. close()
+flushes on shutdown; commit_ms=0 writes every message through.
+
+Retention: the oldest segment expires while the log holds more than
+retain_messages messages or retain_bytes bytes (records and payloads), or
+once its newest message is older than retain_age_s. Ages are counted on the
+clock of the database, kept in each record: it only moves with time() while
+the node runs, so a reboot (loractp resets the RTC) continues from the last
+record and a jump of the RTC is ignored. Downtime is not counted: messages are
+kept longer, never dropped early. Records of older firmware are at clock 0.
+The writer thread
+compacts in small steps between commits: an expired segment leaves the
+index at once, then its blobs no other message points to are removed,
+STEP_RECORDS records per step, then its file. Retention drops whole
+segments, never the one being written.
+"""
+
+import array
+import os
+
+import _thread
 import ujson
-from machine    import RTC
+import blobstore
+from ctpmetrics import ticks_ms, ticks_diff
 from time       import time
+
+COMMIT_MESSAGES = 8         # records per group commit
+COMMIT_MS       = 2000      # durability window: a record is on flash at most this late
+TAIL_MAX_BYTES  = 16384     # tail and pending payloads: beyond this, the writer thread commits at once
+
+SEGMENT_BYTES   = 16384     # a new segment file starts past this size of records,
+SEGMENT_SHARE   = 8         # or past 1/SEGMENT_SHARE of retain_bytes of payloads or retain_messages
+RETAIN_MESSAGES = 2000
+RETAIN_BYTES    = 512 * 1024
+RETAIN_AGE_S    = 0         # 0: no age limit
+STEP_RECORDS    = 16        # records of an expired segment handled per compaction step
+CLOCK_STEP_S    = 60        # a larger move of time() between two ticks is a clock set, not time passing
+
+
+def key_prefix(key):
+    # 28 bits of a blob key (a small int), 0 for none
+    return int(key[:7], 16) if key else 0
+
+
+class Segment:
+    # A log file: its number, the log offset of its first byte and totals of its records
+
+    def __init__(self, number, base):
+        self.number = number
+        self.base = base
+        self.count = 0
+        self.payload_bytes = 0
+        self.last_clock = 0     # database clock of its newest record
+
+
+class Reader:
+    # Reads records from the segment files, the last one used stays open
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.number = None
+        self.f = None
+
+    def read(self, segment, offset, length):
+        if segment.number != self.number:
+            self.close()
+            self.f = open(self.handler.segment_path(segment.number), 'rb')
+            self.number = segment.number
+        self.f.seek(offset - segment.base)
+        return self.f.read(length)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            self.number = None
+
+
 class FileHandler:
-    def __init__(self):
-        self.file_path = '/flash/database.json'
+    def __init__(self, file_path='/flash/messages.log', legacy_path='/flash/database.json', blob_path='/flash/blobs',
+                 commit_messages=COMMIT_MESSAGES, commit_ms=COMMIT_MS,
+                 retain_messages=RETAIN_MESSAGES, retain_bytes=RETAIN_BYTES, retain_age_s=RETAIN_AGE_S):
+        self.file_path = file_path
+        self.legacy_path = legacy_path
         self.file = None
+        self.blobs = blobstore.BlobStore(blob_path)
+        self.commit_messages = commit_messages
+        self.commit_ms = commit_ms
+        self.retain_messages = retain_messages
+        self.retain_bytes = retain_bytes
+        self.retain_age_s = retain_age_s
+        self.lock = _thread.allocate_lock()         # index and tail
+        self.flush_lock = _thread.allocate_lock()   # log and blob file writes
+        self.wake = _thread.allocate_lock()         # released to wake the writer thread
+        self.wake.acquire()
+        self.commits = 0
+        self.dropped_segments = 0
+        self.removed_blobs = 0
+        self.migrate()
+        self.repair()
+        self.build_index()
 
-    def open_file(self, mode):
-        self.file = open(self.file_path, mode)
+    def open_file(self, mode, path=None):
+        self.file = open(self.file_path if path is None else path, mode)
 
     def close_file(self):
         self.file.close()
@@ -18,44 +142,533 @@ class FileHandler:
     def read_from_file(self):
         return self.file.read()
 
+    def segment_path(self, number):
+        return '{}.{}'.format(self.file_path, number)
+
+    def __segment_numbers(self):
+        # Numbers of the segment files on flash, oldest first
+        directory, _, name = self.file_path.rpartition('/')
+        prefix = name + '.'
+        numbers = []
+        for entry in os.listdir(directory or '.'):
+            suffix = entry[len(prefix):]
+            if entry.startswith(prefix) and suffix.isdigit():
+                numbers.append(int(suffix))
+        numbers.sort()
+        return numbers
+
+    def __append(self, segment, id, offset, entry):
+        # Adds a record to the index
+        size = entry.get('size', 0) if 'blob' in entry else 0
+        self.ids.append(id)
+        self.offsets.append(offset)
+        self.keys.append(key_prefix(entry.get('blob')))
+        segment.count += 1
+        segment.payload_bytes += size
+        segment.last_clock = entry.get('clock', 0)
+        self.payload_bytes += size
+        self.next_id = id + 1
+
+    def build_index(self):
+        # Streaming scan of the segments: one line in memory at a time
+        self.ids = array.array('L')
+        self.offsets = array.array('L')
+        self.keys = array.array('L')    # blob key prefix of each record
+        self.segments = []
+        self.next_id = 1
+        self.payload_bytes = 0
+        self.tail = bytearray()
+        self.tail_count = 0
+        self.tail_since = None      # ticks_ms of the oldest record in the tail
+        self.pending_blobs = {}     # key -> payload, not written yet
+        self.pending_bytes = 0      # size of the pending payloads
+        self.compaction = None      # [segment number, file offset] of the expired segment being removed
+        numbers = self.__segment_numbers()
+        if not numbers:
+            self.create_database()
+            numbers = [1]
+        offset = 0
+        for number in numbers:
+            segment = Segment(number, offset)
+            self.segments.append(segment)
+            with open(self.segment_path(number), 'rb') as f:
+                for line in f:
+                    if line.endswith(b'\n'):
+                        try:
+                            entry = ujson.loads(line)
+                            id = entry['id']
+                        except (ValueError, KeyError, TypeError):
+                            id = None
+                        if isinstance(id, int) and id >= self.next_id:
+                            self.__append(segment, id, offset, entry)
+                    offset += len(line)
+        self.end = self.durable = offset    # durable: log bytes on flash, the tail follows them
+        self.clock = max(segment.last_clock for segment in self.segments)
+        self.clock_wall = time()            # time() when the clock last moved
+
+    def __tick(self):
+        # Taken under the lock: the database clock, moved by the time() elapsed since the last tick
+        now = time()
+        step = now - self.clock_wall
+        self.clock_wall = now
+        if 0 <= step <= CLOCK_STEP_S:
+            self.clock += step
+        return int(self.clock)
+
     def database_exists(self):
-        try:
-            self.open_file('r')
-            self.close_file()
-            return True
-        except OSError:
-            return False
+        return len(self.segments) > 0
 
     def create_database(self):
-        self.open_file('w')
+        # An empty log: a single empty segment
+        for number in self.__segment_numbers():
+            os.remove(self.segment_path(number))
+        self.open_file('w', self.segment_path(1))
         self.close_file()
 
+    def migrate(self):
+        # Moves the database of older firmware to the first segment, once
+        numbers = self.__segment_numbers()
+        try:
+            os.stat(self.file_path)
+            if not numbers:
+                os.rename(self.file_path, self.segment_path(1))
+                numbers = [1]
+        except OSError:
+            pass
+        try:
+            with open(self.legacy_path, 'r') as f:
+                data = f.read()
+        except OSError:
+            return
+        if not numbers:
+            try:
+                messages = ujson.loads(data) if data else []
+            except ValueError:
+                messages = []
+            tmp_path = self.file_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                for entry in messages:
+                    f.write(ujson.dumps(entry) + '\n')
+            os.rename(tmp_path, self.segment_path(1))
+        os.remove(self.legacy_path)
+
+    def repair(self):
+        # Terminates the records cut short by a reset
+        for number in self.__segment_numbers():
+            path = self.segment_path(number)
+            with open(path, 'rb') as f:
+                f.seek(0, 2)
+                size = f.tell()
+                if size == 0:
+                    continue
+                f.seek(size - 1)
+                last = f.read(1)
+            if last != b'\n':
+                with open(path, 'a') as f:
+                    f.write('\n')
+
+    def __span(self, position):
+        # (offset, length) of the record at position in the index
+        offset = self.offsets[position]
+        end = self.offsets[position + 1] if position + 1 < len(self.offsets) else self.end
+        return offset, end - offset
+
+    def __bisect(self, id):
+        # First index position with an id >= id (ids grow)
+        low, high = 0, len(self.ids)
+        while low < high:
+            middle = (low + high) // 2
+            if self.ids[middle] < id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __position(self, id):
+        # Index position of the record with this id, None if there is none
+        position = self.__bisect(id)
+        return position if (position < len(self.ids)) and (self.ids[position] == id) else None
+
+    def __segment_at(self, offset):
+        for segment in reversed(self.segments):
+            if segment.base <= offset:
+                return segment
+
+    def __locate(self, position):
+        # Taken under the lock: the record at position, as is while in the tail,
+        # else (segment, offset, length) to read from flash once the lock is released
+        offset, length = self.__span(position)
+        if offset >= self.durable:
+            start = offset - self.durable
+            return bytes(self.tail[start:start + length])
+        return self.__segment_at(offset), offset, length
+
+    def __read(self, reader, place):
+        # JSON line of a record found by __locate, None if compaction removed its segment meanwhile
+        if isinstance(place, bytes):
+            return place
+        try:
+            line = reader.read(*place)
+        except OSError:
+            return None
+        # A torn line closed by repair() may follow a record: only the first line is the record
+        end = line.find(b'\n')
+        return line[:end + 1] if end >= 0 else None
+
+    def records(self):
+        # Yields the stored messages, oldest first, one at a time
+        for id, line in self.query(limit=None):
+            yield ujson.loads(line)
+
+    def query(self, since_id=0, sender=None, from_time=None, limit=50):
+        # Yields (id, JSON line) of up to limit messages (None: all) with an id above
+        # since_id, oldest first, from sender and not older than from_time when given.
+        # Each record is looked up by id in the index and read from flash without the
+        # lock, so neither compaction nor save_message wait for the reads; records
+        # are parsed only to be filtered
+        reader = Reader(self)
+        next_id = since_id + 1
+        try:
+            while (limit is None) or (limit > 0):
+                with self.lock:
+                    position = self.__bisect(next_id)
+                    if position >= len(self.ids):
+                        break
+                    id = self.ids[position]
+                    place = self.__locate(position)
+                next_id = id + 1
+                line = self.__read(reader, place)
+                if line is None:
+                    continue
+                if (sender is not None) or (from_time is not None):
+                    entry = ujson.loads(line)
+                    if (sender is not None) and (entry.get('sender') != sender):
+                        continue
+                    if (from_time is not None) and (entry.get('time', 0) < from_time):
+                        continue
+                if limit is not None:
+                    limit -= 1
+                yield id, line
+        finally:
+            reader.close()
+
+    def stream(self, since_id=0, sender=None, from_time=None, limit=50):
+        # The page of query() as a stream of JSON for the web server
+        return QueryStream(self, since_id, sender, from_time, limit)
+
     def get_messages(self):
-        if self.database_exists():
-            self.open_file('r')
-            data = self.read_from_file()
-            self.close_file()
-            return ujson.loads(data)
-        else:
-            self.create_database()
-            return []
+        return list(self.records())
 
-    def save_message(self, sender, message):
+    def get_message(self, id):
+        # Message with this id, None if there is none
+        with self.lock:
+            position = self.__position(id)
+            if position is None:
+                return None
+            place = self.__locate(position)
+        reader = Reader(self)
+        try:
+            line = self.__read(reader, place)
+        finally:
+            reader.close()
+        return ujson.loads(line) if line is not None else None
+
+    def get_payload(self, id):
+        # (blob file, content type) of the payload of message id,
+        # (None, text) for a row of older firmware, None if there is no such message
+        entry = self.get_message(id)
+        if entry is None:
+            return None
+        if 'blob' in entry:
+            if entry['blob'] in self.pending_blobs:
+                self.flush()
+            return self.blobs.file(entry['blob']), entry.get('type', blobstore.BINARY)
+        return None, entry.get('message')
+
+    def count_messages(self):
+        return len(self.ids)
+
+    def save_message(self, sender, message, segment=None):
         #timestamp = RTC().now()
         timestamp = time()
-        messages = self.get_messages()
-        id = len(messages) + 1
-        messages.append({
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        if isinstance(sender, bytes):
+            sender = sender.decode('utf-8')
+        key = blobstore.key_of(message)
+        self.lock.acquire()
+        id = self.next_id
+        entry = {
             'id': id,
             'sender': sender,
-            'message': message,
-            'time': timestamp
-        })
-        self.open_file('w')
-        self.write_to_file(ujson.dumps(messages))
-        self.close_file()
+            'time': timestamp,
+            'clock': self.__tick(),
+            'blob': key,
+            'size': len(message),
+            'type': blobstore.content_type(message)
+        }
+        if segment is not None:
+            # Priority segment (stream id, index, count) of a progressive transfer
+            entry['segment'] = {'stream': segment[0], 'index': segment[1], 'count': segment[2]}
+        try:
+            line = (ujson.dumps(entry) + '\n').encode('utf-8')
+            active = self.segments[-1]
+            if self.__full(active):
+                # The file of the new segment is created by the commit that reaches it
+                active = Segment(active.number + 1, self.end)
+                self.segments.append(active)
+            if key not in self.pending_blobs:
+                self.pending_blobs[key] = message
+                self.pending_bytes += len(message)
+            self.tail.extend(line)
+            if self.tail_since is None:
+                self.tail_since = ticks_ms()
+            self.tail_count += 1
+            self.__append(active, id, self.end, entry)
+            self.end += len(line)
+            overflow = self.__overflow()
+        finally:
+            self.lock.release()
+        if self.commit_ms == 0:
+            self.flush()
+        elif overflow:
+            self.__wake()
+        return entry
+
+    def __overflow(self):
+        # Taken under the lock: the tail and its payloads hold too much RAM
+        return len(self.tail) + self.pending_bytes > TAIL_MAX_BYTES
+
+    def __wake(self):
+        # The writer thread commits now instead of at its next poll
+        try:
+            self.wake.release()
+        except RuntimeError:
+            pass    # already woken
+
+    def __full(self, segment):
+        # Large payloads live in the blob store: a segment is also full once the
+        # payloads it points to are a share of retain_bytes, so that retention
+        # can drop them before the store passes the limit
+        return ((self.end - segment.base >= SEGMENT_BYTES) or
+                (segment.payload_bytes * SEGMENT_SHARE >= self.retain_bytes) or
+                (segment.count * SEGMENT_SHARE >= self.retain_messages))
+
+    def commit_due(self):
+        # The tail holds commit_messages records or too many bytes, or its oldest is commit_ms old
+        with self.lock:
+            return (self.tail_since is not None) and ((self.tail_count >= self.commit_messages) or
+                                                      self.__overflow() or
+                                                      (ticks_diff(ticks_ms(), self.tail_since) >= self.commit_ms))
+
+    def flush(self):
+        # Group commit: the pending blobs, then the tail appended to its segments
+        with self.flush_lock:
+            with self.lock:
+                if not self.tail:
+                    return
+                blobs = list(self.pending_blobs.items())
+                data = bytes(self.tail)
+                count = self.tail_count
+                start = self.durable
+                pieces = []
+                for i, segment in enumerate(self.segments):
+                    stop = self.segments[i + 1].base if i + 1 < len(self.segments) else start + len(data)
+                    low, high = max(segment.base, start), min(stop, start + len(data))
+                    if low < high:
+                        pieces.append((segment.number, low - start, high - start))
+            for key, payload in blobs:
+                self.blobs.write(key, payload)
+            for number, low, high in pieces:
+                self.open_file('ab', self.segment_path(number))
+                try:
+                    self.write_to_file(data[low:high])
+                finally:
+                    self.close_file()
+            with self.lock:
+                del self.tail[:len(data)]
+                self.durable += len(data)
+                self.tail_count -= count
+                self.tail_since = ticks_ms() if self.tail else None
+                for key, payload in blobs:
+                    if self.pending_blobs.pop(key, None) is not None:
+                        self.pending_bytes -= len(payload)
+                self.commits += 1
+
+    def __expired(self, clock):
+        # The oldest segment if the retention policy drops it, None otherwise
+        if len(self.segments) < 2:
+            return None
+        oldest = self.segments[0]
+        if self.segments[1].base > self.durable:
+            return None     # part of it is still in the tail
+        if (oldest.count == 0) or (len(self.ids) > self.retain_messages):
+            return oldest
+        if self.end - oldest.base + self.payload_bytes > self.retain_bytes:
+            return oldest
+        if self.retain_age_s and (clock - oldest.last_clock > self.retain_age_s):
+            return oldest
+        return None
+
+    def __drop(self, segment):
+        # Removes the oldest segment from the index
+        count = segment.count
+        self.ids = self.ids[count:]
+        self.offsets = self.offsets[count:]
+        self.keys = self.keys[count:]
+        self.payload_bytes -= segment.payload_bytes
+        self.segments.pop(0)
+
+    def __referenced(self, key):
+        # A message still points to the blob. Compared by key prefix: a collision
+        # keeps a blob that could go, never removes one in use
+        if key in self.pending_blobs:
+            return True
+        prefix = key_prefix(key)
+        for live in self.keys:
+            if live == prefix:
+                return True
+        return False
+
+    def compact_step(self):
+        # One small step of retention, returns True while there is work left.
+        # Blobs are only written by flush(), which waits for the step: a blob
+        # found unreferenced here cannot be reused before it is removed
+        with self.flush_lock:
+            if self.compaction is None:
+                with self.lock:
+                    segment = self.__expired(self.__tick())
+                    if segment is None:
+                        return False
+                    self.__drop(segment)
+                self.compaction = [segment.number, 0]
+                return True
+
+            number, offset = self.compaction
+            path = self.segment_path(number)
+            keys = []
+            done = False
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    for i in range(STEP_RECORDS):
+                        line = f.readline()
+                        if not line:
+                            done = True
+                            break
+                        offset += len(line)
+                        try:
+                            key = ujson.loads(line).get('blob')
+                        except (ValueError, AttributeError):
+                            key = None
+                        if key:
+                            keys.append(key)
+            except OSError:
+                done = True
+            for key in keys:
+                with self.lock:
+                    referenced = self.__referenced(key)
+                if not referenced:
+                    self.blobs.remove(key)
+                    self.removed_blobs += 1
+            if done:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                self.compaction = None
+                self.dropped_segments += 1
+            else:
+                self.compaction[1] = offset
+            return True
+
+    def run(self, interval=0.1):
+        # Thread method: group commits the tail when due, compacts a step at a time
+        while True:
+            try:
+                if self.commit_due():
+                    self.flush()
+                self.compact_step()
+            except Exception as ex:
+                print("Database exception: {}".format(ex))
+            self.wake.acquire(1, interval)     # interval, or until save_message overflows
+
+    def close(self):
+        # Shutdown: nothing stays in RAM
+        self.flush()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'messages': len(self.ids),
+                'log_bytes': self.end - self.segments[0].base,
+                'payload_bytes': self.payload_bytes,
+                'segments': len(self.segments),
+                'buffered_messages': self.tail_count,
+                'buffered_bytes': len(self.tail),
+                'buffered_payload_bytes': self.pending_bytes,
+                'commits': self.commits,
+                'commit_messages': self.commit_messages,
+                'commit_ms': self.commit_ms,
+                'retain_messages': self.retain_messages,
+                'retain_bytes': self.retain_bytes,
+                'retain_age_s': self.retain_age_s,
+                'clock': int(self.clock),
+                'dropped_segments': self.dropped_segments,
+                'removed_blobs': self.removed_blobs,
+                'compacting': self.compaction is not None
+            }
 
     def delete_messages(self):
-        self.open_file('w')
-        self.write_to_file(ujson.dumps([]))
-        self.close_file()
\ No newline at end of file
+        with self.flush_lock:
+            with self.lock:
+                self.create_database()
+                self.build_index()
+                self.blobs.clear()
+
+
+class QueryStream:
+    # JSON page of a query, read by the web server in chunks (Response.ReturnStream):
+    #   {"messages": [<message>, ...], "next_cursor": <last id> or null}
+    # next_cursor is set when the page is full, more messages may follow it
+
+    def __init__(self, handler, since_id=0, sender=None, from_time=None, limit=50):
+        self.limit = limit
+        self.rows = handler.query(since_id, sender, from_time, limit)
+        self.pending = b'{"messages":['
+        self.count = 0
+        self.last_id = None
+
+    def __next_chunk(self):
+        if self.rows is None:
+            return b''
+        try:
+            id, line = next(self.rows)
+        except StopIteration:
+            self.rows = None
+            cursor = self.last_id if self.count == self.limit else None
+            return b'],"next_cursor":' + ujson.dumps(cursor).encode('utf-8') + b'}'
+        chunk = line[:-1] if self.count == 0 else b',' + line[:-1]
+        self.count += 1
+        self.last_id = id
+        return chunk
+
+    def readinto(self, buf):
+        # Fills buf, short only at the end of the page
+        n = 0
+        size = len(buf)
+        while n < size:
+            if not self.pending:
+                self.pending = self.__next_chunk()
+                if not self.pending:
+                    break
+            k = min(size - n, len(self.pending))
+            buf[n:n + k] = self.pending[:k]
+            self.pending = self.pending[k:]
+            n += k
+        return n
+
+    def close(self):
+        if self.rows is not None:
+            self.rows.close()
+            self.rows = None
@@ -15,7 +15,6 @@ from network import LoRa
 from machine import RTC
 import binascii
 import gc
-import hashlib
 import machine
 import socket
 import struct
@@ -24,39 +23,95 @@ import time
 import network
 import ujson
 import _thread
+import ctpaggregate
+import ctpalias
+import ctpcapture
+import ctpcodec
+import ctpcongestion
+import ctpcsma
+import ctpdeadline
+import ctpdedup
+import ctpmetrics
+import ctpneighbors
+import ctpoutbox
+import ctpradio
+import ctpsession
+import ctptrace
 
 __version__ = '0'
 
 
 class CTPendpoint:
 
+    SF           = 7
+    BW_KHZ       = 250
     MAX_PKT_SIZE = 230  # Maximum pkt size in LoRa with Spread Factor 7
-    HEADER_SIZE  = 20
+    HEADER_SIZE  = ctpcodec.HEADER_SIZE
     PAYLOAD_SIZE = MAX_PKT_SIZE - HEADER_SIZE
-    # header structure:
+    SHORT_HEADER_SIZE  = ctpcodec.SHORT_HEADER_SIZE
+    SHORT_PAYLOAD_SIZE = MAX_PKT_SIZE - SHORT_HEADER_SIZE
+    # header structure (see ctpcodec):
     # 8 bytes: source addr (last 8 bytes)
     # 8 bytes: dest addr (last 8 bytes)
     # 1 byte: flags
     # 3 bytes: checksum
-    HEADER_FORMAT  = "!8s8sB3s"
+    HEADER_FORMAT  = ctpcodec.HEADER_FORMAT
     PAYLOAD_FORMAT = "!202s"
 
+    # Status of a failed transfer (FAILED)
+    FAILED_RETRIES   = -1   # no ACK after 3 tries
+    FAILED_TIMEOUT   = -2   # call deadline expired
+    FAILED_CANCELLED = -3
+    FAILED_REFUSED   = -4   # the receiver can't take a transfer that long
+
     ITS_DATA_PACKET = False
     ITS_ACK_PACKET  = True
     ANY_ADDR = b'\x00\x00\x00\x00\x00\x00\x00\x00'
     ONE  = 1
     ZERO = 0
 
+    # Priority segment: SEGMENT_PREFIX, stream id, segment index, segment count, data
+    SEGMENT_PREFIX = ctpcodec.CTRL_PREFIX + bytes([ctpcodec.CTRL_SEGMENT])
+    SEGMENT_FORMAT = "!HBB"
+    SEGMENT_HEADER = len(SEGMENT_PREFIX) + 4
+    MAX_SEGMENTS   = 255
+
+    # Transfer priorities (sendit priority=): a transfer to another peer with a
+    # higher priority goes out between the fragments of the running one
+    PRIORITY_BULK   = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_URGENT = 2
+
+    AGGREGATE_MAX_SIZE = 64     # messages up to this size can be coalesced (sendit aggregate=True)
+
+    RTO_TURNAROUND_MS  = 200    # receiver processing and radio turnaround, on top of the airtimes
+    RTT_DEV_MIN_MS     = 25     # floor of the RTT deviation: 4 x this is the minimum margin over the RTT
+    RECV_POLL          = 1      # s, receive timeout between deadline checks
+    PREEMPT_POLL       = 0.1    # s, between deadline checks of a caller waiting for its preempting transfer
+    INACTIVITY_TIMEOUT = 30     # s, a partial transfer is dropped after this silence of its sender
+    DROP_SILENCE       = 5      # s, the rest of a transfer too long for us is ignored until its sender stops
+
+    CAPTURE_PATH     = '/flash/capture.bin'
+    CAPTURE_MAX_BYTES = 65536   # the capture log is rotated beyond this size
+
+    RX_RING_SLOTS    = 16       # data frames buffered by the radio callback
+    ACK_RING_SLOTS   = 4        # ACK frames buffered by the radio callback
+    RX_BUFFER_SIZE   = 4096     # initial size of the reassembly buffer
+    MAX_TRANSFER_SIZE = 262144  # longest transfer reassembled (max_transfer=), longer ones are refused
+    GC_LOW_WATERMARK = 32768    # collect between transfers below this free heap
+
     # List of discovered nodes
     DISCOVERED_NODES = {}
 
-    def __init__(self, debug_send=False, debug_recv=False, debug_hard=False):
+    def __init__(self, debug_send=False, debug_recv=False, debug_hard=False, trace_size=0,
+                 chunk_cache='/flash/chunks', chunk_cache_size=128, csma=True, outbox='/flash/outbox',
+                 linger_ms=0, irq_rx=True, max_transfer=MAX_TRANSFER_SIZE):
 
         # Configure LoRa
         self.lora = LoRa(mode = LoRa.LORA,
                          coding_rate  = LoRa.CODING_4_5,
                          tx_power = 14,
-                         sf = 7,
+                         sf = self.SF,
                          bandwidth = LoRa.BW_250KHZ,
                          power_mode = LoRa.ALWAYS_ON)
 
@@ -75,77 +130,165 @@ class CTPendpoint:
         self.debug_mode_recv = debug_recv
         self.hard_debug_mode = debug_hard
 
+        # Short node IDs learnt from hello messages
+        self.aliases = ctpalias.AliasTable(self.my_addr, self.ANY_ADDR)
+
+        # Precomputed ACK frames sent by the receiver
+        self.acks = ctpcodec.AckCache(self.my_addr, self.aliases.my_alias)
+
+        # Cumulative per-peer transfer metrics
+        self.metrics = ctpmetrics.Metrics()
+
+        # Preallocated frame buffers of the protocol engine: sender frame and ACK,
+        # receiver frame, and the reassembly buffer (grows to the largest transfer)
+        self.tx_frame = bytearray(self.MAX_PKT_SIZE)
+        self.tx_view  = memoryview(self.tx_frame)
+        self.tx_ack   = bytearray(self.MAX_PKT_SIZE)
+        self.tx_headers = None
+        self.rx_frame = bytearray(self.MAX_PKT_SIZE)
+        self.rx_view  = memoryview(self.rx_frame)
+        self.rx_data  = bytearray(self.RX_BUFFER_SIZE)
+        self.max_transfer = max_transfer
+
+        # Binary event trace of the protocol engine, None when disabled
+        self.trace = ctptrace.Trace(trace_size) if trace_size > 0 else None
+
+        # Smallest retransmission timeout: a full frame out, an ACK back and the turnaround
+        frame_ms = ctpcongestion.airtime_ms(self.MAX_PKT_SIZE, self.SF, self.BW_KHZ)
+        ack_ms = ctpcongestion.airtime_ms(self.HEADER_SIZE, self.SF, self.BW_KHZ)
+        self.min_rto_ms = frame_ms + ack_ms + self.RTO_TURNAROUND_MS
+
+        # Per-peer AIMD rate controllers pacing the sender, rates derived from the airtimes
+        self.congestion = ctpcongestion.Registry(frame_ms, ack_ms)
+
+        # Listen before talk for data and hello frames, None when disabled
+        self.csma = ctpcsma.Csma(self.lora) if csma else None
+
+        # Chunk cache answering deduplicated transfers, None when disabled
+        if chunk_cache is None:
+            self.dedup = None
+        else:
+            self.dedup = ctpdedup.Deduplicator(ctpdedup.ChunkCache(chunk_cache, chunk_cache_size))
+
+        # Store and forward queue of undelivered messages, None when disabled
+        self.outbox = ctpoutbox.Outbox(outbox) if outbox is not None else None
+
+        # Small messages to the same peer coalesced while a transfer to it runs, and
+        # the messages of a received batch not yet handed to the application
+        self.aggregator = ctpaggregate.Aggregator(self.__send_batch, self.PAYLOAD_SIZE, linger_ms)
+        self.rx_pending = []
+
+        # Nodes heard lately, from any frame, and hello suppression
+        self.neighbors = ctpneighbors.Neighbors()
+
+        # Transfer parameters agreed with each peer (session handshake)
+        self.sessions = ctpsession.Sessions()
+
+        # Reply carried by the ACK of the last fragment sent (see __control_reply)
+        self.ack_reply = None
+
+        # Senders (hello thread, web server) share the tx buffers. The running
+        # transfer (addr, priority) serves the preempting ones queued meanwhile,
+        # with the spare tx buffers (see __serve_preempt)
+        self.send_lock = _thread.allocate_lock()
+        self.preempt_lock = _thread.allocate_lock()
+        self.tx_active = None
+        self.preempt = []
+        self.preempting = False
+        self.tx_spare = None
+
+        # Radio callback copying received frames into the ACK and data rings
+        # (see ctpradio), None when the engine reads the sockets directly
+        self.radio = None
+        if irq_rx: self.__start_irq_rx()
+
+        # Frame capture to flash (see start_capture), None when not capturing
+        self.capture = None
+
     #
     # BEGIN: Utility functions
     #
-
-    # Create a packet from the necessary parameters
-    def __make_packet(self, s_addr, d_addr, hello, seqnum, ack_required, acknum, pkt_type, is_last, content):
-        # s_addr: bytes, d_addr: bytes, hello: boolean, seqnum: int, ack_required: boolean, acknum: int, pkt_type: boolean, is_last: boolean, content: bytes
-        if self.hard_debug_mode: print("DEBUG 080:", s_addr, d_addr, hello, seqnum, ack_required, acknum, pkt_type, is_last, content)
-        flags = 0
-        if seqnum == self.ONE:
-            flags = flags | (1<<0)
-        if acknum == self.ONE:
-            flags = flags | (1<<2)
-        if is_last:
-            flags = flags | (1<<4)
-        if hello:
-            flags = flags | (1<<5)
-        if pkt_type == self.ITS_ACK_PACKET:
-            flags = flags | (1<<6)
-        if ack_required:
-            flags = flags | (1<<7)
-
-        if self.debug_mode_send: print ("DEBUG 081: Flags: ", flags)
-
-        if (len(content)>0 and (pkt_type == self.ITS_DATA_PACKET)):
-            # p = struct.pack(self.PAYLOAD_FORMAT, content)
-            p = content
-            check = self.__get_checksum(p)
-            h = struct.pack(self.HEADER_FORMAT, s_addr, d_addr, flags, check)
-            if self.hard_debug_mode: print("DEBUG 096:", h+p)
-        else:
-            p = b''
-            h = struct.pack(self.HEADER_FORMAT, s_addr, d_addr, flags, b'')
-            if self.hard_debug_mode: print("DEBUG 100:", h+p)
-
-        return h + p
-
-    # Break a packet into its component parts
-    def __unpack(self, packet):
-        header  = packet[:self.HEADER_SIZE]
-        content = packet[self.HEADER_SIZE:]
-
-        sp, dp, flags, check = struct.unpack(self.HEADER_FORMAT, header)
-        seqnum   = self.ONE if ((flags) & 1) & 1 else self.ZERO
-        acknum   = self.ONE if (flags >> 2)  & 1 else self.ZERO
-        is_last  = (flags >> 4) & 1 == 1
-        hello   = (flags >> 5) & 1 == 1
-        pkt_type = (flags >> 6) & 1 == 1
-        ack_required = (flags >> 7) & 1 == 1
-
-        if (content == b''):
-            payload = b''
-        else:
-            payload = content
-
-        return sp, dp, hello, seqnum, ack_required, acknum, pkt_type, is_last, check, payload
-
-    def __get_checksum(self, data):
-        # data: byte -> byte:
-        if self.hard_debug_mode: print("DEBUG 123: in get_checksum->", data)
-        h = hashlib.sha256(data)
-        ha = binascii.hexlify(h.digest())
-        if self.hard_debug_mode: print("DEBUG 126: in get_checksum->", ha[-3:])
-        return (ha[-3:])
-
-    def __debug_printpacket(self, msg, packet, cont=False):
-        sp, dp, hello, seqnum, ack_required, acknum, pkt_type, is_last, check, content = self.__unpack(packet)
-        if cont:
-            print ("DEBUG {}: s_a: {}, d_a: {}, hello {}, seqn: {}, ack_required: {}, ackn: {}, is-ack: {}, fin: {}, check: {}, cont: {}".format(msg, sp, dp, hello, seqnum, ack_required, acknum, pkt_type, is_last, check, content))
-        else:
-            print ("DEBUG {}: s_a: {}, d_a: {}, hello {}, seqn: {}, ack_required: {}, ackn: {}, is_ack: {}, fin: {}, check: {}".format(msg, sp, dp, hello, seqnum, ack_required, acknum, pkt_type, is_last, check))
+    def __start_irq_rx(self):
+        # The raw recv socket is drained by the callback only (non blocking);
+        # the engine reads the rings and sends on the raw sockets
+        raw_send, raw_recv = self.send, self.recv
+        raw_recv.setblocking(False)
+        self.ack_ring = ctpradio.FrameRing(self.ACK_RING_SLOTS, self.MAX_PKT_SIZE)
+        self.rx_ring = ctpradio.FrameRing(self.RX_RING_SLOTS, self.MAX_PKT_SIZE)
+        self.radio = ctpradio.RxDispatcher(self.lora, raw_recv, self.ack_ring, self.rx_ring, LoRa.RX_PACKET_EVENT)
+        self.send = ctpradio.RingSocket(self.ack_ring, raw_send)
+        self.recv = ctpradio.RingSocket(self.rx_ring, raw_recv)
+        self.lora.callback(trigger=LoRa.RX_PACKET_EVENT, handler=self.radio)
+
+
+    # Receive a frame into buf, for sockets without readinto
+    def __recv_into(self, the_sock, buf):
+        packet = the_sock.recv(len(buf))
+        buf[:len(packet)] = packet
+        return len(packet)
+
+    # Received frame (n bytes in buf) is an ACK
+    def __is_ack(self, buf, n):
+        return n >= ctpcodec.header_size(buf) and (ctpcodec.flag_byte(buf) & ctpcodec.F_IS_ACK) != 0
+
+    # ACK in buf is from rcvr_addr to sndr_addr (or between the aliases, for short frames)
+    def __ack_from(self, buf, sndr_addr, rcvr_addr, my_alias, rcvr_alias):
+        if ctpcodec.is_short(buf):
+            return (my_alias is not None) and (buf[1] == rcvr_alias) and (buf[2] == my_alias)
+        return ctpcodec.same_bytes(buf, 8, sndr_addr) and ctpcodec.same_bytes(buf, 0, rcvr_addr)
+
+    # Enlarge the reassembly buffer, keeping its content
+    def __grow_rx(self, size):
+        # None past max_transfer: a sender can't make us allocate more than that
+        if size > self.max_transfer:
+            return None
+        old = self.rx_data
+        new = bytearray(max(size, min(2 * len(old), self.max_transfer)))
+        new[:len(old)] = old
+        self.rx_data = new
+        return new
+
+    # Drop a partial reassembly, shrinking the buffer back if a large transfer grew it
+    def __reclaim_rx(self):
+        if len(self.rx_data) > self.RX_BUFFER_SIZE:
+            self.rx_data = None
+            gc.collect()
+            self.rx_data = bytearray(self.RX_BUFFER_SIZE)
+        return self.rx_data
+
+    # Garbage collection happens between transfers, and only when the heap runs low,
+    # instead of gc.collect() pauses at the start and end of every transfer
+    def __collect_if_low(self):
+        mem_free = getattr(gc, 'mem_free', None)
+        if (mem_free is not None) and (mem_free() < self.GC_LOW_WATERMARK):
+            gc.collect()
+
+    # Reply to a control message received from sender, sent back in the ACK of its last fragment
+    def __control_reply(self, sender, data):
+        if (self.dedup is not None) and ctpdedup.is_manifest(data):
+            return self.dedup.answer(sender, data)
+        if (self.dedup is not None) and ctpdedup.is_delta(data):
+            reply = self.dedup.accept(sender, data)
+            if reply == ctpdedup.DELTA_REJECTED:
+                self.metrics.peer(sender)[ctpmetrics.DEDUP_REJECTED] += 1
+            return reply
+        if ctpsession.is_session(data):
+            return self.__accept_session(sender, data)
+        return None
+
+    # Session offer from sender: agree, cache and size the reassembly buffer for the announced transfer
+    def __accept_session(self, sender, data):
+        params = ctpsession.parse(data)
+        if params and ctpsession.too_long(params, self.max_transfer):
+            self.sessions.drop(sender)
+            return ctpsession.refusal(self.max_transfer)
+        agreed = ctpsession.agree(params, self.SF, self.BW_KHZ, self.dedup is not None, self.max_transfer) if params else None
+        if agreed is None:
+            return None
+        self.sessions.put(sender, agreed)
+        if agreed['len'] > len(self.rx_data):
+            self.rx_data = bytearray(agreed['len'])
+        return ctpsession.encode_agreed(agreed)
 
     def __timeout(self, signum, frame):
         raise socket.timeout
@@ -157,279 +300,816 @@ class CTPendpoint:
     # Register node in discovered list of nodes
     def __register_node(self, node_name, discovered_node_list):
         # Convert to string
+        node_addr = node_name
         node_name = node_name.decode('utf-8')
         content = discovered_node_list.decode('utf-8')
         discovered_node_list = []
+        alias = None
+        listed_alias = None
 
         if content != 'None':
-            discovered_node_list = list(ujson.loads(content).keys())
+            nodes = ujson.loads(content)
+            # The sender advertises its own alias under its own address,
+            # and the alias it knows us by among its neighbours
+            alias = nodes.pop(node_name, None)
+            listed_alias = nodes.get(self.get_my_addr())
+            discovered_node_list = list(nodes.keys())
+
+        alias = alias if isinstance(alias, int) else None
+        listed_alias = listed_alias if isinstance(listed_alias, int) else None
+        if self.aliases.learn(node_addr, alias, listed_alias):
+            self.acks.set_alias(self.aliases.my_alias)
+
+        # Link quality of the hello schedules the delivery of queued messages
+        self.neighbors.heard(node_addr)
+        if self.outbox is not None:
+            rssi, snr = self.__link(self.recv)
+            self.outbox.seen(node_addr, rssi, snr)
 
         if self.debug_mode_recv: print ("DEBUG RECV 293: HELLO received. Registering node: {} {}".format(node_name, discovered_node_list))
         self.DISCOVERED_NODES[node_name] = discovered_node_list
 
         if self.debug_mode_recv: print ("DEBUG RECV 296: DISCOVERED_NODES: {}".format(self.DISCOVERED_NODES))
 
-    def _csend(self, payload, the_sock, sndr_addr, rcvr_addr, ack_required=True, hello=False):
-
-        global_time_t0 = time.time()
+    # Link quality (rssi, snr) of the last frame read from the_sock
+    def __link(self, the_sock):
+        link = getattr(the_sock, 'link', None)
+        if link is not None:
+            return link()
+        stats = self.lora.stats()
+        return stats.rssi, stats.snr
+
+    # Any frame proves its sender is alive: register it, at most every REFRESH_S
+    def __heard(self, addr, the_sock):
+        if not self.neighbors.heard(addr):
+            return
+        name = addr.decode('utf-8')
+        if name not in self.DISCOVERED_NODES:
+            self.DISCOVERED_NODES[name] = []
+        if self.outbox is not None:
+            rssi, snr = self.__link(the_sock)
+            self.outbox.seen(addr, rssi, snr)
+
+    # Neighbours listed in the presence hint of an ACK, added to the peer's list
+    def __learn_hint(self, peer, ack, n):
+        if not ctpneighbors.valid_addr(peer):
+            return
+        name = peer.decode('utf-8')
+        known = self.DISCOVERED_NODES.get(name) or []
+        for addr in ctpneighbors.decode_hint(ack, n):
+            addr = addr.decode('utf-8')
+            if addr not in known: known = known + [addr]
+        self.DISCOVERED_NODES[name] = known
+
+    def _csend(self, payload, the_sock, sndr_addr, rcvr_addr, ack_required=True, hello=False, deadline=None, retry_of=None):
+        # retry_of: (start time, start ticks, frames sent, retransmissions) of a first attempt by alias
+        # that got nothing through, retried with full addresses: both are accounted as one transfer
+        if retry_of is None:
+            global_time_t0, ticks_t0, psent_t0, retrans_t0 = time.time(), ctpmetrics.ticks_ms(), 0, 0
+        else:
+            global_time_t0, ticks_t0, psent_t0, retrans_t0 = retry_of
+        trace = self.trace
         # Shortening addresses to last 8 bytes to save space in packet
         sndr_addr = sndr_addr[8:]
         rcvr_addr = rcvr_addr[:8]
-        if self.debug_mode_send: print ("DEBUG SEND 148: sndr_addr, rcvr_addr", sndr_addr, rcvr_addr)
+        rcvr_known = not ((rcvr_addr == self.ANY_ADDR) or (rcvr_addr == b''))
+        metrics = self.metrics.peer(rcvr_addr)
+        congestion = self.congestion.peer(rcvr_addr)
+        payload_len = len(payload)
+        self.ack_reply = None
+
+        # Peers that know our alias are addressed by alias, with the short header
+        rcvr_alias = None if hello else self.aliases.alias_of(rcvr_addr)
+        if rcvr_alias is None:
+            header_size  = self.HEADER_SIZE
+            payload_size = self.PAYLOAD_SIZE
+        else:
+            header_size  = self.SHORT_HEADER_SIZE
+            payload_size = self.SHORT_PAYLOAD_SIZE
 
         # computing payload (content) size as "totptbs" = total packets to be sent
         if (len(payload)==0): print ("WARNING csend: payload size == 0... continuing")
-        totptbs = int(len(payload) / self.PAYLOAD_SIZE)
-        if ((len(payload) % self.PAYLOAD_SIZE)!=0): totptbs += 1
+        totptbs = int(len(payload) / payload_size)
+        if ((len(payload) % payload_size)!=0): totptbs += 1
 
-        if self.debug_mode_send: print ("DEBUG SEND 155: Total packages to be send: ", totptbs)  ###
-        timeout_value = 5
+        if trace and (retry_of is None): trace.event(ctptrace.EV_SEND_START, 0, totptbs, len(payload))
 
         # Initialize stats counters
         FAILED         = 0
-        stats_psent    = 0
-        stats_retrans  = 0
+        stats_psent    = psent_t0
+        stats_retrans  = retrans_t0
 
-        # RTT estimators
-        timeout_time   =  1    # 1 second
+        # RTT estimators, in milliseconds
         estimated_rtt  = -1
-        dev_rtt        =  1
-        the_sock.settimeout(5)      # 5 seconds initial timeout... LoRa is slow
+        dev_rtt        = 1000
+        timeout_set    = 5000
+        timeout_value  = 5          # 5 seconds initial timeout... LoRa is slow
+        the_sock.settimeout(timeout_value)
 
         # stop and wait
         seqnum = self.ZERO
         acknum = self.ONE
 
-        # Enabling garbage collection
-        gc.enable()
-        gc.collect()
+        # Headers (flags and checksums) of every fragment, packed in a buffer reused across transfers
+        my_alias = None
+        if rcvr_alias is None:
+            headers = ctpcodec.pack_headers(sndr_addr, rcvr_addr, payload, payload_size, hello, ack_required, self.tx_headers)
+        else:
+            my_alias = self.aliases.my_alias
+            headers = ctpcodec.pack_headers(my_alias, rcvr_alias, payload, payload_size, hello, ack_required, self.tx_headers)
+        self.tx_headers = headers
+
+        # Every fragment is staged in the preallocated tx frame: nothing is
+        # allocated per fragment but the transient views used to copy it
+        hview = memoryview(headers)
+        pview = memoryview(payload)
+        frame = self.tx_frame
+        fview = self.tx_view
+        ack = self.tx_ack
+        readinto = getattr(the_sock, 'readinto', None)
+        last_size = header_size + payload_len - (totptbs - 1) * payload_size
+        last_frame = fview[:last_size]
+
+        cp = 0
         for cp in range(totptbs):
 
-            if self.debug_mode_send: print ("DEBUG SEND 178: Packet counter: ", cp)  ###
             last_pkt = True if (cp == (totptbs-1)) else False
 
-            # Getting a block of max self.PAYLOAD_SIZE from "payload"
-            blocktbs = payload[0:self.PAYLOAD_SIZE]  # Taking self.PAYLOAD_SIZE bytes ToBeSent
-            payload  = payload[self.PAYLOAD_SIZE:]   # Shifting the input string
-
-            packet = self.__make_packet(sndr_addr, rcvr_addr, hello, seqnum, ack_required, acknum, self.ITS_DATA_PACKET, last_pkt, blocktbs)
-            if self.debug_mode_send: self.__debug_printpacket("DEBUG SEND 186: sending packet", packet)
+            # Fragment cp: its precomputed header followed by a block of max payload_size from "payload"
+            offset = cp * payload_size
+            fview[0:header_size] = hview[cp * header_size:(cp + 1) * header_size]
+            if last_pkt:
+                fview[header_size:last_size] = pview[offset:]
+                packet = last_frame
+            else:
+                fview[header_size:] = pview[offset:offset + payload_size]
+                packet = frame
 
             # trying 3 times
             keep_trying = 3
             while (keep_trying > 0):
 
+                if deadline is not None:
+                    if deadline.cancelled():
+                        FAILED = self.FAILED_CANCELLED
+                        break
+                    if deadline.expired():
+                        FAILED = self.FAILED_TIMEOUT
+                        break
+
                 try:
-                    time.sleep((3-keep_trying)) ###
+                    # Paced by the peer's rate, retransmissions after a random growing delay
+                    if keep_trying < 3:
+                        metrics[ctpmetrics.PACING_MS] += congestion.retry_delay(3 - keep_trying)
+                    else:
+                        metrics[ctpmetrics.PACING_MS] += congestion.pace(ack_required)
                     the_sock.setblocking(True)
-                    send_time = time.time()
+                    if self.csma:
+                        busy, backoff_ms = self.csma.wait()
+                        if busy:
+                            metrics[ctpmetrics.CHANNEL_BUSY] += busy
+                            metrics[ctpmetrics.BACKOFF_MS] += backoff_ms
+                            if trace: trace.event(ctptrace.EV_BACKOFF, 0, cp, busy, backoff_ms)
+                    send_ticks = ctpmetrics.ticks_ms()
                     the_sock.send(packet)
+                    metrics[ctpmetrics.FRAMES_SENT] += 1
+                    if not hello: self.neighbors.sent()
+                    if trace: trace.event(ctptrace.EV_TX_DATA, seqnum | (acknum << 1), cp, last_size if last_pkt else self.MAX_PKT_SIZE, 3 - keep_trying)
 
                     if ack_required:
-                        # waiting for the ack
-                        the_sock.settimeout(timeout_value)  ###
-                        if self.debug_mode_send: print("DEBUG SEND 200: waiting ACK")
-                        ack = the_sock.recv(self.HEADER_SIZE)
-                        recv_time = time.time()
-                        if self.debug_mode_send: print("DEBUG SEND 203: received ack", ack)
-
-                        # self.__unpack packet information
-                        try:
-                            ack_saddr, ack_daddr, hello, ack_seqnum, ack_required, ack_acknum, ack_is_ack, ack_final, ack_check, ack_content = self.__unpack(ack)
-                        except Exception as e:
-                            print("ERROR ACKKKKKKKK 208:", e)
-                            
-                        if (rcvr_addr == self.ANY_ADDR) or (rcvr_addr == b''):
-                            rcvr_addr = ack_saddr       # in case rcvr_addr was self.ANY_ADDR and payload needs many packets
+                        # waiting for the ack, not beyond the deadline
+                        if (deadline is not None) and (deadline.timeout_ms is not None):
+                            the_sock.settimeout(min(timeout_value, max(deadline.remaining(), 0.1)))
+                        else:
+                            the_sock.settimeout(timeout_value)  ###
+                        n = readinto(ack) if readinto else self.__recv_into(the_sock, ack)
+                        recv_ticks = ctpmetrics.ticks_ms()
+                        if n is None:
+                            raise socket.timeout
+
+                        if (not rcvr_known) and self.__is_ack(ack, n) and not ctpcodec.is_short(ack):
+                            # in case rcvr_addr was self.ANY_ADDR and payload needs many packets:
+                            # address the remaining fragments to the receiver
+                            rcvr_addr = bytes(ack[0:8])
+                            rcvr_known = True
+                            metrics = self.metrics.peer(rcvr_addr)
+                            congestion = self.congestion.peer(rcvr_addr)
+                            for i in range(cp + 1, totptbs):
+                                headers[i * header_size + 8:i * header_size + 16] = rcvr_addr
 
                         # Check if valid...
-                        if (ack_is_ack) and (ack_acknum == seqnum) and (sndr_addr == ack_daddr) and (rcvr_addr == ack_saddr):
+                        if self.__is_ack(ack, n) and ((ctpcodec.flag_byte(ack) >> 2) & 1 == seqnum) and self.__ack_from(ack, sndr_addr, rcvr_addr, my_alias, rcvr_alias):
+                            rtt_ms = ctpmetrics.ticks_diff(recv_ticks, send_ticks)
+                            self.metrics.rtt(metrics, rtt_ms)
+                            congestion.on_ack(rtt_ms)
+                            if trace: trace.event(ctptrace.EV_RX_ACK, (ctpcodec.flag_byte(ack) & 1) | ((ctpcodec.flag_byte(ack) >> 1) & 2), cp, n, rtt_ms)
                             stats_psent   += 1
+                            self.__heard(rcvr_addr, the_sock)
+                            ack_size = ctpcodec.header_size(ack)
+                            if ctpcodec.flag_byte(ack) & ctpcodec.F_HINT:
+                                self.__learn_hint(rcvr_addr, ack, n)
+                                n -= ctpneighbors.hint_size(ack, n)
+                            if last_pkt and (n > ack_size) and (ctpcodec.check_value(ack, ack_size) == ctpcodec.checksum_value(memoryview(ack)[ack_size:n])):
+                                self.ack_reply = bytes(ack[ack_size:n])
                             # No more need to retry
                             break
                         else:
                             # Received packet not valid
-                            if self.debug_mode_send: print ("ERROR SEND: ACK received not valid")
+                            if trace: trace.event(ctptrace.EV_ACK_INVALID, 0, cp, n)
                     else:
                         # No need to wait for ACK
                         break
                 except socket.timeout:
-                    if self.debug_mode_send: print("EXCEPTION!! Socket timeout: ", time.time())
+                    metrics[ctpmetrics.TIMEOUTS] += 1
+                    # The retransmissions of a frame are one loss event
+                    if keep_trying == 3: congestion.on_loss()
+                    if trace: trace.event(ctptrace.EV_TIMEOUT, seqnum | (acknum << 1), cp, 0, 3 - keep_trying)
 
-                if self.debug_mode_send: self.__debug_printpacket("re-sending packet", packet)
-                if self.debug_mode_send: print ("DEBUG SEND 222: attempt number: ", keep_trying)
                 stats_psent   += 1
                 stats_retrans += 1
+                metrics[ctpmetrics.RETRANSMISSIONS] += 1
                 keep_trying   -= 1
                 if(keep_trying == 0):
-                    FAILED = -1
+                    FAILED = self.FAILED_RETRIES
                     break
 
             # Check if last packet or failed to send a packet...
             if last_pkt or (FAILED<0): break
 
-            # RTT calculations
-            sample_rtt = recv_time - send_time
-            if estimated_rtt == -1:
-                estimated_rtt = sample_rtt
-            else:
-                estimated_rtt = estimated_rtt * 0.875 + sample_rtt * 0.125
-            dev_rtt = 0.75 * dev_rtt + 0.25 * abs(sample_rtt - estimated_rtt)
-            timeout_value = (estimated_rtt + 4 * dev_rtt)
-            if self.debug_mode_send: print ("DEBUG SEND 241: setting timeout to", estimated_rtt + 4 * dev_rtt)
+            # Higher priority transfers to other peers go out between our fragments
+            if self.preempt and not self.preempting:
+                self.__serve_preempt()
+
+            if ack_required:
+                # RTT calculations, integer milliseconds
+                sample_rtt = ctpmetrics.ticks_diff(recv_ticks, send_ticks)
+                if estimated_rtt == -1:
+                    estimated_rtt = sample_rtt
+                else:
+                    estimated_rtt = (estimated_rtt * 7 + sample_rtt) >> 3
+                dev_rtt = max((dev_rtt * 3 + abs(sample_rtt - estimated_rtt)) >> 2, self.RTT_DEV_MIN_MS)
+                # Rounded to 100 ms so the (float) socket timeout is only rebuilt when it really changes
+                timeout_ms = (max(estimated_rtt + 4 * dev_rtt, self.min_rto_ms) + 99) // 100 * 100
+                if timeout_ms != timeout_set:
+                    timeout_set = timeout_ms
+                    timeout_value = timeout_ms / 1000
+                    if trace: trace.event(ctptrace.EV_RTO, 0, cp, 0, timeout_ms)
 
             # Increment sequence and ack numbers
             seqnum = (seqnum + self.ONE) % 2    # self.ONE if seqnum == self.ZERO else self.ZERO
             acknum = (acknum + self.ONE) % 2    # self.ONE if acknum == self.ZERO else self.ZERO
 
-        if self.debug_mode_send: print ("DEBUG SEND 247: RETURNING tsend")
-        if self.debug_mode_send: print ("DEBUG SEND 248: Retrans: ", stats_retrans)
-
-        # KN: Enabling garbage collection
-        gc.enable()
-        gc.collect()
-        payload = ""
-        blocktbs = []
-        payload  = []
-        packet = ""
+        hview = pview = last_frame = None
+        if (FAILED == self.FAILED_RETRIES) and (rcvr_alias is not None):
+            # The peer may not resolve our alias (collision or stale hello):
+            # use full addresses until its next hello, and retry from scratch if nothing got through
+            self.aliases.forget(rcvr_addr)
+            if cp == 0:
+                return self._csend(payload, the_sock, self.lora_mac, rcvr_addr, ack_required, hello, deadline,
+                                   (global_time_t0, ticks_t0, stats_psent, stats_retrans))
+
+        if trace: trace.event(ctptrace.EV_SEND_END, 0, stats_psent, 1 if FAILED < 0 else 0, stats_retrans)
+        metrics[ctpmetrics.TX_TRANSFERS] += 1
+        metrics[ctpmetrics.TX_TIME_MS] += ctpmetrics.ticks_diff(ctpmetrics.ticks_ms(), ticks_t0)
+        if FAILED < 0:
+            metrics[ctpmetrics.TX_FAILED] += 1
+        elif ack_required:
+            metrics[ctpmetrics.TX_BYTES] += payload_len
+
+        # The transfer is over: a good time to collect, if needed at all
+        self.__collect_if_low()
         global_time_t1 = time.time()
         time_to_send = global_time_t1 - global_time_t0
-        if self.debug_mode_send: print("DEBUG SEND 255: time to send {:.4f} seconds".format(time_to_send))
         return rcvr_addr, stats_psent, stats_retrans, FAILED, time_to_send
 
-    def _crecv(self, the_sock, my_addr, snd_addr):
+    def _crecv(self, the_sock, my_addr, snd_addr, deadline=None, transfer_timeout=None, inactivity=INACTIVITY_TIMEOUT):
         global_time_t0 = time.time()
+        ticks_t0 = ctpmetrics.ticks_ms()
+        trace = self.trace
 
         # Shortening addresses to last 8 bytes
         my_addr  = my_addr[8:]
         snd_addr = snd_addr[:8]
         ack_required = True
-        if self.debug_mode_recv: print ("DEBUG RECV 264: my_addr, snd_addr: ", my_addr, snd_addr)
 
-        # Buffer storing the received data to be returned
-        rcvd_data = b''
-        last_check = 0
+        # Frames are received in the preallocated rx frame and the data is
+        # reassembled in a buffer reused across transfers
+        frame = self.rx_frame
+        fview = self.rx_view
+        rcvd_data = self.rx_data
+        rcvd_len = 0
+        readinto = getattr(the_sock, 'readinto', None)
+        last_check = -1
+        frag = 0
+        reply = None
+        dropping = False
 
         next_acknum = self.ONE
-        the_sock.settimeout(5)
 
-        if (snd_addr == self.ANY_ADDR) or (snd_addr == b''): SENDER_ADDR_KNOWN = False
+        SENDER_ADDR_KNOWN = not ((snd_addr == self.ANY_ADDR) or (snd_addr == b''))
+        first_snd_addr = snd_addr
+        # A started transfer is dropped after inactivity (or transfer_timeout) seconds, in ms
+        inactivity_ms = int(inactivity * 1000)
+        drop_ms = self.DROP_SILENCE * 1000
+        transfer_ms = None if transfer_timeout is None else int(transfer_timeout * 1000)
+        first_rx = last_rx = ticks_t0
         self.p_resend = 0   ###
+        if trace: trace.event(ctptrace.EV_RECV_START)
 
-        # Enabling garbage collection
-        gc.enable()
-        gc.collect()
         while True:
-            try:
-                the_sock.setblocking(True)
-                packet = the_sock.recv(self.MAX_PKT_SIZE)
-                if self.debug_mode_recv: print ("DEBUG RECV 283: packet received: ", packet)
-                inp_src_addr, inp_dst_addr, hello, inp_seqnum, inp_ackrequired, inp_acknum, is_ack, last_pkt, check, content = self.__unpack(packet)
-                if self.debug_mode_recv: print ("DEBUG RECV 286: inp_src_addr {}, inp_dst_addr {}, hello {}, inp_seqnum {}, inp_acknum {}, is_ack {}, last_pkt {}, check {}, content {}".format(inp_src_addr, inp_dst_addr, hello, inp_seqnum, inp_acknum, is_ack, last_pkt, check, content))
-
-                # If destination address is broadcast and mensage hello, then no send acknowledgement package
-                if (hello):
-                    ack_required = False
-                    self.__register_node(inp_src_addr, content)
-
-                # getting sender address, if unknown, with the first packet
-                if (not SENDER_ADDR_KNOWN):
-                    snd_addr = inp_src_addr
-                    SENDER_ID_KNOWN = True
-                # Checking if a "valid" packet... i.e., either for me or broadcast
-                if (inp_dst_addr != my_addr) and (inp_dst_addr != self.ANY_ADDR):
-                    if self.debug_mode_recv: print("RECV DISCARDED received packet not for me!!")
+            if deadline is not None:
+                try:
+                    deadline.check()
+                except (ctpdeadline.Timeout, ctpdeadline.Cancelled):
+                    self.__reclaim_rx()
+                    raise
+            if frag or dropping:
+                now = ctpmetrics.ticks_ms()
+                if dropping:
+                    expired = ctpmetrics.ticks_diff(now, last_rx) > drop_ms
+                else:
+                    expired = (ctpmetrics.ticks_diff(now, last_rx) > inactivity_ms) or ((transfer_ms is not None) and (ctpmetrics.ticks_diff(now, first_rx) > transfer_ms))
+                    if expired:
+                        self.metrics.peer(snd_addr)[ctpmetrics.RX_ABORTED] += 1
+                        if trace: trace.event(ctptrace.EV_RECV_ABORT, 0, frag, min(rcvd_len, 0xFFFF))
+                if expired:
+                    # The sender vanished mid-transfer (or gave up the one we dropped): wait for a new one
+                    rcvd_data = self.__reclaim_rx()
+                    rcvd_len = 0
+                    frag = 0
+                    last_check = -1
+                    reply = None
+                    next_acknum = self.ONE
+                    ack_required = True
+                    snd_addr = first_snd_addr
+                    dropping = False
                     continue
+            try:
+                # Wait for the next frame; poll only while deadlines or inactivity must be checked
+                the_sock.settimeout(self.RECV_POLL if (frag or dropping or deadline is not None) else None)
+                n = readinto(frame) if readinto else self.__recv_into(the_sock, frame)
             except socket.timeout:
-                if self.debug_mode_recv: print ("RECV EXCEPTION!! Socket timeout: ", time.time())
                 continue
             except Exception as e:
                 print (" RECV EXCEPTION!! Packet not valid: ", e)
+                if trace: trace.event(ctptrace.EV_BAD_FRAME, 0, frag)
+                continue
+            if n is None:
                 continue
 
-            if self.debug_mode_recv: print("DEBUG RECV 300: get_checksum(content)", self.__get_checksum(content))
-            checksum_OK = (check == self.__get_checksum(content))
+            header_size = ctpcodec.header_size(frame)
+            if n < header_size:
+                if trace: trace.event(ctptrace.EV_BAD_FRAME, 0, frag, n)
+                continue
+            flags = ctpcodec.flag_byte(frame)
+            if flags & ctpcodec.F_IS_ACK:
+                # ACK of some other transfer
+                if trace: trace.event(ctptrace.EV_NOT_FOR_ME, 0, frag, n)
+                continue
+            inp_seqnum = flags & ctpcodec.F_SEQNUM
+            inp_acknum = (flags >> 2) & 1
+            last_pkt = (flags & ctpcodec.F_LAST) != 0
+            hello = (flags & ctpcodec.F_HELLO) != 0
+            if trace: trace.event(ctptrace.EV_RX_DATA, inp_seqnum | (inp_acknum << 1), frag, n)
+
+            if ctpcodec.is_short(frame):
+                # Short frame: aliases, ACKs use the short header too
+                inp_src_addr = self.aliases.resolve.get(frame[1])
+                if inp_src_addr is None:
+                    # alias we can't resolve (unknown or collision)
+                    if trace: trace.event(ctptrace.EV_NOT_FOR_ME, 0, frag, n)
+                    continue
+                for_me = (frame[2] == self.aliases.my_alias) or (frame[2] == ctpalias.BROADCAST_ALIAS)
+                ack_peer = frame[1]
+            else:
+                # The source address is only copied when it is not the current sender
+                if ctpcodec.same_bytes(frame, 0, snd_addr):
+                    inp_src_addr = snd_addr
+                else:
+                    inp_src_addr = bytes(frame[0:8])
+                for_me = ctpcodec.same_bytes(frame, 8, my_addr) or ctpcodec.same_bytes(frame, 8, self.ANY_ADDR)
+                ack_peer = inp_src_addr
+
+            # If destination address is broadcast and mensage hello, then no send acknowledgement package
+            if (hello):
+                content = bytes(fview[header_size:n])
+                try:
+                    self.__register_node(inp_src_addr, content)
+                except Exception as e:
+                    # Malformed node list: the beacon is dropped, a transfer in progress goes on
+                    print(" RECV EXCEPTION!! Hello not valid: ", e)
+                    if trace: trace.event(ctptrace.EV_BAD_FRAME, 0, frag, n)
+                    continue
+                if trace: trace.event(ctptrace.EV_HELLO, 0, 0, len(content))
+                if frag:
+                    # Beacon of a neighbour in the middle of a transfer: only registered
+                    continue
+                ack_required = False
+
+            # getting sender address, if unknown, with the first packet (and keeping it for the whole transfer)
+            if (not SENDER_ADDR_KNOWN) and (frag == 0):
+                snd_addr = inp_src_addr
+            # Checking if a "valid" packet... i.e., either for me or broadcast
+            if not for_me:
+                if trace: trace.event(ctptrace.EV_NOT_FOR_ME, 0, frag, n)
+                continue
+            metrics = self.metrics.peer(inp_src_addr)
+            metrics[ctpmetrics.FRAMES_RECV] += 1
+            if dropping:
+                # Rest of the transfer too long for us: neither stored nor acknowledged
+                if inp_src_addr == snd_addr: last_rx = ctpmetrics.ticks_ms()
+                continue
+
+            check = ctpcodec.check_value(frame, header_size)
+            block = fview[header_size:n]
+            checksum_OK = (check == ctpcodec.checksum_value(block))
+            if not checksum_OK: metrics[ctpmetrics.CHECKSUM_FAIL] += 1
+            # A valid frame for us proves its sender alive (hellos are registered above)
+            elif not hello: self.__heard(inp_src_addr, the_sock)
 
             if (checksum_OK) and (next_acknum == inp_acknum) and (snd_addr == inp_src_addr):
-                rcvd_data += content
+                content_len = n - header_size
+                if rcvd_len + content_len > len(rcvd_data):
+                    rcvd_data = self.__grow_rx(rcvd_len + content_len)
+                    if rcvd_data is None:
+                        # Longer than max_transfer: dropped, the sender gets no more ACKs and gives up
+                        metrics[ctpmetrics.RX_ABORTED] += 1
+                        if trace: trace.event(ctptrace.EV_RECV_ABORT, 0, frag, min(rcvd_len, 0xFFFF))
+                        rcvd_data = self.__reclaim_rx()
+                        rcvd_len = 0
+                        last_rx = ctpmetrics.ticks_ms()
+                        dropping = True
+                        continue
+                rcvd_data[rcvd_len:rcvd_len + content_len] = block
+                rcvd_len += content_len
                 last_check = check
+                last_rx = ctpmetrics.ticks_ms()
+                if frag == 0: first_rx = last_rx
+                frag += 1
 
                 if ack_required:
-                    # Sending ACK
+                    # Sending ACK, the last one answers control messages
                     next_acknum = (inp_acknum + self.ONE) % 2
-                    ack_segment = self.__make_packet(my_addr, inp_src_addr, hello, inp_seqnum, ack_required, next_acknum, self.ITS_ACK_PACKET, last_pkt, b'')
-                    if self.debug_mode_recv: print ("DEBUG RECV 310: Forwarded package", self.p_resend)   ###
+                    ack_segment = self.acks.get(ack_peer, ctpcodec.flags(inp_seqnum, next_acknum, last_pkt, hello, self.ITS_ACK_PACKET, ack_required))
+                    if last_pkt and (rcvd_len >= len(ctpcodec.CTRL_PREFIX)) and ctpcodec.same_bytes(rcvd_data, 0, ctpcodec.CTRL_PREFIX):
+                        reply = self.__control_reply(snd_addr, bytes(memoryview(rcvd_data)[:rcvd_len]))
+                        if reply: ack_segment = ctpcodec.with_reply(ack_segment, reply)
+                    if last_pkt: ack_segment = ctpcodec.with_hint(ack_segment, self.neighbors.get_hint())
                     self.p_resend = self.p_resend + 1   ###
                     the_sock.setblocking(False)
                     the_sock.send(ack_segment)
-                    if self.debug_mode_recv: print("DEBUG RECV 314: Sent ACK", ack_segment)
+                    self.neighbors.sent()
+                    if trace: trace.event(ctptrace.EV_TX_ACK, inp_seqnum | (next_acknum << 1), frag, len(ack_segment))
                     if (last_pkt):
                         break
                 else:
                     break
             elif (checksum_OK) and (last_check == check) and (snd_addr == inp_src_addr):
-                # KN: Handlig ACK lost
-                rcvd_data += content
+                # KN: Handlig ACK lost: the fragment was already stored, only the ACK is sent again
+                metrics[ctpmetrics.DUPLICATES] += 1
+                last_rx = ctpmetrics.ticks_ms()
+                if trace: trace.event(ctptrace.EV_DUPLICATE, inp_seqnum | (inp_acknum << 1), frag, n)
 
                 if ack_required:
-                    # KN: Re-Sending ACK
-                    next_acknum = (inp_acknum + self.ZERO) % 2
-                    ack_segment = self.__make_packet(my_addr, inp_src_addr, hello, inp_seqnum, ack_required, next_acknum, self.ITS_ACK_PACKET, last_pkt, b'')
+                    # KN: Re-Sending the same ACK (the expected acknum doesn't change)
+                    ack_segment = self.acks.get(ack_peer, ctpcodec.flags(inp_seqnum, next_acknum, last_pkt, hello, self.ITS_ACK_PACKET, ack_required))
+                    if last_pkt and reply: ack_segment = ctpcodec.with_reply(ack_segment, reply)
+                    if last_pkt: ack_segment = ctpcodec.with_hint(ack_segment, self.neighbors.get_hint())
                     self.p_resend = self.p_resend -1 #CHANGED
-                    if self.debug_mode_recv: print ("DEBUG RECV 325: Forwarded package", self.p_resend)   ###
                     the_sock.setblocking(False)
                     the_sock.send(ack_segment)
-                    if self.debug_mode_recv: print("DEBUG RECV 328: re-sending ACK", ack_segment)
+                    self.neighbors.sent()
+                    if trace: trace.event(ctptrace.EV_TX_ACK, inp_seqnum | (next_acknum << 1), frag, len(ack_segment))
                     if (last_pkt):
                         break
                 else:
                     break
             else:
-                if self.debug_mode_recv: print ("DEBUG RECV 332: packet not valid", packet)
-
-        # KN: Enabling garbage collection
-        last_check = 0
-        packet = ""
-        content = ""
-        gc.enable()
-        gc.collect()
+                if trace: trace.event(ctptrace.EV_BAD_FRAME, inp_seqnum | (inp_acknum << 1), frag, n)
+
+        # The only allocation of the transfer: the data handed to the application
+        data = bytes(memoryview(rcvd_data)[:rcvd_len])
+        self.__collect_if_low()
         global_time_t1 = time.time()
         time_to_recv = global_time_t1 - global_time_t0
-        if self.debug_mode_send: print("DEBUG SEND 255: time to send {:.4f} seconds".format(time_to_recv))
-        return rcvd_data, snd_addr, time_to_recv
+        if trace: trace.event(ctptrace.EV_RECV_END, 0, frag, min(rcvd_len, 0xFFFF))
+        metrics = self.metrics.peer(snd_addr)
+        metrics[ctpmetrics.RX_TRANSFERS] += 1
+        metrics[ctpmetrics.RX_BYTES] += rcvd_len
+        metrics[ctpmetrics.RX_TIME_MS] += ctpmetrics.ticks_diff(ctpmetrics.ticks_ms(), ticks_t0)
+        return data, snd_addr, time_to_recv
 
     def connect(self, dest=ANY_ADDR):
         print("loractp: connecting to... ", dest)
-        rcvr_addr, stats_psent, stats_retrans, FAILED, time_to_send = self._csend(b"CONNECT", self.send, self.lora_mac, dest)
+        # Session handshake, renewing the parameters cached for dest
+        self.__acquire_tx(dest, self.PRIORITY_NORMAL)
+        try:
+            self.sessions.drop(dest)
+            rcvr_addr, stats_psent, stats_retrans, FAILED, time_to_send = self.__handshake(dest, 0, None)
+        finally:
+            self.__release_tx()
         return self.my_addr, rcvr_addr, stats_psent, stats_retrans, FAILED, time_to_send
 
     def hello(self, dest=ANY_ADDR):
         if self.debug_mode_send: print("loractp: send hello to... ", dest)
-        nodes = b'None'
-        nodes_list = self.get_discovered_nodes_list()
-
-        if len(nodes_list) > 0:
-            nodes = ujson.dumps(dict.fromkeys(nodes_list, '')).encode('utf-8')
-
-        rcvr_addr, stats_psent, stats_retrans, FAILED, time_to_send = self._csend(nodes, self.send, self.lora_mac, dest, ack_required=False, hello=True)
+        # Discovered nodes with the alias we resolve them to, and our own alias
+        nodes = dict.fromkeys(self.get_discovered_nodes_list(), '')
+        for addr, alias in self.aliases.neighbours().items():
+            nodes[addr.decode('utf-8')] = alias
+        nodes[self.get_my_addr()] = self.aliases.my_alias
+        nodes = ujson.dumps(nodes).encode('utf-8')
+
+        self.__acquire_tx(dest, self.PRIORITY_NORMAL)
+        try:
+            rcvr_addr, stats_psent, stats_retrans, FAILED, time_to_send = self._csend(nodes, self.send, self.lora_mac, dest, ack_required=False, hello=True)
+        finally:
+            self.__release_tx()
+        self.neighbors.hello_sent()
         return self.my_addr, rcvr_addr, stats_psent, stats_retrans, FAILED
 
+    def beacon_due(self, interval):
+        # Whether the periodic hello (every interval seconds) is needed: not while our frames are heard anyway
+        return self.neighbors.beacon_due(interval)
+
     def listen(self, sender=ANY_ADDR):
         print("loractp: listening for...", sender)
         rcvd_data, snd_addr, time_to_recv = self._crecv(self.recv, self.lora_mac, sender)
-        if (rcvd_data==b"CONNECT"):
+        if (rcvd_data==b"CONNECT") or ctpsession.is_session(rcvd_data):
             return self.my_addr, snd_addr, 0
         else:
             return self.my_addr, snd_addr, -1
 
-    def sendit(self, addr=ANY_ADDR, payload=b'', ack_required=True):
-        rcvr_addr, stats_psent, stats_retrans, FAILED, time_to_send = self._csend(payload, self.send, self.lora_mac, addr, ack_required)
+    def sendit(self, addr=ANY_ADDR, payload=b'', ack_required=True, dedup=False, timeout=None, cancel=None, aggregate=False,
+               priority=PRIORITY_NORMAL):
+        # payload can also be a list of segments ordered by priority, see __send_segments
+        # timeout (s) bounds the whole call, cancel is a ctpdeadline.CancelToken: FAILED tells why it stopped
+        # aggregate: a small message may share its frame with others to the same peer (ctpaggregate),
+        # once the session with the peer says it understands batches
+        # priority: PRIORITY_URGENT/NORMAL/BULK, see __preempt_request
+        # Frames carry the 8 byte short address: sessions, locks and metrics are kept under it
+        addr = addr[:8] or self.ANY_ADDR
+        if (addr != self.ANY_ADDR) and not ctpneighbors.valid_addr(addr):
+            raise ValueError("loractp: invalid address {}".format(addr))
+        if aggregate and ack_required and (addr != self.ANY_ADDR) and (timeout is None) and (cancel is None) \
+                and isinstance(payload, bytes) and (len(payload) <= self.AGGREGATE_MAX_SIZE) \
+                and (self.sessions.get(addr) or {}).get('batch'):
+            return self.aggregator.send(addr, payload)
+        deadline = None
+        if (timeout is not None) or (cancel is not None):
+            deadline = ctpdeadline.Deadline(timeout, cancel)
+
+        request = self.__preempt_request(addr, payload, ack_required, dedup, deadline, priority)
+        if request is not None:
+            # Sent by the running transfer at its next fragment boundary
+            return self.__wait_preempt(request, deadline)
+
+        if not self.__acquire_tx(addr, priority, timeout):
+            return addr, 0, 0, self.FAILED_TIMEOUT, 0
+        try:
+            return self.__send_payload(addr, payload, ack_required, dedup, deadline)
+        finally:
+            self.__release_tx()
+
+    def __send_payload(self, addr, payload, ack_required, dedup, deadline):
+        if isinstance(payload, (list, tuple)):
+            return self.__send_segments(addr, payload, ack_required, dedup, deadline)
+        return self.__send_one(addr, payload, ack_required, dedup, deadline)
+
+    def __acquire_tx(self, addr, priority, timeout=None):
+        if not self.send_lock.acquire(1, -1 if timeout is None else timeout):
+            return False
+        with self.preempt_lock:
+            self.tx_active = (addr[:8], priority)
+        return True
+
+    def __release_tx(self):
+        # Preempting transfers queued at the very end are served before giving up the radio
+        while True:
+            with self.preempt_lock:
+                if not self.preempt:
+                    self.tx_active = None
+                    self.send_lock.release()
+                    return
+            self.__serve_preempt()
+
+    # A transfer with a lower priority to another peer is running: queue the payload,
+    # it goes out at the next fragment boundary instead of after the whole transfer.
+    # Returns the request or None if the caller has to wait for the radio.
+    # The receiver handles one transfer per sender at a time, so the same peer is never preempted.
+    def __preempt_request(self, addr, payload, ack_required, dedup, deadline, priority):
+        with self.preempt_lock:
+            active = self.tx_active
+            if (active is None) or (priority <= active[1]) or (addr[:8] == active[0]):
+                return None
+            done = _thread.allocate_lock()
+            done.acquire()
+            failed = (addr, 0, 0, self.FAILED_RETRIES, 0)
+            request = [priority, addr, payload, ack_required, dedup, deadline, done, failed]
+            i = 0
+            while i < len(self.preempt) and self.preempt[i][0] >= priority:
+                i += 1
+            self.preempt.insert(i, request)
+            return request
+
+    # Result of a queued preempting transfer. The deadline bounds the wait: a request that has
+    # not started is withdrawn when it expires or is cancelled, a started one stops by itself
+    def __wait_preempt(self, request, deadline):
+        done = request[6]
+        if deadline is None:
+            done.acquire()
+            return request[7]
+        while not done.acquire(1, self.PREEMPT_POLL):
+            if deadline.cancelled():
+                status = self.FAILED_CANCELLED
+            elif deadline.expired():
+                status = self.FAILED_TIMEOUT
+            else:
+                continue
+            with self.preempt_lock:
+                for i in range(len(self.preempt)):
+                    if self.preempt[i] is request:
+                        del self.preempt[i]
+                        return request[1], 0, 0, status, 0
+        return request[7]
+
+    # Runs the queued preempting transfers, with the spare tx buffers so that the interrupted one can resume
+    def __serve_preempt(self):
+        saved = (self.tx_frame, self.tx_view, self.tx_ack, self.tx_headers, self.ack_reply)
+        if self.tx_spare is None:
+            frame = bytearray(self.MAX_PKT_SIZE)
+            self.tx_spare = [frame, memoryview(frame), bytearray(self.MAX_PKT_SIZE), None]
+        self.tx_frame, self.tx_view, self.tx_ack, self.tx_headers = self.tx_spare
+        self.preempting = True
+        try:
+            while True:
+                with self.preempt_lock:
+                    if not self.preempt:
+                        break
+                    request = self.preempt.pop(0)
+                priority, addr, payload, ack_required, dedup, deadline, done, result = request
+                try:
+                    request[7] = self.__send_payload(addr, payload, ack_required, dedup, deadline)
+                finally:
+                    done.release()
+        finally:
+            self.preempting = False
+            self.tx_spare[3] = self.tx_headers
+            self.tx_frame, self.tx_view, self.tx_ack, self.tx_headers, self.ack_reply = saved
+
+    def __send_batch(self, addr, payload):
+        return self.sendit(addr, payload)
+
+    def __send_one(self, addr, payload, ack_required, dedup, deadline):
+        if (not ack_required) or (addr == self.ANY_ADDR):
+            return self._csend(payload, self.send, self.lora_mac, addr, ack_required, deadline=deadline)
+
+        # The first transfer to a peer agrees on the session parameters, the next ones reuse them
+        stats_psent, stats_retrans, time_to_send = 0, 0, 0
+        session = self.sessions.get(addr)
+        if session is None:
+            rcvr_addr, stats_psent, stats_retrans, FAILED, time_to_send = self.__handshake(addr, len(payload), deadline)
+            if FAILED < 0:
+                return rcvr_addr, stats_psent, stats_retrans, FAILED, time_to_send
+            # Stored under the address that acknowledged, older firmware agrees on nothing
+            session = self.sessions.get(rcvr_addr) or ctpsession.LEGACY
+
+        if dedup and session.get('dedup') and (len(payload) > ctpdedup.CHUNK_SIZE):
+            rcvr_addr, psent, retrans, FAILED, time_data = self.__send_dedup(addr, payload, deadline)
+        else:
+            rcvr_addr, psent, retrans, FAILED, time_data = self._csend(payload, self.send, self.lora_mac, addr, deadline=deadline)
+        if FAILED == self.FAILED_RETRIES:
+            # The peer may have restarted: agree again next time
+            self.sessions.drop(addr)
+        return rcvr_addr, stats_psent + psent, stats_retrans + retrans, FAILED, time_to_send + time_data
+
+    # One round trip: our offer, the agreed parameters come back in its ACK
+    def __handshake(self, addr, length, deadline):
+        offer = ctpsession.offer(self.SF, self.BW_KHZ, self.dedup is not None, length, machine.rng() & 0xFFFF)
+        rcvr_addr, stats_psent, stats_retrans, FAILED, time_to_send = self._csend(offer, self.send, self.lora_mac, addr, deadline=deadline)
+        if FAILED == 0:
+            agreed = ctpsession.decode_agreed(self.ack_reply) if self.ack_reply else None
+            if agreed and ctpsession.is_refusal(agreed):
+                if self.trace:
+                    max_len = agreed.get('max')
+                    self.trace.event(ctptrace.EV_REFUSED, 0, 0, min(length >> 10, 0xFFFF),
+                                     min(max_len >> 10, 0xFFFF) if isinstance(max_len, int) else 0)
+                return rcvr_addr, stats_psent, stats_retrans, self.FAILED_REFUSED, time_to_send
+            # A peer that acknowledges without answering runs an older firmware
+            self.sessions.put(rcvr_addr, agreed or ctpsession.LEGACY)
+            if self.trace:
+                self.trace.event(ctptrace.EV_SESSION, 0, 1 if agreed else 0, 0,
+                                 (1 if agreed and agreed.get('dedup') is True else 0) |
+                                 (2 if agreed and agreed.get('batch') is True else 0))
+        return rcvr_addr, stats_psent, stats_retrans, FAILED, time_to_send
+
+    # Priority segments (e.g. a thumbnail, then the full image) are sent in order,
+    # each one as its own transfer that the receiver delivers as soon as it completes:
+    # a transfer aborted partway still leaves the first segments at the receiver
+    def __send_segments(self, addr, segments, ack_required, dedup, deadline):
+        if len(segments) > self.MAX_SEGMENTS:
+            raise ValueError("loractp: too many segments ({} max)".format(self.MAX_SEGMENTS))
+        stream = machine.rng() & 0xFFFF
+        rcvr_addr, stats_psent, stats_retrans, FAILED, time_to_send = addr, 0, 0, 0, 0
+        for index, segment in enumerate(segments):
+            data = self.SEGMENT_PREFIX + struct.pack(self.SEGMENT_FORMAT, stream, index, len(segments)) + segment
+            rcvr_addr, psent, retrans, FAILED, time_segment = self.__send_one(rcvr_addr, data, ack_required, dedup, deadline)
+            stats_psent   += psent
+            stats_retrans += retrans
+            time_to_send  += time_segment
+            if FAILED < 0:
+                if self.trace: self.trace.event(ctptrace.EV_SEGMENT_FAIL, 0, index, len(segments))
+                break
+        return rcvr_addr, stats_psent, stats_retrans, FAILED, time_to_send
+
+    # Deduplicated transfer: the manifest of the payload chunks first, the receiver
+    # answers with the chunks it holds in the ACK, then only the missing chunks
+    def __send_dedup(self, addr, payload, deadline):
+        manifest = ctpdedup.manifest(payload)
+        rcvr_addr, stats_psent, stats_retrans, FAILED, time_to_send = self._csend(manifest, self.send, self.lora_mac, addr, deadline=deadline)
+        if FAILED < 0:
+            return rcvr_addr, stats_psent, stats_retrans, FAILED, time_to_send
+        held = self.ack_reply
+        if held:
+            data = ctpdedup.delta(payload, manifest, held)
+            self.metrics.peer(rcvr_addr)[ctpmetrics.DEDUP_SAVED] += len(payload) - len(data)
+        else:
+            # The receiver has no chunk cache: plain transfer
+            data = payload
+        if self.trace: self.trace.event(ctptrace.EV_DEDUP, 0, 0, min(len(data), 0xFFFF), min(len(payload) >> 10, 0xFFFF))
+        rcvr_addr, psent, retrans, FAILED, time_data = self._csend(data, self.send, self.lora_mac, rcvr_addr, deadline=deadline)
+        stats_psent, stats_retrans, time_to_send = stats_psent + psent, stats_retrans + retrans, time_to_send + time_data
+        if (FAILED == 0) and held and (self.ack_reply == ctpdedup.DELTA_REJECTED):
+            # The receiver couldn't rebuild the payload from the delta: sent in full
+            self.metrics.peer(rcvr_addr)[ctpmetrics.DEDUP_REJECTED] += 1
+            rcvr_addr, psent, retrans, FAILED, time_data = self._csend(payload, self.send, self.lora_mac, rcvr_addr, deadline=deadline)
+            stats_psent, stats_retrans, time_to_send = stats_psent + psent, stats_retrans + retrans, time_to_send + time_data
         return rcvr_addr, stats_psent, stats_retrans, FAILED, time_to_send
 
-    def recvit(self, addr=ANY_ADDR):
-        rcvd_data, snd_addr, time_to_recv = self._crecv(self.recv, self.lora_mac, addr)
+    def queue(self, addr, payload, ack_required=True, dedup=False):
+        # Store payload for addr until it is heard again (see flush_outbox), returns the message id
+        if self.outbox is None:
+            return None
+        return self.outbox.put(addr, payload, ack_required, dedup)
+
+    def flush_outbox(self):
+        # Send the queued messages of the reachable peers that are due, returns how many were delivered
+        if self.outbox is None:
+            return 0
+        delivered = 0
+        for dest in self.outbox.due():
+            for msg_id in list(self.outbox.queue.get(dest, ())):
+                meta, payload = self.outbox.get(dest, msg_id)
+                rcvr_addr, stats_psent, stats_retrans, FAILED, time_to_send = self.sendit(dest, payload, meta['ack_required'], meta['dedup'])
+                if FAILED < 0:
+                    self.outbox.failed(dest)
+                    break
+                self.outbox.remove(dest, msg_id)
+                delivered += 1
+            else:
+                self.outbox.delivered(dest)
+        return delivered
+
+    def get_outbox(self):
+        return self.outbox.pending() if self.outbox is not None else {}
+
+    def recvit(self, addr=ANY_ADDR, timeout=None, cancel=None, transfer_timeout=None, inactivity=INACTIVITY_TIMEOUT):
+        # timeout (s) bounds the whole call and cancel is a ctpdeadline.CancelToken: they raise
+        # ctpdeadline.Timeout/Cancelled. A transfer whose sender is silent for inactivity seconds,
+        # or that lasts more than transfer_timeout seconds, is dropped and the call keeps waiting.
+        rcvd_data, snd_addr, time_to_recv, segment = self.recv_segment(addr, timeout, cancel, transfer_timeout, inactivity)
         return rcvd_data, snd_addr, time_to_recv
 
+    def recv_segment(self, addr=ANY_ADDR, timeout=None, cancel=None, transfer_timeout=None, inactivity=INACTIVITY_TIMEOUT):
+        # Like recvit, plus (stream id, index, count) when the data is a priority segment, None otherwise
+        deadline = None
+        if (timeout is not None) or (cancel is not None):
+            deadline = ctpdeadline.Deadline(timeout, cancel)
+        while True:
+            if self.rx_pending:
+                return self.rx_pending.pop(0)
+            rcvd_data, snd_addr, time_to_recv = self._crecv(self.recv, self.lora_mac, addr, deadline, transfer_timeout, inactivity)
+            if (self.dedup is not None) and ctpdedup.is_delta(rcvd_data):
+                # Checked in the ACK of its last fragment (__control_reply), rebuilt now that it is sent.
+                # None if it was rejected there (the sender resends the payload in full), or if a
+                # held chunk can't be read back from flash
+                accepted = snd_addr in self.dedup.pending
+                payload = self.dedup.rebuild(snd_addr, rcvd_data)
+                if payload is None:
+                    if accepted: self.metrics.peer(snd_addr)[ctpmetrics.DEDUP_REJECTED] += 1
+                    continue
+                rcvd_data = payload
+            if rcvd_data.startswith(self.SEGMENT_PREFIX) and (len(rcvd_data) >= self.SEGMENT_HEADER):
+                segment = struct.unpack_from(self.SEGMENT_FORMAT, rcvd_data, len(self.SEGMENT_PREFIX))
+                return rcvd_data[self.SEGMENT_HEADER:], snd_addr, time_to_recv, segment
+            if ctpaggregate.is_batch(rcvd_data):
+                # Coalesced messages: handed to the application one by one
+                for record in ctpaggregate.split(rcvd_data):
+                    self.rx_pending.append((record, snd_addr, time_to_recv, None))
+                continue
+            if not rcvd_data.startswith(ctpcodec.CTRL_PREFIX):
+                return rcvd_data, snd_addr, time_to_recv, None
+            # Other control messages are answered in the ACK (manifests), they are never handed to the application
+
     def get_lora_mac(self):
         return (self.lora_mac).decode('utf-8')
 
@@ -441,3 +1121,64 @@ class CTPendpoint:
 
     def get_discovered_nodes_list(self):
         return list(self.DISCOVERED_NODES.keys())
+
+    def get_metrics(self):
+        # Per-peer cumulative transfer metrics as a dict
+        return self.metrics.snapshot()
+
+    def get_sessions(self):
+        # Parameters agreed with each peer
+        return dict((addr.decode('utf-8'), agreed) for addr, agreed in self.sessions.peers.items())
+
+    def get_congestion(self):
+        # Current AIMD sending rate (frames per second) per peer, and its RTTs once it acknowledged frames
+        out = {}
+        delays = self.congestion.delays()
+        for addr, rate in self.congestion.rates().items():
+            base_rtt, srtt = delays.get(addr, (None, None))
+            out['broadcast' if addr == self.ANY_ADDR else addr.decode('utf-8')] = {
+                'rate': round(rate, 2), 'base_rtt_ms': base_rtt, 'srtt_ms': srtt}
+        return out
+
+    def reset_metrics(self):
+        self.metrics.reset()
+
+    def get_trace(self):
+        # Returns the binary trace dump (see ctptrace.decode) or None if tracing is disabled
+        if self.trace is None:
+            return None
+        return self.trace.dump()
+
+    def get_radio(self):
+        # Frames buffered and dropped by the radio callback, None if it is disabled
+        if self.radio is None:
+            return None
+        return {'data': self.rx_ring.stats(), 'ack': self.ack_ring.stats()}
+
+    def get_neighbors(self):
+        # Seconds since each node was last heard, and hellos suppressed by traffic
+        return {'heard': self.neighbors.snapshot(), 'suppressed_hellos': self.neighbors.suppressed}
+
+    def start_capture(self, path=CAPTURE_PATH, max_bytes=CAPTURE_MAX_BYTES):
+        # Records every frame sent and received to path (see ctpcapture), from the next transfer on
+        if self.capture is not None:
+            return
+        self.capture = ctpcapture.Capture(path, self.my_addr, max_bytes)
+        send, recv = self.send, self.recv
+        self.send = ctpcapture.CaptureSocket(send, self.capture, lambda: self.__link(send))
+        self.recv = ctpcapture.CaptureSocket(recv, self.capture, lambda: self.__link(recv))
+
+    def stop_capture(self):
+        if self.capture is None:
+            return
+        self.send = self.send.sock
+        self.recv = self.recv.sock
+        self.capture.close()
+        self.capture = None
+
+    def get_capture(self):
+        # Path of the capture log, flushed, None if not capturing
+        if self.capture is None:
+            return None
+        self.capture.flush()
+        return self.capture.path
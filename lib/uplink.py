@@ -0,0 +1,313 @@
+"""
+Uplink bridge
+
+Forwards the messages received over LoRa to an upstream HTTP collector over
+the node's WiFi. Messages are spooled on flash (one JSON line each) as they
+are received, and sent in batches (up to BATCH_MESSAGES and BATCH_BYTES per
+request):
+
+    POST <path> HTTP/1.0
+    Content-Type: application/json
+    Content-Encoding: deflate       (when the firmware has zlib.compress)
+    X-Node: <node name>
+
+    {"node": <node name>, "messages": [<message>, ...]}
+
+A message is its database row with the payload added, in base64. put()
+only queues it in RAM: the bridge thread encodes and appends it to the
+spool, so the radio thread that received it never waits for flash. The
+queue holds at most QUEUE_MAX_BYTES and the spool SPOOL_MAX_BYTES of unsent
+messages: past that, the oldest ones are dropped (counted in stats), in the
+spool down to three quarters of it. A message that could not fit in either
+is not forwarded at all (counted apart, as oversized).
+
+Requests run on their own XAsyncSocketsPool (XAsyncTCPClient), so neither
+the radio threads nor the web server wait for the network: only the bridge
+thread waits for the TCP connection, sending and answer are asynchronous. A batch leaves
+the spool only once the collector answers 2xx. Failed batches are retried
+with an exponential backoff, also after a reboot (the spool and the offset
+of the next batch are files).
+"""
+
+import binascii
+import os
+import time
+
+import _thread
+import ujson
+
+from MicroWebSrv2.libs.XAsyncSockets import XAsyncSocketsPool, XAsyncTCPClient
+
+try:
+    from zlib import compress
+except ImportError:
+    # The Pycom zlib (uzlib) only decompresses: batches are sent as is
+    compress = None
+
+BATCH_MESSAGES   = 32
+BATCH_BYTES      = 4096     # uncompressed JSON per request
+CONNECT_TIMEOUT  = 5        # s
+REQUEST_TIMEOUT  = 20       # s, a request (connect, send, answer) not over by then fails
+RETRY_BASE_S     = 5
+RETRY_MAX_S      = 600
+SPOOL_MAX_BYTES  = 256 * 1024   # unsent messages kept on flash, the oldest are dropped beyond
+QUEUE_MAX_BYTES  = 128 * 1024   # messages not spooled yet, in RAM: the oldest are dropped beyond
+QUEUE_ENTRY_BYTES = 128         # RAM of a queued database entry, counted with its payload
+
+
+class Bridge:
+
+    def __init__(self, collector, node_name, path='/ingest', spool='/flash/uplink.jsonl'):
+        # collector: (host, port) of the HTTP collector
+        self.collector = collector
+        self.node_name = node_name
+        self.path = path
+        self.spool = spool
+        self.offset_path = spool + '.pos'
+        self.lock = _thread.allocate_lock()
+        self.queue = []             # (entry, payload) received, not spooled yet
+        self.queue_bytes = 0
+        self.offset = self.__load_offset()
+        self.pool = None
+        self.request = None         # XAsyncTCPClient of the running request
+        self.request_start = 0
+        self.request_end = 0        # spool offset after the batch being sent
+        self.request_count = 0
+        self.answer_ok = False
+        self.request_error = None
+        self.failures = 0
+        self.next_attempt = 0
+        self.sent = 0
+        self.batches = 0
+        self.dropped = 0
+        self.oversized = 0
+        self.last_error = None
+
+    def __load_offset(self):
+        try:
+            with open(self.offset_path, 'r') as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def start(self):
+        # Event loop of the uplink sockets, in its own thread
+        self.pool = XAsyncSocketsPool()
+        self.pool.AsyncWaitEvents(threadsCount=1)
+
+    def put(self, entry, payload=None):
+        # Queue a received message (database entry and its payload) for the collector
+        size = QUEUE_ENTRY_BYTES + (len(payload) if payload is not None else 0)
+        with self.lock:
+            if size > QUEUE_MAX_BYTES:
+                self.oversized += 1
+                return
+            self.queue.append((entry, payload))
+            self.queue_bytes += size
+            while self.queue_bytes > QUEUE_MAX_BYTES:
+                old = self.queue.pop(0)[1]
+                self.queue_bytes -= QUEUE_ENTRY_BYTES + (len(old) if old is not None else 0)
+                self.dropped += 1
+
+    def spool_queued(self):
+        # Bridge thread: appends the queued messages to the spool
+        with self.lock:
+            queued = self.queue
+            self.queue = []
+            self.queue_bytes = 0
+        if not queued:
+            return
+        lines = []
+        oversized = 0
+        for entry, payload in queued:
+            if payload is not None:
+                entry = dict(entry)
+                entry['payload'] = binascii.b2a_base64(payload).strip().decode()
+            line = (ujson.dumps(entry) + '\n').encode('utf-8')
+            if len(line) > SPOOL_MAX_BYTES * 3 // 4:
+                oversized += 1      # the next trim would drop it at once
+                continue
+            lines.append(line)
+        with self.lock:
+            self.oversized += oversized
+            if not lines:
+                return
+            with open(self.spool, 'ab') as f:
+                for line in lines:
+                    f.write(line)
+            # Offsets of the batch being sent would move: trimmed once it is over
+            if self.request is None:
+                size = os.stat(self.spool)[6]
+                if size - self.offset > SPOOL_MAX_BYTES:
+                    self.__trim(size)
+
+    def __trim(self, size):
+        # Drops the oldest unsent messages down to 3/4 of SPOOL_MAX_BYTES, the newest
+        # are copied to a new spool so that the file shrinks too
+        excess = size - self.offset - SPOOL_MAX_BYTES * 3 // 4
+        tmp_path = self.spool + '.tmp'
+        dropped = 0
+        with open(self.spool, 'rb') as f:
+            f.seek(self.offset)
+            while excess > 0:
+                line = f.readline()
+                if not line:
+                    break
+                excess -= len(line)
+                dropped += 1
+            with open(tmp_path, 'wb') as out:
+                while True:
+                    chunk = f.read(1024)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+        os.remove(self.spool)
+        os.rename(tmp_path, self.spool)
+        try:
+            os.remove(self.offset_path)
+        except OSError:
+            pass
+        self.offset = 0
+        self.dropped += dropped
+
+    def __read_batch(self):
+        # JSON lines (bytes) of the next batch and the spool offset after them
+        lines = []
+        size = 0
+        with self.lock:
+            try:
+                f = open(self.spool, 'rb')
+            except OSError:
+                return lines, self.offset
+            try:
+                f.seek(self.offset)
+                end = self.offset
+                while len(lines) < BATCH_MESSAGES:
+                    line = f.readline()
+                    if not line.endswith(b'\n'):
+                        break   # end of the spool, or a line being written
+                    if lines and size + len(line) > BATCH_BYTES:
+                        break
+                    lines.append(line[:-1])
+                    size += len(line)
+                    end += len(line)
+            finally:
+                f.close()
+        return lines, end
+
+    def __ack(self, end):
+        # Batch delivered: move the offset, drop the spool once it is all sent
+        with self.lock:
+            self.offset = end
+            try:
+                done = os.stat(self.spool)[6] <= end
+            except OSError:
+                done = True
+            if done:
+                for path in (self.spool, self.offset_path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                self.offset = 0
+            else:
+                with open(self.offset_path, 'w') as f:
+                    f.write(str(end))
+
+    def __failed(self, error):
+        self.failures += 1
+        self.last_error = error
+        self.next_attempt = time.time() + min(RETRY_BASE_S << min(self.failures - 1, 10), RETRY_MAX_S)
+
+    def flush(self):
+        # Sends the next batch if none is running and a retry is not pending
+        if self.request is not None:
+            if time.time() - self.request_start > REQUEST_TIMEOUT:
+                cli = self.request
+                cli.OnClosed = None
+                cli.Close()
+                self.request = None
+                self.__failed('timeout')
+            return
+        if (self.pool is None) or (time.time() < self.next_attempt):
+            return
+        lines, end = self.__read_batch()
+        if not lines:
+            return
+
+        body = b'{"node":' + ujson.dumps(self.node_name).encode('utf-8') + b',"messages":[' + b','.join(lines) + b']}'
+        headers = 'POST {} HTTP/1.0\r\nHost: {}\r\nContent-Type: application/json\r\nX-Node: {}\r\n'.format(
+            self.path, self.collector[0], self.node_name)
+        if compress is not None:
+            body = compress(body)
+            headers += 'Content-Encoding: deflate\r\n'
+        headers += 'Content-Length: {}\r\n\r\n'.format(len(body))
+
+        self.answer_ok = False
+        self.request_error = None
+        self.request_start = time.time()
+        self.request_end = end
+        self.request_count = len(lines)
+        try:
+            cli = XAsyncTCPClient.Create(self.pool, self.collector, connectTimeout=CONNECT_TIMEOUT,
+                                         recvBufLen=256, sendBufLen=256, connectAsync=False)
+        except Exception:
+            cli = None
+        if cli is None:
+            self.__failed('connect')
+            return
+        self.request = cli
+        cli.OnClosed = self.__on_closed
+        cli.AsyncSendData(headers.encode('utf-8') + body, self.__on_sent)
+
+    def __on_sent(self, cli, arg):
+        cli.AsyncRecvLine(onLineRecv=self.__on_status, timeoutSec=REQUEST_TIMEOUT)
+
+    def __on_status(self, cli, line, arg):
+        # Status line: HTTP/1.x <code> <reason>
+        parts = line.split()
+        self.answer_ok = (len(parts) > 1) and parts[1].startswith('2')
+        if not self.answer_ok:
+            self.request_error = line.strip()
+        cli.Close()
+
+    def __on_closed(self, cli, reason):
+        if self.answer_ok:
+            self.__ack(self.request_end)
+            self.sent += self.request_count
+            self.batches += 1
+            self.failures = 0
+            self.next_attempt = 0
+        else:
+            self.__failed(self.request_error or 'no answer')
+        self.request = None
+
+    def run(self, interval=1):
+        # Thread method: send batches as long as there are messages
+        while True:
+            try:
+                self.spool_queued()
+                self.flush()
+            except Exception as ex:
+                print("Uplink exception: {}".format(ex))
+            time.sleep(interval)
+
+    def stats(self):
+        with self.lock:
+            try:
+                pending = max(0, os.stat(self.spool)[6] - self.offset)
+            except OSError:
+                pending = 0
+        return {
+            'collector': '{}:{}'.format(self.collector[0], self.collector[1]),
+            'pending_bytes': pending,
+            'queued': len(self.queue),
+            'queued_bytes': self.queue_bytes,
+            'sent': self.sent,
+            'batches': self.batches,
+            'dropped': self.dropped,
+            'oversized': self.oversized,
+            'failures': self.failures,
+            'retry_in': max(0, int(self.next_attempt - time.time())),
+            'last_error': self.last_error
+        }
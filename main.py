@@ -2,6 +2,7 @@ from network            import WLAN
 from time               import sleep
 from lib.MicroWebSrv2   import *
 import loractp
+import machine
 import pycom
 import gc
 import time
@@ -9,10 +10,26 @@ import ujson
 import _thread
 import socket
 import database
+import uplink
 
 # Set the LED to green
 LORA_CONNECTED = False
 
+# Messages larger than this are sent deduplicated (see lib/ctpdedup.py)
+DEDUP_MIN_SIZE = 2048
+
+# Upstream collector (host, port) the received messages are forwarded to over
+# WiFi (see lib/uplink.py and tools/uplink_collector.py), None to disable
+UPLINK_COLLECTOR = None
+
+# Messages per GET /messages page: default and maximum
+MESSAGES_PAGE = 50
+MESSAGES_PAGE_MAX = 200
+
+# Web server threads: POST /message blocks its thread for the whole LoRa transfer,
+# so concurrent requests need their own to be coalesced or to preempt a bulk transfer
+HTTP_WORKERS = 4
+
 # This is for semaphore
 baton = _thread.allocate_lock()
 
@@ -65,14 +82,16 @@ class WiFi:
         return clients
 
 class Node:
-    def __init__(self, ctp, wifi, database, node_name):
+    def __init__(self, ctp, wifi, database, node_name, bridge=None):
         """
-        Initialize the Node class with the LoRa CTP object, the WiFi object and the node name
+        Initialize the Node class with the LoRa CTP object, the WiFi object, the node name
+        and the uplink bridge (None when disabled)
         """
         self.ctp = ctp
         self.wifi = wifi
         self.database = database
         self.node_name = node_name
+        self.bridge = bridge
 
     @WebRoute(GET, '/info')
     def get_node_info(microWebSrv2, request):
@@ -122,9 +141,39 @@ class Node:
     @WebRoute(GET, '/messages')
     def get_messages(microWebSrv2, request):
         """
-        Returns the LoRa messages
+        Returns a page of the LoRa messages, oldest first:
+        {"messages": [...], "next_cursor": id or null}
+        Query parameters (all optional): since_id, sender, from_time, limit,
+        cursor (next_cursor of the previous page)
         """
-        return request.Response.ReturnFile('/flash/database.json')
+        params = request.QueryParams
+        try:
+            since_id = int(params.get('cursor') or params.get('since_id') or 0)
+            from_time = int(params['from_time']) if params.get('from_time') else None
+            limit = min(int(params.get('limit') or MESSAGES_PAGE), MESSAGES_PAGE_MAX)
+        except ValueError:
+            return request.Response.ReturnBadRequest()
+        if limit <= 0:
+            return request.Response.ReturnBadRequest()
+        stream = database.stream(since_id, params.get('sender') or None, from_time, limit)
+        request.Response.ContentType = 'application/json'
+        return request.Response.ReturnStream(200, stream)
+
+    @WebRoute(GET, '/messages/<id>/payload')
+    def get_message_payload(microWebSrv2, request, args):
+        """
+        Returns the payload of a LoRa message, with its content type
+        """
+        payload = database.get_payload(args['id']) if isinstance(args['id'], int) else None
+        if payload is None:
+            return request.Response.ReturnNotFound()
+        path, kind = payload
+        if path is None:
+            # Message of older firmware, stored inline
+            request.Response.ContentType = 'text/plain; charset=utf-8'
+            return request.Response.Return(200, str(kind).encode('utf-8'))
+        request.Response.ContentType = kind
+        return request.Response.ReturnFile(path)
 
     @WebRoute(POST, '/messages')
     def send_message(microWebSrv2, request):
@@ -140,6 +189,22 @@ class Node:
             address = data['address'].encode()
             broadcast = data['broadcast']
             ack_required = True
+            # Either a message, or segments ordered by priority delivered one by one (e.g. thumbnail first)
+            if data.get('segments'):
+                message = [segment.encode() for segment in data['segments']]
+                size = max(len(segment) for segment in message)
+            else:
+                message = data['message'].encode()
+                size = len(message)
+
+            # Urgent messages go out between the fragments of a bulk transfer to another node
+            urgent = bool(data.get('urgent'))
+            if urgent:
+                priority = ctp.PRIORITY_URGENT
+            elif size > DEDUP_MIN_SIZE:
+                priority = ctp.PRIORITY_BULK
+            else:
+                priority = ctp.PRIORITY_NORMAL
 
             if broadcast:
                 address = ctp.ANY_ADDR
@@ -147,11 +212,17 @@ class Node:
 
             print("Sending message {} to {} -- broadcast {}".format(message, address, broadcast))
             #baton.acquire(1, 3)
-            receiver, stats, retransmissions, lora_result, time_to_send = ctp.sendit(address, message, ack_required)
+            receiver, stats, retransmissions, lora_result, time_to_send = ctp.sendit(address, message, ack_required, dedup=size > DEDUP_MIN_SIZE, timeout=data.get('timeout'), aggregate=not urgent, priority=priority)
             #baton.release()
             result = "success"
-            if lora_result == -1:
+            outbox_id = None
+            if lora_result < 0:
                 result = "fail"
+                # Unreachable peer: keep the message on flash and deliver it when the peer is heard again
+                if not broadcast and isinstance(message, bytes):
+                    outbox_id = ctp.queue(address, message, ack_required, dedup=size > DEDUP_MIN_SIZE)
+                    if outbox_id is not None:
+                        result = "queued"
             LORA_CONNECTED = False
 
             return request.Response.ReturnJSON(200, {
@@ -159,11 +230,118 @@ class Node:
                 "packets" : stats,
                 "retransmissions" : retransmissions,
                 "status" : result,
+                "outbox_id" : outbox_id,
                 "time_to_send" : time_to_send})
         except Exception as ex:
             print(ex)
             return request.Response.ReturnJSON(500, {"status" : "You have to send a JSON with address, message and broadcast"})
 
+    @WebRoute(GET, '/outbox')
+    def get_outbox(microWebSrv2, request):
+        """
+        Returns the messages waiting for their destination to be reachable
+        """
+        return request.Response.ReturnOkJSON(ctp.get_outbox())
+
+    @WebRoute(GET, '/metrics')
+    def get_metrics(microWebSrv2, request):
+        """
+        Returns the LoRa CTP transfer metrics per peer
+        """
+        return request.Response.ReturnOkJSON(ctp.get_metrics())
+
+    @WebRoute(GET, '/sessions')
+    def get_sessions(microWebSrv2, request):
+        """
+        Returns the transfer parameters agreed with each LoRa peer
+        """
+        return request.Response.ReturnOkJSON(ctp.get_sessions())
+
+    @WebRoute(GET, '/congestion')
+    def get_congestion(microWebSrv2, request):
+        """
+        Returns the LoRa CTP sending rate per peer (frames per second)
+        """
+        return request.Response.ReturnOkJSON(ctp.get_congestion())
+
+    @WebRoute(GET, '/neighbors')
+    def get_neighbors(microWebSrv2, request):
+        """
+        Returns the seconds since each LoRa node was last heard and the hellos suppressed by traffic
+        """
+        return request.Response.ReturnOkJSON(ctp.get_neighbors())
+
+    @WebRoute(POST, '/capture')
+    def start_capture(microWebSrv2, request):
+        """
+        Start recording every LoRa frame to flash, replay it with tools/ctpreplay.py
+        """
+        ctp.start_capture()
+        return request.Response.ReturnOkJSON({"status" : "success"})
+
+    @WebRoute(GET, '/capture')
+    def get_capture(microWebSrv2, request):
+        """
+        Returns the LoRa frame capture log
+        """
+        path = ctp.get_capture()
+        if path is None:
+            return request.Response.ReturnJSON(404, {"status" : "not capturing"})
+        return request.Response.ReturnFile(path)
+
+    @WebRoute(DELETE, '/capture')
+    def stop_capture(microWebSrv2, request):
+        """
+        Stop recording LoRa frames
+        """
+        ctp.stop_capture()
+        return request.Response.ReturnOkJSON({"status" : "success"})
+
+    @WebRoute(GET, '/uplink')
+    def get_uplink(microWebSrv2, request):
+        """
+        Returns the state of the uplink bridge to the upstream collector
+        """
+        if bridge is None:
+            return request.Response.ReturnJSON(404, {"status" : "uplink disabled"})
+        return request.Response.ReturnOkJSON(bridge.stats())
+
+    @WebRoute(GET, '/database')
+    def get_database(microWebSrv2, request):
+        """
+        Returns the size of the messages database and its write buffer
+        """
+        return request.Response.ReturnOkJSON(database.stats())
+
+    @WebRoute(GET, '/radio')
+    def get_radio(microWebSrv2, request):
+        """
+        Returns the frames buffered and dropped by the LoRa receive callback
+        """
+        radio = ctp.get_radio()
+        if radio is None:
+            return request.Response.ReturnJSON(404, {"status" : "receive callback disabled"})
+        return request.Response.ReturnOkJSON(radio)
+
+    @WebRoute(DELETE, '/metrics')
+    def reset_metrics(microWebSrv2, request):
+        """
+        Reset the LoRa CTP transfer metrics
+        """
+        ctp.reset_metrics()
+        return request.Response.ReturnOkJSON({"status" : "success"})
+
+    @WebRoute(GET, '/trace')
+    def get_trace(microWebSrv2, request):
+        """
+        Returns the LoRa CTP binary trace, decode it with tools/ctptrace_dump.py
+        """
+        trace = ctp.get_trace()
+        if trace is None:
+            return request.Response.ReturnJSON(404, {"status" : "tracing disabled"})
+        request.Response.ContentType = 'application/octet-stream'
+        return request.Response.Return(200, trace)
+
     @WebRoute(DELETE, '/messages')
     def delete_messages(microWebSrv2, request):
         """
@@ -179,11 +357,24 @@ class Node:
         global LORA_CONNECTED
 
         while True:
-            LORA_CONNECTED = True
-            baton.acquire()
-            sender, stats, receiver, retrans, status = self.ctp.hello()
-            baton.release()
-            LORA_CONNECTED = False
+            # Not while data or ACK frames of this node are on the air: they prove it alive
+            if self.ctp.beacon_due(delay):
+                LORA_CONNECTED = True
+                baton.acquire()
+                sender, stats, receiver, retrans, status = self.ctp.hello()
+                baton.release()
+                LORA_CONNECTED = False
+            # Random jitter so the hellos of nodes powered up together don't keep colliding
+            sleep(delay + (machine.rng() % 2000) / 1000)
+
+    def deliver_outbox(self, delay):
+        """
+        Thread method to deliver the queued messages to the peers heard again
+        """
+        while True:
+            delivered = self.ctp.flush_outbox()
+            if delivered:
+                print("Delivered {} queued messages".format(delivered))
             sleep(delay)
 
     def change_led_status(self):
@@ -212,10 +403,13 @@ class Node:
             try:
                 # baton.acquire()
                 LORA_CONNECTED = True
-                rcvd_data, snd_addr, time_to_recv = self.ctp.recvit()
+                rcvd_data, snd_addr, time_to_recv, segment = self.ctp.recv_segment()
                 print("Received from {}: {} after {:.2f} seconds".format(snd_addr, rcvd_data, time_to_recv))
-                # Save sender and message in file
-                database.save_message(snd_addr, rcvd_data)
+                # Save sender and message, each segment as soon as it arrives: both only queue
+                # in RAM, the database and uplink threads write them to flash
+                entry = database.save_message(snd_addr, rcvd_data, segment)
+                if self.bridge is not None:
+                    self.bridge.put(entry, rcvd_data)
 
                 LORA_CONNECTED = False
                 # baton.release()
@@ -223,7 +417,7 @@ class Node:
                 print("Exception: {}".format(ex))
 
 # Create LoRa CTP endpoint
-ctp = loractp.CTPendpoint(debug_send=True, debug_recv=True)
+ctp = loractp.CTPendpoint(trace_size=512)
 node_name = "NODE-{}".format(ctp.get_my_addr())
 
 print("\n=========================")
@@ -241,12 +435,25 @@ sleep(5)
 # Initialize the database
 database = database.FileHandler()
 
+# Group commit the received messages to flash in the background
+_thread.start_new_thread(database.run, ())
+
+# Forward the received messages upstream, the bridge runs its own socket pool
+bridge = None
+if UPLINK_COLLECTOR is not None:
+    bridge = uplink.Bridge(UPLINK_COLLECTOR, node_name)
+    bridge.start()
+    _thread.start_new_thread(bridge.run, ())
+
 # Create Node
-node = Node(ctp, wifi, database, node_name)
+node = Node(ctp, wifi, database, node_name, bridge)
 
 # Send hello to others LoRa nodes in a thread every 60 seconds
 _thread.start_new_thread(node.send_lora_hello, (10, 1))
 
+# Deliver queued messages every 5 seconds
+_thread.start_new_thread(node.deliver_outbox, (5,))
+
 # Change LED status every second
 _thread.start_new_thread(node.change_led_status, ())
 
@@ -265,11 +472,14 @@ mws2.BufferSlotSize = 8*1024
 mws2.MaxRequestContentLength = 8*1024*1024
 mws2.CORSAllowAll = True
 mws2.AllowAllOrigins = True
-mws2.StartManaged()
+mws2.StartManaged(parllProcCount=HTTP_WORKERS)
 
 try :
     while mws2.IsRunning:
         sleep(0.100)
 except KeyboardInterrupt:
     mws2.Stop()
+    database.close()
+    if bridge is not None:
+        bridge.spool_queued()
     print("Stop node")
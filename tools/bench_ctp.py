@@ -0,0 +1,332 @@
+"""
+Micro-benchmark suite of the LoRaCTP per-frame hot paths on CPython.
+
+Each case runs one operation per frame of a 210 byte fragment transfer:
+
+    checksum      ctpcodec.checksum of a fragment
+    encode        ctpcodec.encode of a data frame
+    decode        ctpcodec.decode of a data frame
+    headers       ctpcodec.pack_headers, per fragment of the transfer
+    slice         fragment staging into the tx frame, as _csend does
+    reassemble    fragment append to the reassembly buffer, as _crecv does
+    register      __register_node parsing a hello with 8 neighbours
+    send          CTPendpoint._csend, whole transfer (no ACKs)
+    recv          CTPendpoint._crecv, whole transfer (ACKs sent)
+
+and reports:
+
+    ns/frame      best of the runs, without tracing: at least --repeat runs
+                  and MIN_SECONDS of them per case
+    rel           ns/frame relative to a reference loop of bytes copies and
+                  dict updates timed alternately with the case, so that the
+                  speed of the computer at the time cancels out
+    B/frame       bytes allocated per frame (tracemalloc peak between two
+                  frames above the memory at the first one, averaged), the
+                  heap churn that triggers collections on the LoPy
+    ret/frame     memory blocks retained per frame (sys.getallocatedblocks)
+    peak KB       tracemalloc peak of the whole run
+
+Usage:
+    python tools/bench_ctp.py [--frames N] [--repeat R] [--save baseline.json]
+    python tools/bench_ctp.py --check baseline.json [--tolerance 0.5]
+
+--check fails (exit status 1) when a case allocates more per frame than its
+baseline (beyond 16 bytes of measurement noise), retains anything per frame,
+or its rel time is above the baseline by more than the tolerance. Absolute
+times are reported only: they move with the load and clock of the computer.
+"""
+
+import gc
+import json
+import sys
+import time
+import tracemalloc
+
+import ctpsim
+
+ctpsim.install()
+
+import ctpcodec
+import ctpcongestion
+import ctpcsma
+import loractp
+
+SENDER = b'\x70\xb3\xd5\x49\x90\x00\x00\x01'
+RECEIVER = b'\x70\xb3\xd5\x49\x90\x00\x00\x02'
+SRC = b'90000001'
+DST = b'90000002'
+PAYLOAD_SIZE = loractp.CTPendpoint.PAYLOAD_SIZE
+HEADER_SIZE = loractp.CTPendpoint.HEADER_SIZE
+ALLOC_NOISE = 16        # bytes per frame
+MIN_SECONDS = 0.5       # of timed runs per case
+
+time.sleep = lambda seconds: None
+ctpcongestion.sleep_ms = ctpcsma.sleep_ms = lambda ms: None
+
+
+class Probe:
+    # Samples tracemalloc at frame boundaries: bytes allocated within each frame
+
+    def __init__(self):
+        self.enabled = False
+        self.total = 0
+        self.frames = 0
+        self.last = 0
+
+    def start(self):
+        self.total = self.frames = 0
+        self.enabled = True
+        tracemalloc.reset_peak()
+        self.last = tracemalloc.get_traced_memory()[0]
+
+    def mark(self, *args):
+        if not self.enabled:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        self.total += peak - self.last
+        self.frames += 1
+        tracemalloc.reset_peak()
+        self.last = current
+
+    def stop(self):
+        self.enabled = False
+        return self.total / self.frames if self.frames else 0
+
+
+class NullSocket(ctpsim.ScriptedSocket):
+    # Discards sent frames, marks the probe at each one
+
+    def __init__(self, probe, frames=None):
+        ctpsim.ScriptedSocket.__init__(self, frames)
+        self.probe = probe
+        self.index = 0
+
+    def send(self, data):
+        self.probe.mark()
+        return len(data)
+
+    def readinto(self, buf):
+        if self.index == len(self.frames):
+            raise ctpsim.socket.timeout
+        frame = self.frames[self.index]
+        self.index += 1
+        buf[:len(frame)] = frame
+        return len(frame)
+
+
+def payload_of(frames):
+    data = bytes(range(256)) * (frames * PAYLOAD_SIZE // 256 + 1)
+    return data[:frames * PAYLOAD_SIZE]
+
+
+def data_frames(payload):
+    # Frames of a transfer of payload, as sent with ack_required
+    headers = ctpcodec.pack_headers(SRC, DST, payload, PAYLOAD_SIZE)
+    total = ctpcodec.fragment_count(len(payload), PAYLOAD_SIZE)
+    return [bytes(headers[i * HEADER_SIZE:(i + 1) * HEADER_SIZE]) + payload[i * PAYLOAD_SIZE:(i + 1) * PAYLOAD_SIZE]
+            for i in range(total)]
+
+
+def micro_cases(frames, probe):
+    # name -> run(), each running one step per frame and marking the probe after it
+    payload = payload_of(frames)
+    blocks = [payload[i * PAYLOAD_SIZE:(i + 1) * PAYLOAD_SIZE] for i in range(frames)]
+    packets = data_frames(payload)
+    mark = probe.mark
+    flag_bytes = [ctpcodec.flags(i & 1, (i & 1) ^ 1, i == frames - 1, False, False, True) for i in range(frames)]
+
+    def checksum():
+        for block in blocks:
+            ctpcodec.checksum(block)
+            mark()
+
+    def encode():
+        for i, block in enumerate(blocks):
+            ctpcodec.encode(SRC, DST, flag_bytes[i], block)
+            mark()
+
+    def decode():
+        for packet in packets:
+            ctpcodec.decode(packet)
+            mark()
+
+    headers_buf = [None]
+
+    def headers():
+        headers_buf[0] = ctpcodec.pack_headers(SRC, DST, payload, PAYLOAD_SIZE, headers=headers_buf[0])
+        for i in range(frames):
+            mark()
+
+    frame = bytearray(loractp.CTPendpoint.MAX_PKT_SIZE)
+    fview = memoryview(frame)
+    hbuf = ctpcodec.pack_headers(SRC, DST, payload, PAYLOAD_SIZE)
+
+    def slice_():
+        hview = memoryview(hbuf)
+        pview = memoryview(payload)
+        for i in range(frames):
+            fview[0:HEADER_SIZE] = hview[i * HEADER_SIZE:(i + 1) * HEADER_SIZE]
+            fview[HEADER_SIZE:] = pview[i * PAYLOAD_SIZE:(i + 1) * PAYLOAD_SIZE]
+            mark()
+
+    rx = bytearray(len(payload))
+    pview_rx = [memoryview(bytearray(p)) for p in packets]
+
+    def reassemble():
+        pos = 0
+        for view in pview_rx:
+            n = len(view)
+            rx[pos:pos + n - HEADER_SIZE] = view[HEADER_SIZE:n]
+            pos += n - HEADER_SIZE
+            mark()
+
+    endpoint = ctpsim.make_endpoint(RECEIVER)
+    neighbours = dict(('9000{:04X}'.format(i), i + 1) for i in range(8))
+    neighbours[SRC.decode()] = 200
+    hello = json.dumps(neighbours).encode()
+    register_node = endpoint._CTPendpoint__register_node
+
+    def register():
+        for i in range(frames):
+            register_node(SRC, hello)
+            mark()
+
+    return [('checksum', checksum), ('encode', encode), ('decode', decode), ('headers', headers),
+            ('slice', slice_), ('reassemble', reassemble), ('register', register)]
+
+
+def engine_cases(frames, probe):
+    payload = payload_of(frames)
+
+    send_sock = NullSocket(probe)
+    sender = ctpsim.make_endpoint(SENDER, send_sock, csma=False)
+
+    def send():
+        sender._csend(payload, send_sock, sender.lora_mac, DST, ack_required=False)
+
+    recv_frames = data_frames(payload)
+    recv_sock = NullSocket(probe, recv_frames)
+    receiver = ctpsim.make_endpoint(RECEIVER, recv_sock)
+
+    def recv():
+        recv_sock.index = 0
+        receiver._crecv(recv_sock, receiver.lora_mac, receiver.ANY_ADDR)
+
+    return [('send', send), ('recv', recv)]
+
+
+def reference_case(frames):
+    # Fixed interpreter work per frame: the yardstick of the rel column
+    block = bytes(PAYLOAD_SIZE)
+    buf = bytearray(PAYLOAD_SIZE)
+    table = {}
+
+    def reference():
+        for i in range(frames):
+            buf[:] = block
+            table[i & 7] = block[i & 15:]
+    return reference
+
+
+def timed(run):
+    t0 = time.perf_counter_ns()
+    run()
+    return time.perf_counter_ns() - t0
+
+
+def measure(run, frames, repeat, probe, reference=None):
+    run()   # warm up: caches and buffers reach their steady size
+    best = best_ref = None
+    runs = 0
+    deadline = time.perf_counter() + MIN_SECONDS
+    while runs < repeat or time.perf_counter() < deadline:
+        elapsed = timed(run)
+        best = elapsed if best is None else min(best, elapsed)
+        if reference is not None:
+            elapsed = timed(reference)
+            best_ref = elapsed if best_ref is None else min(best_ref, elapsed)
+        runs += 1
+
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    probe.start()
+    run()
+    per_frame = probe.stop()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    gc.collect()
+    retained = sys.getallocatedblocks() - blocks
+    return {
+        'ns': best / frames,
+        'rel': best / best_ref if best_ref else 0,
+        'bytes': per_frame,
+        'retained': max(0, retained) / frames,
+        'peak_kb': max(0, peak - base) / 1024,
+    }
+
+
+def calibrate(frames, probe):
+    # Bytes the probe itself allocates per mark, subtracted from the results
+    def empty():
+        for i in range(frames):
+            probe.mark()
+    return measure(empty, frames, 1, probe)['bytes']
+
+
+def check(results, baseline, tolerance):
+    failures = []
+    for name, result in results.items():
+        ref = baseline.get(name)
+        if ref is None:
+            continue
+        if ('rel' in ref) and (result['rel'] > ref['rel'] * (1 + tolerance)):
+            failures.append("{}: {:.2f} rel, baseline {:.2f}".format(name, result['rel'], ref['rel']))
+        if result['bytes'] > ref['bytes'] + ALLOC_NOISE:
+            failures.append("{}: {:.0f} B/frame, baseline {:.0f}".format(name, result['bytes'], ref['bytes']))
+        if result['retained'] > ref['retained'] + 0.01:
+            failures.append("{}: retains {:.2f} blocks/frame, baseline {:.2f}".format(name, result['retained'], ref['retained']))
+    return failures
+
+
+def option(argv, name, default):
+    return argv[argv.index(name) + 1] if name in argv else default
+
+
+def main(argv):
+    if '--help' in argv:
+        print(__doc__)
+        return 0
+    frames = int(option(argv, '--frames', 500))
+    repeat = int(option(argv, '--repeat', 7))
+    tolerance = float(option(argv, '--tolerance', 0.5))
+
+    probe = Probe()
+    overhead = calibrate(frames, probe)
+    reference = reference_case(frames)
+    results = {}
+    print("{:<12} {:>10} {:>7} {:>9} {:>10} {:>9}".format("case", "ns/frame", "rel", "B/frame", "ret/frame", "peak KB"))
+    for name, run in micro_cases(frames, probe) + engine_cases(frames, probe):
+        result = measure(run, frames, repeat, probe, reference)
+        result['bytes'] = max(0.0, result['bytes'] - overhead)
+        results[name] = result
+        print("{:<12} {:>10.0f} {:>7.2f} {:>9.0f} {:>10.2f} {:>9.1f}".format(
+            name, result['ns'], result['rel'], result['bytes'], result['retained'], result['peak_kb']))
+
+    if '--save' in argv:
+        with open(option(argv, '--save', None), 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if '--check' in argv:
+        with open(option(argv, '--check', None)) as f:
+            baseline = json.load(f)
+        failures = check(results, baseline, tolerance)
+        for failure in failures:
+            print("REGRESSION " + failure)
+        print("FAIL" if failures else "OK")
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
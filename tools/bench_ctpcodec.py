@@ -0,0 +1,170 @@
+"""
+Micro-benchmark of the LoRa CTP header codec on CPython.
+
+Compares the original per-frame implementation of CTPendpoint.__make_packet
+and __unpack (format string + flag branches) with lib/ctpcodec.py, checks both
+produce identical frames and reports frames/sec.
+
+Usage:
+    python tools/bench_ctpcodec.py [frames]
+
+Each rate is the best of REPEAT runs.
+
+Data frame encoding is dominated by the SHA256 checksum on CPython; the
+"transfer" row includes the input shifting done by the original _csend, which
+is quadratic in the payload size.
+"""
+
+import binascii
+import hashlib
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import ctpcodec
+
+HEADER_FORMAT = "!8s8sB3s"
+HEADER_SIZE = 20
+PAYLOAD_SIZE = 210
+REPEAT = 7
+SRC = b'90000001'
+DST = b'90000002'
+
+
+# Reference implementation, as in loractp before the codec
+def legacy_checksum(data):
+    return binascii.hexlify(hashlib.sha256(data).digest())[-3:]
+
+
+def legacy_make_packet(s_addr, d_addr, hello, seqnum, ack_required, acknum, pkt_type, is_last, content):
+    flags = 0
+    if seqnum == 1:
+        flags = flags | (1<<0)
+    if acknum == 1:
+        flags = flags | (1<<2)
+    if is_last:
+        flags = flags | (1<<4)
+    if hello:
+        flags = flags | (1<<5)
+    if pkt_type:
+        flags = flags | (1<<6)
+    if ack_required:
+        flags = flags | (1<<7)
+    if len(content) > 0 and not pkt_type:
+        p = content
+        h = struct.pack(HEADER_FORMAT, s_addr, d_addr, flags, legacy_checksum(p))
+    else:
+        p = b''
+        h = struct.pack(HEADER_FORMAT, s_addr, d_addr, flags, b'')
+    return h + p
+
+
+def legacy_unpack(packet):
+    header  = packet[:HEADER_SIZE]
+    content = packet[HEADER_SIZE:]
+    sp, dp, flags, check = struct.unpack(HEADER_FORMAT, header)
+    seqnum   = 1 if flags & 1 else 0
+    acknum   = 1 if (flags >> 2) & 1 else 0
+    is_last  = (flags >> 4) & 1 == 1
+    hello    = (flags >> 5) & 1 == 1
+    pkt_type = (flags >> 6) & 1 == 1
+    ack_required = (flags >> 7) & 1 == 1
+    return sp, dp, hello, seqnum, ack_required, acknum, pkt_type, is_last, check, content
+
+
+def check_compatible(payload):
+    total = ctpcodec.fragment_count(len(payload), PAYLOAD_SIZE)
+    headers = ctpcodec.pack_headers(SRC, DST, payload, PAYLOAD_SIZE)
+    for i in range(total):
+        block = payload[i * PAYLOAD_SIZE:(i + 1) * PAYLOAD_SIZE]
+        seqnum = i & 1
+        old = legacy_make_packet(SRC, DST, False, seqnum, True, seqnum ^ 1, False, i == total - 1, block)
+        new = ctpcodec.encode(SRC, DST, ctpcodec.flags(seqnum, seqnum ^ 1, i == total - 1, False, False, True), block)
+        assert old == new, "encode mismatch at fragment {}".format(i)
+        assert bytes(headers[i * HEADER_SIZE:(i + 1) * HEADER_SIZE]) + block == old, "batch mismatch at fragment {}".format(i)
+        assert legacy_unpack(old) == ctpcodec.decode(old), "decode mismatch at fragment {}".format(i)
+    acks = ctpcodec.AckCache(DST)
+    for flags in range(256):
+        if flags & ctpcodec.F_IS_ACK and not flags & 0x0A:
+            f = ctpcodec.FLAGS_DECODE[flags]
+            old = legacy_make_packet(DST, SRC, f[0], f[1], f[2], f[3], True, f[5], b'')
+            assert acks.get(SRC, flags) == old, "ack mismatch for flags {}".format(flags)
+
+
+def rate(frames, fn, repeat=REPEAT):
+    # Best of repeat runs: a single run is too noisy to compare
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return frames / best
+
+
+def main(argv):
+    frames = int(argv[1]) if len(argv) > 1 else 2000
+    payload = os.urandom(frames * PAYLOAD_SIZE)
+    check_compatible(payload[:50 * PAYLOAD_SIZE + 17])
+
+    blocks = [payload[i * PAYLOAD_SIZE:(i + 1) * PAYLOAD_SIZE] for i in range(frames)]
+    packets = [legacy_make_packet(SRC, DST, False, i & 1, True, (i & 1) ^ 1, False, False, b) for i, b in enumerate(blocks)]
+    acks = ctpcodec.AckCache(SRC)
+
+    def legacy_encode():
+        for i, b in enumerate(blocks):
+            legacy_make_packet(SRC, DST, False, i & 1, True, (i & 1) ^ 1, False, False, b)
+
+    def codec_encode():
+        for i, b in enumerate(blocks):
+            ctpcodec.encode(SRC, DST, ctpcodec.flags(i & 1, (i & 1) ^ 1, False, False, False, True), b)
+
+    def codec_batch():
+        ctpcodec.pack_headers(SRC, DST, payload, PAYLOAD_SIZE)
+
+    def legacy_transfer():
+        # Fragmentation loop of the original _csend: shift the input and build each frame
+        rest = payload
+        for i in range(frames):
+            block = rest[0:PAYLOAD_SIZE]
+            rest = rest[PAYLOAD_SIZE:]
+            legacy_make_packet(SRC, DST, False, i & 1, True, (i & 1) ^ 1, False, i == frames - 1, block)
+
+    def codec_transfer():
+        headers = ctpcodec.pack_headers(SRC, DST, payload, PAYLOAD_SIZE)
+        for i in range(frames):
+            headers[i * HEADER_SIZE:(i + 1) * HEADER_SIZE] + payload[i * PAYLOAD_SIZE:(i + 1) * PAYLOAD_SIZE]
+
+    def legacy_decode():
+        for p in packets:
+            legacy_unpack(p)
+
+    def codec_decode():
+        for p in packets:
+            ctpcodec.decode(p)
+
+    def legacy_ack():
+        for i in range(frames):
+            legacy_make_packet(SRC, DST, False, i & 1, True, (i & 1) ^ 1, True, False, b'')
+
+    def codec_ack():
+        for i in range(frames):
+            acks.get(DST, ctpcodec.flags(i & 1, (i & 1) ^ 1, False, False, True, True))
+
+    print("{:<14} {:>14} {:>14} {:>8}".format("operation", "legacy fr/s", "codec fr/s", "gain"))
+    for name, old, new in (("encode", legacy_encode, codec_encode),
+                           ("encode batch", legacy_encode, codec_batch),
+                           ("transfer", legacy_transfer, codec_transfer),
+                           ("decode", legacy_decode, codec_decode),
+                           ("ack frame", legacy_ack, codec_ack)):
+        r_old = rate(frames, old)
+        r_new = rate(frames, new)
+        print("{:<14} {:>14.0f} {:>14.0f} {:>7.2f}x".format(name, r_old, r_new, r_new / r_old))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
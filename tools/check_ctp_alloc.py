@@ -0,0 +1,221 @@
+"""
+Allocation check of the LoRaCTP protocol engine on CPython.
+
+Drives a full stop & wait transfer through CTPendpoint._csend and _crecv over
+scripted sockets (single threaded, so the counts are exact) and checks that:
+
+- steady-state fragments allocate nothing that outlives them: the number of
+  allocated memory blocks is sampled at every frame sent and must not grow
+  from one fragment to the next,
+- the transient memory a fragment allocates (median tracemalloc peak between
+  two frames, the garbage that triggers collections on the LoPy) stays within
+  the budget of the allocations left in the hot path, listed below,
+- the tracemalloc peak of a transfer does not grow with its fragment count
+  beyond the data handed to the application.
+
+Allocations left per fragment (CPython sizes, a few tens of bytes each on
+MicroPython):
+    send    the memoryview slices copying the header and the payload block
+            into the preallocated tx frame (one alive at a time)
+    recv    the memoryview of the fragment content (checksum and reassembly
+            copy), the SHA256 object and its digest
+
+Usage:
+    python tools/check_ctp_alloc.py
+Exits with status 1 on failure.
+"""
+
+import array
+import sys
+import time
+import tracemalloc
+
+import ctpsim
+
+ctpsim.install()
+
+import ctpcodec
+import ctpsession
+
+# Bytes a steady-state fragment may allocate transiently (see above)
+FRAME_BUDGET = {'send': 256, 'recv': 384}
+
+SENDER = b'\x70\xb3\xd5\x49\x90\x00\x00\x01'
+RECEIVER = b'\x70\xb3\xd5\x49\x90\x00\x00\x02'
+time.sleep = lambda seconds: None
+
+
+def sender_frames(payload):
+    # Frames a sender emits for payload, as seen on the air
+    sender = ctpsim.make_endpoint(SENDER)
+    sender.sendit(b'90000002', payload, ack_required=False)
+    frames = sender.send.sent
+    # ack_required is part of the flags: set it as a normal transfer would
+    out = []
+    for frame in frames:
+        frame = bytearray(frame)
+        frame[16] |= ctpcodec.F_ACK_REQ
+        out.append(bytes(frame))
+    return out
+
+
+def ack_frames(frames):
+    # ACKs a receiver answers to frames
+    receiver = ctpsim.make_endpoint(RECEIVER, ctpsim.ScriptedSocket(frames))
+    receiver.recvit()
+    return receiver.send.sent
+
+
+class Samples:
+    # Per frame samples kept in preallocated arrays, so that sampling itself
+    # retains no Python objects: sys.getallocatedblocks(), and while
+    # tracemalloc runs the bytes allocated since the previous frame (peak
+    # above the memory in use at that frame)
+
+    def __init__(self, size):
+        self.values = array.array('q', [0] * size)
+        self.transient = array.array('q', [0] * size)
+        self.count = 0
+        self.last = 0
+
+    def sample(self, *args):
+        self.values[self.count] = sys.getallocatedblocks()
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            self.transient[self.count] = peak - self.last
+            tracemalloc.reset_peak()
+            self.last = tracemalloc.get_traced_memory()[0]
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    def start(self):
+        tracemalloc.reset_peak()
+        self.last = tracemalloc.get_traced_memory()[0]
+
+    def list(self):
+        return list(self.values[:self.count])
+
+    def transients(self):
+        return list(self.transient[:self.count])
+
+
+def probe_overhead():
+    # Bytes the sampling itself shows per frame, subtracted from the measures
+    samples = Samples(101)
+    tracemalloc.start()
+    samples.start()
+    for i in range(101):
+        samples.sample()
+    tracemalloc.stop()
+    return max(samples.transients()[1:])
+
+
+def run_sender(payload, acks):
+    sock = ctpsim.ScriptedSocket()
+    sender = ctpsim.make_endpoint(SENDER, sock)
+    pending = list(acks)
+    blocks = Samples(len(acks) + 1)
+
+    def on_send(data):
+        blocks.sample()
+        sock.frames.append(pending.pop(0))
+
+    sock.on_send = on_send
+    sender.sessions.put(b'90000002', ctpsession.LEGACY)   # the scripted peer answers data frames only
+    sender.sendit(b'90000002', payload)     # warm up: buffers reach their steady size
+    pending[:] = acks
+    blocks.clear()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    result = sender.sendit(b'90000002', payload)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    assert result[3] == 0, "transfer failed"
+
+    # Transient allocations per frame, in a run of its own: the peak above includes them
+    pending[:] = acks
+    blocks.clear()
+    tracemalloc.start()
+    blocks.start()
+    sender.sendit(b'90000002', payload)
+    tracemalloc.stop()
+    return blocks.list(), peak, blocks.transients()
+
+
+def run_receiver(frames):
+    sock = ctpsim.ScriptedSocket()
+    receiver = ctpsim.make_endpoint(RECEIVER, sock)
+    blocks = Samples(len(frames) + 1)
+    sock.on_send = blocks.sample
+    sock.frames = list(frames)
+    receiver.recvit()                       # warm up
+    blocks.clear()
+    sock.frames = list(frames)
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    data = receiver.recvit()[0]
+    peak = tracemalloc.get_traced_memory()[1] - base - len(data)
+    tracemalloc.stop()
+
+    blocks.clear()
+    sock.frames = list(frames)
+    tracemalloc.start()
+    blocks.start()
+    receiver.recvit()
+    tracemalloc.stop()
+    return blocks.list(), peak, blocks.transients()
+
+
+def growth(blocks):
+    # Blocks retained across steady-state fragments: the first half of the
+    # transfer lets the RTT estimator settle, the last fragment is skipped
+    steady = blocks[len(blocks) // 2:-1]
+    return max(steady) - steady[0] if steady else 0
+
+
+def transient(samples, overhead):
+    # Transient allocation of a steady-state fragment (as for growth()), the
+    # median: one-off interpreter allocations (free lists, caches) are not the
+    # fragment's
+    steady = sorted(samples[len(samples) // 2:-1])
+    return max(0, steady[len(steady) // 2] - overhead) if steady else 0
+
+
+def main():
+    failed = False
+    peaks = {}
+    overhead = probe_overhead()
+    for fragments in (20, 200):
+        payload = bytes(range(256)) * (fragments * 210 // 256 + 1)
+        payload = payload[:fragments * 210]
+        frames = sender_frames(payload)
+        acks = ack_frames(frames)
+
+        blocks, peak, samples = run_sender(payload, acks)
+        peaks.setdefault('send', []).append(peak)
+        print("send {:>4} fragments: {} blocks retained across fragments, {} bytes transient per fragment, peak {} bytes".format(
+            fragments, growth(blocks), transient(samples, overhead), peak))
+        failed |= growth(blocks) > 0
+        failed |= transient(samples, overhead) > FRAME_BUDGET['send']
+
+        blocks, peak, samples = run_receiver(frames)
+        peaks.setdefault('recv', []).append(peak)
+        print("recv {:>4} fragments: {} blocks retained across fragments, {} bytes transient per fragment, peak {} bytes (excluding data)".format(
+            fragments, growth(blocks), transient(samples, overhead), peak))
+        failed |= growth(blocks) > 0
+        failed |= transient(samples, overhead) > FRAME_BUDGET['recv']
+
+    # Peak memory of a transfer may not depend on its length
+    for side, (small, large) in peaks.items():
+        if large > small + 1024:
+            print("{}: peak grows with the number of fragments ({} -> {} bytes)".format(side, small, large))
+            failed = True
+
+    print("FAIL" if failed else "OK")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+"""
+Retention check of the messages database on CPython.
+
+Stores messages in a temporary directory with the database of the node
+(log segments and blob store) and checks that the bytes it occupies stay
+under retain_bytes once the compaction steps are done, for large image
+payloads as well as for many small messages. Messages are committed and
+compacted after each one, as the writer thread does.
+
+Usage:
+    python tools/check_db_retention.py
+Exits with status 1 on failure.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import ctpsim
+
+ctpsim.install()
+
+import database
+
+
+def flash_use(path):
+    # Bytes of the files under path
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def run(name, messages, size, retain_bytes):
+    path = tempfile.mkdtemp()
+    try:
+        db = database.FileHandler(os.path.join(path, 'messages.log'), os.path.join(path, 'database.json'),
+                                  os.path.join(path, 'blobs'), commit_ms=0, retain_bytes=retain_bytes)
+        worst = 0
+        for i in range(messages):
+            payload = b'\xff\xd8\xff' + i.to_bytes(4, 'big') + os.urandom(size - 7)
+            db.save_message(b'90000001', payload)
+            while db.compact_step():
+                pass
+            worst = max(worst, flash_use(path))
+        stats = db.stats()
+        print("{:<8} {} x {} B, limit {} KB: worst {} KB on flash, {} messages kept in {} segments".format(
+            name, messages, size, retain_bytes // 1024, worst // 1024, stats['messages'], stats['segments']))
+        return worst <= retain_bytes
+    finally:
+        shutil.rmtree(path)
+
+
+def main():
+    ok = run('images', 30, 100 * 1024, 512 * 1024)
+    ok &= run('text', 3000, 40, 128 * 1024)
+    print("OK" if ok else "FAIL")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
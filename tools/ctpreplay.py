@@ -0,0 +1,148 @@
+"""
+Replay a LoRa CTP frame capture through the receive path on a computer.
+
+The frames received by the capturing node (GET /capture, see ctpcapture)
+are fed, in order, to a CTPendpoint with the same address running on
+CPython. The messages it rebuilds, its metrics and the ACKs it answers are
+printed; the ACKs are compared with the ones the node actually sent, so a
+difference points at a change of behaviour of the receive path.
+
+Usage:
+    python tools/ctpreplay.py http://192.168.4.1/capture [--save capture.bin]
+    python tools/ctpreplay.py capture.bin [--speed N] [--profile] [--dump]
+
+    --speed N   replay N times faster than recorded (default 0: as fast as possible)
+    --profile   profile the replay (cProfile, top 25 by cumulative time)
+    --dump      list the captured frames and exit
+
+Frames are replayed in order at the recorded pace, but the endpoint runs its
+own clock: inactivity timeouts only match the field when --speed is 1.
+"""
+
+import binascii
+import socket
+import sys
+import time
+from urllib.request import urlopen
+
+import ctpsim
+
+ctpsim.install()
+
+import ctpcapture
+import ctpcodec
+import ctpdeadline
+
+
+class ReplaySocket(ctpsim.ScriptedSocket):
+    # Returns the captured frames at their recorded time (scaled by speed),
+    # cancels the replay once they are exhausted
+
+    def __init__(self, records, speed, cancel):
+        ctpsim.ScriptedSocket.__init__(self)
+        self.records = records
+        self.speed = speed
+        self.cancel = cancel
+        self.index = 0
+        self.t0 = None
+
+    def readinto(self, buf):
+        if self.index == len(self.records):
+            self.cancel.cancel()
+            raise socket.timeout
+        t_ms, frame = self.records[self.index]
+        self.index += 1
+        if self.speed:
+            if self.t0 is None:
+                self.t0 = time.time() - t_ms / 1000.0 / self.speed
+            wait = self.t0 + t_ms / 1000.0 / self.speed - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        buf[:len(frame)] = frame
+        return len(frame)
+
+
+def load(source):
+    if source.startswith('http://') or source.startswith('https://'):
+        with urlopen(source) as response:
+            return response.read()
+    with open(source, 'rb') as f:
+        return f.read()
+
+
+def dump(records):
+    for direction, t_ms, rssi, snr, frame in records:
+        flags = ctpcodec.flag_byte(frame) if len(frame) >= ctpcodec.header_size(frame) else 0
+        kind = 'ack' if flags & ctpcodec.F_IS_ACK else ('hello' if flags & ctpcodec.F_HELLO else 'data')
+        print("{:>10} ms  {}  {:<5} len={:<4} rssi={:<4} snr={:<3} {}".format(
+            t_ms, 'TX' if direction == ctpcapture.TX else 'RX', kind, len(frame), rssi, snr,
+            binascii.hexlify(frame[:24]).decode()))
+    print("{} frames".format(len(records)))
+
+
+def replay(my_addr, records, speed):
+    # Runs the receive path over the received frames, returns (messages, endpoint)
+    cancel = ctpdeadline.CancelToken()
+    rx = [(t_ms, frame) for direction, t_ms, rssi, snr, frame in records if direction == ctpcapture.RX]
+    sock = ReplaySocket(rx, speed, cancel)
+    endpoint = ctpsim.make_endpoint(b'\x70\xb3\xd5\x49' + binascii.unhexlify(my_addr), sock)
+    messages = []
+    while True:
+        t0 = time.time()
+        try:
+            data, sender, time_to_recv, segment = endpoint.recv_segment(cancel=cancel)
+        except ctpdeadline.Cancelled:
+            break
+        messages.append((sender, data, segment, time.time() - t0))
+    return messages, endpoint
+
+
+def compare_acks(records, sent):
+    # (ACKs sent in the field, ACKs sent by the replay, identical in order)
+    field = [frame for direction, t_ms, rssi, snr, frame in records
+             if direction == ctpcapture.TX and ctpcodec.flag_byte(frame) & ctpcodec.F_IS_ACK]
+    replayed = [frame for frame in sent if ctpcodec.flag_byte(frame) & ctpcodec.F_IS_ACK]
+    same = 0
+    for a, b in zip(field, replayed):
+        if a == b:
+            same += 1
+    return len(field), len(replayed), same
+
+
+def main(argv):
+    if len(argv) < 2:
+        print(__doc__)
+        return 1
+    data = load(argv[1])
+    if '--save' in argv:
+        with open(argv[argv.index('--save') + 1], 'wb') as f:
+            f.write(data)
+    my_addr, records = ctpcapture.decode(data)
+    if '--dump' in argv:
+        dump(records)
+        return 0
+    speed = float(argv[argv.index('--speed') + 1]) if '--speed' in argv else 0
+
+    if '--profile' in argv:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        messages, endpoint = replay(my_addr, records, speed)
+        profiler.disable()
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    else:
+        messages, endpoint = replay(my_addr, records, speed)
+
+    print("Node {}: {} frames captured".format(my_addr.decode(), len(records)))
+    for sender, payload, segment, elapsed in messages:
+        print("  from {}: {} bytes{} in {:.3f} s".format(
+            sender.decode(), len(payload), ' segment {}'.format(segment) if segment else '', elapsed))
+    print("Metrics: {}".format(endpoint.get_metrics()))
+    field, replayed, same = compare_acks(records, endpoint.send.sent)
+    print("ACKs: {} in the field, {} replayed, {} identical".format(field, replayed, same))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
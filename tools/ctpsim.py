@@ -0,0 +1,131 @@
+"""
+Run lib/loractp.py on CPython.
+
+Installs stand-ins for the Pycom modules imported by loractp (network,
+machine, ujson and the AF_LORA socket constants) so CTPendpoint can be built
+on a computer, and provides in-memory sockets to drive its protocol engine.
+Used by the offline tools (allocation check, benchmarks, replay); it is not
+uploaded to the LoPy.
+"""
+
+import json
+import os
+import socket
+import sys
+import types
+
+LIB = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib')
+if LIB not in sys.path:
+    sys.path.insert(0, LIB)
+
+
+class LoRa:
+    LORA = 0
+    LORAWAN = 1
+    CODING_4_5 = 1
+    BW_125KHZ = 0
+    BW_250KHZ = 1
+    BW_500KHZ = 2
+    ALWAYS_ON = 0
+    RX_PACKET_EVENT = 1
+    TX_PACKET_EVENT = 2
+
+    mac_address = b'\x70\xb3\xd5\x49\x90\x00\x00\x01'
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def mac(self):
+        return LoRa.mac_address
+
+    def stats(self):
+        return types.SimpleNamespace(rssi=-80, snr=7.0, sftx=7, sfrx=7, rx_timestamp=0)
+
+    def ischannel_free(self, rssi_threshold):
+        return True
+
+    def callback(self, *args, **kwargs):
+        pass
+
+
+class RTC:
+
+    def init(self, *args):
+        pass
+
+
+def install():
+    # Register the stand-in modules, idempotent
+    if 'network' not in sys.modules:
+        network = types.ModuleType('network')
+        network.LoRa = LoRa
+        sys.modules['network'] = network
+    if 'machine' not in sys.modules:
+        machine = types.ModuleType('machine')
+        machine.RTC = RTC
+        machine.rng = lambda: int.from_bytes(os.urandom(3), 'big')
+        sys.modules['machine'] = machine
+    if 'ujson' not in sys.modules:
+        ujson = types.ModuleType('ujson')
+        ujson.loads = json.loads
+        ujson.dumps = lambda obj: json.dumps(obj, separators=(',', ':'))
+        sys.modules['ujson'] = ujson
+    if not hasattr(socket, 'AF_LORA'):
+        socket.AF_LORA = 160
+        socket.SOCK_RAW = getattr(socket, 'SOCK_RAW', 3)
+
+
+class ScriptedSocket:
+    # Socket whose received frames come from a list (or a callable), sent frames are collected
+
+    def __init__(self, frames=None):
+        self.frames = list(frames or [])
+        self.sent = []
+        self.on_send = None
+        self.timeout = None
+
+    def settimeout(self, value):
+        self.timeout = value
+
+    def setblocking(self, flag):
+        self.timeout = None if flag else 0
+
+    def send(self, data):
+        if self.on_send is not None:
+            self.on_send(data)
+        else:
+            self.sent.append(bytes(data))
+        return len(data)
+
+    def recv(self, size):
+        if not self.frames:
+            raise socket.timeout
+        return self.frames.pop(0)[:size]
+
+    def readinto(self, buf):
+        if not self.frames:
+            raise socket.timeout
+        frame = self.frames.pop(0)
+        buf[:len(frame)] = frame
+        return len(frame)
+
+
+def make_endpoint(mac=None, sock=None, **kwargs):
+    # Build a CTPendpoint with the given 8 byte LoRa MAC, both sockets replaced by sock.
+    # There is no /flash here: the chunk cache and the outbox are off unless a directory is given.
+    # The engine reads sock directly: there is no radio callback filling the rings
+    install()
+    kwargs.setdefault('chunk_cache', None)
+    kwargs.setdefault('outbox', None)
+    kwargs.setdefault('irq_rx', False)
+    import loractp
+    if mac is not None:
+        LoRa.mac_address = mac
+    real_socket = socket.socket
+    socket.socket = lambda *args, **kw: None
+    try:
+        endpoint = loractp.CTPendpoint(**kwargs)
+    finally:
+        socket.socket = real_socket
+    endpoint.send = endpoint.recv = sock if sock is not None else ScriptedSocket()
+    return endpoint
@@ -0,0 +1,42 @@
+"""
+Decode a LoRa CTP trace dump on a computer.
+
+Usage:
+    python tools/ctptrace_dump.py http://192.168.4.1/trace
+    python tools/ctptrace_dump.py trace.bin [--save trace.bin]
+"""
+
+import os
+import sys
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import ctptrace
+
+
+def main(argv):
+    if len(argv) < 2:
+        print(__doc__)
+        return 1
+
+    source = argv[1]
+    if source.startswith('http://') or source.startswith('https://'):
+        with urlopen(source) as response:
+            data = response.read()
+    else:
+        with open(source, 'rb') as f:
+            data = f.read()
+
+    if '--save' in argv:
+        with open(argv[argv.index('--save') + 1], 'wb') as f:
+            f.write(data)
+
+    events = ctptrace.decode(data)
+    print(ctptrace.format_events(events))
+    print("{} events".format(len(events)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
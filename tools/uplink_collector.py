@@ -0,0 +1,74 @@
+"""
+Stand-in upstream collector for the uplink bridge (lib/uplink.py).
+
+Accepts the message batches POSTed by the nodes, inflates them when they are
+deflate encoded, prints them and appends every message, tagged with its
+node, to a JSON lines file.
+
+Usage:
+    python tools/uplink_collector.py [--port 8080] [--out messages.jsonl] [--fail-every N]
+
+    --fail-every N  answer 503 to every Nth request, to exercise the retries
+"""
+
+import json
+import sys
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class Collector(BaseHTTPRequestHandler):
+    out = None
+    fail_every = 0
+    requests = 0
+
+    def do_POST(self):
+        Collector.requests += 1
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if Collector.fail_every and Collector.requests % Collector.fail_every == 0:
+            self.answer(503, b'unavailable\n')
+            return
+        try:
+            if self.headers.get('Content-Encoding') == 'deflate':
+                body = zlib.decompress(body)
+            batch = json.loads(body)
+        except (ValueError, zlib.error) as ex:
+            self.answer(400, 'bad batch: {}\n'.format(ex).encode())
+            return
+        node = batch.get('node')
+        messages = batch.get('messages', [])
+        with open(Collector.out, 'a') as f:
+            for message in messages:
+                f.write(json.dumps({'node': node, 'message': message}) + '\n')
+        print("{}: {} messages ({} bytes on the wire)".format(node, len(messages), self.headers.get('Content-Length')))
+        self.answer(200, b'ok\n')
+
+    def answer(self, code, text):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(argv):
+    if '--help' in argv:
+        print(__doc__)
+        return 0
+    port = int(argv[argv.index('--port') + 1]) if '--port' in argv else 8080
+    Collector.out = argv[argv.index('--out') + 1] if '--out' in argv else 'messages.jsonl'
+    Collector.fail_every = int(argv[argv.index('--fail-every') + 1]) if '--fail-every' in argv else 0
+    server = HTTPServer(('', port), Collector)
+    print("Collecting on port {} into {}".format(port, Collector.out))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))